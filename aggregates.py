@@ -0,0 +1,165 @@
+"""Денормализованные счетчики и статистика пользователей.
+
+total_meetings, completed_meetings, rating_sum, rating_count и average_rating
+в таблице users обновляются в той же транзакции, что и встречи и оценки,
+поэтому /stats читает одну строку. reconcile_user_aggregates пересчитывает
+все счетчики одним запросом и исправляет возможное расхождение.
+
+get_user_stats / get_users_stats возвращают статистику, уровень опыта и
+достижения одним SQL-запросом для одного пользователя или для списка.
+"""
+import logging
+from collections import Counter
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import case, func, or_, select, update
+
+from database import Meeting, Rating, User, chunked
+
+logger = logging.getLogger(__name__)
+
+# Уровни опыта по числу встреч (от высшего к низшему)
+EXPERIENCE_LEVELS = (
+    (20, 'expert'),
+    (10, 'regular'),
+)
+DEFAULT_EXPERIENCE_LEVEL = 'newbie'
+
+# Достижения за число встреч
+MEETING_ACHIEVEMENTS = (
+    ('first_meeting', 1),
+    ('meetings_5', 5),
+    ('meetings_10', 10),
+    ('meetings_20', 20),
+)
+
+# Достижение за средний рейтинг
+TOP_RATED_ACHIEVEMENT = ('top_rated', 4.5)
+
+
+async def record_meetings(session, meetings: Iterable[Dict]):
+    """Увеличивает total_meetings участникам новых встреч (без commit)"""
+    per_user = Counter()
+    for meeting in meetings:
+        per_user[meeting['user1_id']] += 1
+        per_user[meeting['user2_id']] += 1
+
+    # Один UPDATE на каждое различное приращение (обычно 1 или 2) и часть участников
+    by_increment: Dict[int, list] = {}
+    for user_id, increment in per_user.items():
+        by_increment.setdefault(increment, []).append(user_id)
+    for increment, user_ids in by_increment.items():
+        for chunk in chunked(user_ids):
+            await session.execute(
+                update(User).filter(User.id.in_(chunk))
+                .values(total_meetings=func.coalesce(User.total_meetings, 0) + increment)
+                .execution_options(synchronize_session=False))
+
+
+async def complete_meeting(session, meeting_id: int) -> bool:
+    """Отмечает встречу завершенной и обновляет счетчики (без commit)"""
+    meeting = await session.get(Meeting, meeting_id, with_for_update=True)
+    if meeting is None or meeting.status == 'completed':
+        return False
+    meeting.status = 'completed'
+    await session.execute(
+        update(User).filter(User.id.in_([meeting.user1_id, meeting.user2_id]))
+        .values(completed_meetings=func.coalesce(User.completed_meetings, 0) + 1)
+        .execution_options(synchronize_session=False))
+    return True
+
+
+async def add_rating(session, meeting_id: int, from_user_id: int, to_user_id: int,
+                     rating: float, comment: str = None) -> Rating:
+    """Сохраняет оценку и обновляет рейтинг получателя (без commit)"""
+    new_rating = Rating(meeting_id=meeting_id, from_user_id=from_user_id,
+                        to_user_id=to_user_id, rating=rating, comment=comment)
+    session.add(new_rating)
+    rating_sum = func.coalesce(User.rating_sum, 0) + rating
+    rating_count = func.coalesce(User.rating_count, 0) + 1
+    await session.execute(
+        update(User).filter(User.id == to_user_id)
+        .values(rating_sum=rating_sum, rating_count=rating_count,
+                average_rating=rating_sum / rating_count)
+        .execution_options(synchronize_session=False))
+    return new_rating
+
+
+def reconcile_statement():
+    """UPDATE, пересчитывающий счетчики всех пользователей по встречам и оценкам"""
+    involved = or_(Meeting.user1_id == User.id, Meeting.user2_id == User.id)
+    total = select(func.count(Meeting.id)).filter(involved).scalar_subquery()
+    completed = select(func.count(Meeting.id)).filter(
+        involved, Meeting.status == 'completed').scalar_subquery()
+    rating_sum = select(func.coalesce(func.sum(Rating.rating), 0.0)).filter(
+        Rating.to_user_id == User.id).scalar_subquery()
+    rating_count = select(func.count(Rating.rating)).filter(
+        Rating.to_user_id == User.id).scalar_subquery()
+    average = select(func.coalesce(func.avg(Rating.rating), 0.0)).filter(
+        Rating.to_user_id == User.id).scalar_subquery()
+    return update(User).values(
+        total_meetings=total,
+        completed_meetings=completed,
+        rating_sum=rating_sum,
+        rating_count=rating_count,
+        average_rating=average,
+    ).execution_options(synchronize_session=False)
+
+
+async def reconcile_user_aggregates(session):
+    """Пересчитывает счетчики всех пользователей одним запросом"""
+    result = await session.execute(reconcile_statement())
+    await session.commit()
+    logger.info(f"Reconciled aggregates for {result.rowcount} users")
+    return result.rowcount
+
+
+def _stats_statement():
+    """SELECT со статистикой, уровнем опыта и флагами достижений"""
+    total = func.coalesce(User.total_meetings, 0)
+    average = func.coalesce(User.average_rating, 0.0)
+    level = case(*((total >= threshold, name) for threshold, name in EXPERIENCE_LEVELS),
+                 else_=DEFAULT_EXPERIENCE_LEVEL)
+    achievement_name, achievement_rating = TOP_RATED_ACHIEVEMENT
+    flags = [case((total >= threshold, 1), else_=0).label(name)
+             for name, threshold in MEETING_ACHIEVEMENTS]
+    flags.append(case((average >= achievement_rating, 1),
+                 else_=0).label(achievement_name))
+    return select(
+        User.telegram_id,
+        total.label('total_meetings'),
+        func.coalesce(User.completed_meetings, 0).label('completed_meetings'),
+        average.label('avg_rating'),
+        level.label('experience_level'),
+        User.created_at,
+        *flags
+    )
+
+
+def _stats_from_row(row) -> Dict:
+    achievement_names = [name for name, _ in MEETING_ACHIEVEMENTS]
+    achievement_names.append(TOP_RATED_ACHIEVEMENT[0])
+    return {
+        'total_meetings': row.total_meetings,
+        'completed_meetings': row.completed_meetings,
+        'avg_rating': round(row.avg_rating, 1),
+        'experience_level': row.experience_level,
+        'registration_date': row.created_at,
+        'achievements': [name for name in achievement_names if getattr(row, name)],
+    }
+
+
+async def get_user_stats(session, telegram_id: int) -> Optional[Dict]:
+    """Статистика пользователя одним запросом (None, если он не зарегистрирован)"""
+    row = (await session.execute(
+        _stats_statement().filter(User.telegram_id == telegram_id))).first()
+    return _stats_from_row(row) if row else None
+
+
+async def get_users_stats(session, telegram_ids: List[int]) -> Dict[int, Dict]:
+    """Статистика списка пользователей за один запрос: {telegram_id: stats}"""
+    if not telegram_ids:
+        return {}
+    rows = (await session.execute(
+        _stats_statement().filter(User.telegram_id.in_(telegram_ids)))).all()
+    return {row.telegram_id: _stats_from_row(row) for row in rows}
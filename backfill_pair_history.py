@@ -0,0 +1,42 @@
+"""Разовое заполнение pair_history из существующей таблицы meetings.
+
+Запуск (после `alembic upgrade head`):
+    python backfill_pair_history.py
+
+Скрипт идемпотентен: таблица пересчитывается целиком в одной транзакции.
+"""
+import os
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+BACKFILL_SQL = """
+INSERT INTO pair_history (user_low_id, user_high_id, meet_count, last_met_at)
+SELECT
+    CASE WHEN user1_id < user2_id THEN user1_id ELSE user2_id END,
+    CASE WHEN user1_id < user2_id THEN user2_id ELSE user1_id END,
+    COUNT(*),
+    MAX(created_at)
+FROM meetings
+WHERE user1_id IS NOT NULL AND user2_id IS NOT NULL AND user1_id <> user2_id
+GROUP BY 1, 2
+"""
+
+
+def backfill(database_url):
+    """Пересчитывает pair_history по всем встречам"""
+    engine = create_engine(database_url)
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM pair_history"))
+        connection.execute(text(BACKFILL_SQL))
+        return connection.execute(text("SELECT COUNT(*) FROM pair_history")).scalar()
+
+
+def main():
+    load_dotenv()
+    database_url = os.getenv('DATABASE_URL', 'sqlite:///random_coffee.db')
+    pairs = backfill(database_url)
+    print(f"pair_history заполнена: {pairs} пар")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Бенчмарк движка распределения пар по числу участников и плотности истории.
+
+Для каждого размера (по умолчанию от 10 до 100 000 участников) генерирует
+граф встреч и замеряет create_pairs или другой движок с той же сигнатурой:
+время, пиковую память (tracemalloc, отдельным прогоном — трассировка
+замедляет код), число повторных пар и групп из 3+ человек. По замерам
+оценивается показатель роста времени: t ~ n^k (наклон прямой в
+логарифмических координатах).
+
+Модели истории:
+* uniform — случайные встречи, в среднем --density прошлых собеседников;
+* clustered — худший случай живого сообщества: доля --veterans участников
+  разбита на когорты по --cohort-size (0 — одна когорта), внутри когорты
+  все уже встречались друг с другом, остальные — новички. Плотность в
+  отчете — фактическое среднее число прошлых собеседников. Размеры, для
+  которых история больше --max-edges пар, пропускаются.
+
+Запуск:
+    python benchmark_pairing.py
+    python benchmark_pairing.py --sizes 1000 10000 100000 --density 0 10 50 --csv pairing.csv
+    python benchmark_pairing.py --model clustered --sizes 500 1000 2000 4000
+    python benchmark_pairing.py --engine mymodule:create_pairs --project 250000
+"""
+import argparse
+import csv
+import importlib
+import math
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Sequence
+
+from pairing import History, count_repeats
+
+COLUMNS = ('model', 'participants', 'density', 'seconds', 'peak_mb', 'pairs', 'repeats', 'groups_3plus')
+
+
+def load_engine(spec: str) -> Callable:
+    """Движок по строке module:function"""
+    module_name, _, function_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), function_name or 'create_pairs')
+
+
+def generate_history(user_ids: Sequence[int], density: float, rng: random.Random) -> History:
+    """Случайная история: в среднем density прошлых собеседников на участника"""
+    history: History = {}
+    n = len(user_ids)
+    if n < 2 or density <= 0:
+        return history
+    for _ in range(int(n * min(density, n - 1) / 2)):
+        user1, user2 = rng.sample(user_ids, 2) if n < 64 else (
+            user_ids[rng.randrange(n)], user_ids[rng.randrange(n)])
+        if user1 == user2:
+            continue
+        # Стоимость как у pair_cost: встречи плюс штраф за давность
+        cost = rng.randint(1, 3) + 1 / (1 + rng.randrange(52))
+        history.setdefault(user1, {})[user2] = cost
+        history.setdefault(user2, {})[user1] = cost
+    return history
+
+
+def generate_clustered_history(user_ids: Sequence[int], veterans: float, cohort_size: int,
+                               rng: random.Random) -> History:
+    """Когорты старожилов, где все встречались со всеми, и новички без истории"""
+    history: History = {}
+    shuffled = list(user_ids)
+    rng.shuffle(shuffled)
+    veteran_ids = shuffled[:int(len(shuffled) * veterans)]
+    cohort_size = cohort_size or len(veteran_ids)
+    for start in range(0, len(veteran_ids), max(cohort_size, 1)):
+        cohort = veteran_ids[start:start + cohort_size]
+        for i, user1 in enumerate(cohort):
+            partners = history.setdefault(user1, {})
+            for user2 in cohort[i + 1:]:
+                cost = rng.randint(1, 3) + 1 / (1 + rng.randrange(52))
+                partners[user2] = cost
+                history.setdefault(user2, {})[user1] = cost
+    return history
+
+
+def clustered_edges(size: int, veterans: float, cohort_size: int) -> int:
+    """Число пар в истории clustered без ее построения"""
+    count = int(size * veterans)
+    cohort_size = cohort_size or count
+    full, rest = divmod(count, max(cohort_size, 1))
+    return full * cohort_size * (cohort_size - 1) // 2 + rest * (rest - 1) // 2
+
+
+def validate(pairs: List[tuple], user_ids: Sequence[int]):
+    members = [user for group in pairs for user in group]
+    if sorted(members) != sorted(user_ids):
+        raise AssertionError("Engine must place every participant into exactly one group")
+
+
+def measure(engine: Callable, size: int, density: float, repeat: int, seed: int,
+            model: str = 'uniform', veterans: float = 0.75, cohort_size: int = 0) -> Dict:
+    rng = random.Random(seed)
+    user_ids = list(range(1, size + 1))
+    if model == 'clustered':
+        history = generate_clustered_history(user_ids, veterans, cohort_size, rng)
+        density = sum(len(partners) for partners in history.values()) / size
+    else:
+        history = generate_history(user_ids, density, rng)
+
+    # Время: лучший из repeat прогонов без трассировки памяти
+    seconds = math.inf
+    for run in range(repeat):
+        started = time.perf_counter()
+        pairs = engine(user_ids, history, random.Random(seed + run))
+        seconds = min(seconds, time.perf_counter() - started)
+    validate(pairs, user_ids)
+
+    tracemalloc.start()
+    try:
+        engine(user_ids, history, random.Random(seed))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'model': model,
+        'participants': size,
+        'density': density,
+        'seconds': seconds,
+        'peak_mb': peak / 2 ** 20,
+        'pairs': len(pairs),
+        'repeats': count_repeats(pairs, history),
+        'groups_3plus': sum(1 for group in pairs if len(group) >= 3),
+    }
+
+
+def scaling_exponent(rows: List[Dict]):
+    """Наклон log(время) от log(n) методом наименьших квадратов и свободный член"""
+    points = [(math.log(row['participants']), math.log(row['seconds']))
+              for row in rows if row['participants'] >= 100 and row['seconds'] > 0]
+    if len(points) < 2:
+        return None, None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if not variance:
+        return None, None
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    return slope, mean_y - slope * mean_x
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 3000, 10000, 100000])
+    parser.add_argument('--density', type=float, nargs='+', default=[0, 5, 20],
+                        help='среднее число прошлых собеседников на участника')
+    parser.add_argument('--model', nargs='+', choices=('uniform', 'clustered'),
+                        default=['uniform', 'clustered'], help='модель истории встреч')
+    parser.add_argument('--veterans', type=float, default=0.75,
+                        help='clustered: доля участников, уже встречавшихся в когортах')
+    parser.add_argument('--cohort-size', type=int, default=0,
+                        help='clustered: размер когорты (0 — все старожилы в одной)')
+    parser.add_argument('--max-edges', type=int, default=3000000,
+                        help='clustered: пропускать размеры с историей больше стольких пар')
+    parser.add_argument('--engine', default='pairing:create_pairs', help='module:function')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--csv', help='файл для результатов в CSV')
+    parser.add_argument('--project', type=int,
+                        help='оценить время для такого числа участников по показателю роста')
+    args = parser.parse_args()
+
+    engine = load_engine(args.engine)
+    # Серии замеров: uniform — по каждой плотности, clustered — одна
+    series = [('uniform', density) for density in args.density if 'uniform' in args.model]
+    if 'clustered' in args.model:
+        series.append(('clustered', None))
+
+    rows = []
+    print(f"Движок: {args.engine}")
+    print(f"{'модель':>9} {'участников':>10} {'плотность':>9} {'время, с':>10} {'пик, МБ':>9} "
+          f"{'пар':>7} {'повторов':>9} {'групп 3+':>9}")
+    for model, density in series:
+        for size in args.sizes:
+            if model == 'clustered':
+                edges = clustered_edges(size, args.veterans, args.cohort_size)
+                if edges > args.max_edges:
+                    print(f"{model:>9} {size:>10} пропущен: история из {edges} пар больше --max-edges")
+                    continue
+            row = measure(engine, size, density, args.repeat, args.seed,
+                          model, args.veterans, args.cohort_size)
+            row['series'] = (model, density)
+            rows.append(row)
+            print(f"{model:>9} {row['participants']:>10} {row['density']:>9.4g} {row['seconds']:>10.4f} "
+                  f"{row['peak_mb']:>9.2f} {row['pairs']:>7} {row['repeats']:>9} "
+                  f"{row['groups_3plus']:>9}")
+            sys.stdout.flush()
+
+    print()
+    for model, density in series:
+        title = f"Плотность {density:g}" if model == 'uniform' else "Когорты старожилов (clustered)"
+        slope, intercept = scaling_exponent([row for row in rows if row['series'] == (model, density)])
+        if slope is None:
+            print(f"{title}: недостаточно замеров для оценки роста")
+            continue
+        line = f"{title}: время ~ n^{slope:.2f}"
+        if args.project:
+            line += f", для {args.project} участников ~ {math.exp(intercept) * args.project ** slope:.2f} с"
+        print(line)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Бенчмарк пропускной способности обработки обновлений по числу воркеров.
+
+Диспетчер из sharding.py раздает синтетические обновления воркерам, каждый
+воркер — Application с обработчиком, который тратит --work-ms процессорного
+времени на обновление (вместо реальных обработчиков с базой). Исходящие
+вызовы Bot API уходят в заглушку из fake_telegram.py.
+
+Запуск (на машине с несколькими ядрами):
+    python benchmark_sharding.py --workers 1 2 4 8 --updates 20000 --work-ms 1
+"""
+import argparse
+import asyncio
+import functools
+import multiprocessing
+import os
+import time
+from types import SimpleNamespace
+
+from telegram.ext import Application, MessageHandler, filters
+
+import fake_telegram
+from sharding import WorkerPool
+
+API_PORT = 18181
+
+
+def _serve_api(port):
+    asyncio.run(fake_telegram.serve_api(SimpleNamespace(host='127.0.0.1', port=port)))
+
+
+async def benchmark_application(work_ms, processed):
+    """Воркер бенчмарка: обработчик занимает процессор на work_ms"""
+    application = Application.builder().token('1000000001:benchmark')\
+        .base_url(f'http://127.0.0.1:{API_PORT}/bot').build()
+
+    async def handle(update, context):
+        deadline = time.perf_counter() + work_ms / 1000
+        while time.perf_counter() < deadline:
+            pass
+        with processed.get_lock():
+            processed.value += 1
+
+    application.add_handler(MessageHandler(filters.ALL, handle))
+    return application
+
+
+def wait_for(processed, target, timeout=600):
+    deadline = time.perf_counter() + timeout
+    while processed.value < target:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"processed {processed.value} of {target} updates")
+        time.sleep(0.005)
+
+
+def run(workers, updates, work_ms, users):
+    """Обновлений в секунду при заданном числе воркеров"""
+    context = multiprocessing.get_context('spawn')
+    processed = context.Value('l', 0)
+    pool = WorkerPool(functools.partial(benchmark_application, work_ms, processed), workers)
+    pool.start()
+    try:
+        # Прогрев: воркеры запущены и обработали по несколько обновлений
+        warmup = workers * 20
+        for update_id in range(warmup):
+            pool.dispatcher.dispatch(fake_telegram.make_update(update_id, users))
+        wait_for(processed, warmup)
+
+        started = time.perf_counter()
+        for update_id in range(warmup, warmup + updates):
+            pool.dispatcher.dispatch(fake_telegram.make_update(update_id, users))
+        wait_for(processed, warmup + updates)
+        elapsed = time.perf_counter() - started
+    finally:
+        pool.stop()
+    routed = pool.dispatcher.routed
+    return updates / elapsed, max(routed) / (sum(routed) / len(routed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--work-ms', type=float, default=1.0)
+    parser.add_argument('--users', type=int, default=10000)
+    args = parser.parse_args()
+
+    api = multiprocessing.get_context('spawn').Process(target=_serve_api, args=(API_PORT,), daemon=True)
+    api.start()
+    time.sleep(1)
+
+    print(f"Ядер: {os.cpu_count()}, обновлений: {args.updates}, работа: {args.work_ms} мс")
+    print(f"{'воркеров':>8} {'обновл./с':>12} {'ускорение':>10} {'перекос шардов':>15}")
+    baseline = None
+    try:
+        for workers in args.workers:
+            rate, skew = run(workers, args.updates, args.work_ms, args.users)
+            baseline = baseline or rate
+            print(f"{workers:>8} {rate:>12.1f} {rate / baseline:>10.2f} {skew:>15.2f}")
+    finally:
+        api.terminate()
+
+
+if __name__ == '__main__':
+    main()
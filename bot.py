@@ -1,15 +1,30 @@
 import os
 import logging
-import random
 import fcntl
 import sys
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Poll, Bot, ReplyKeyboardMarkup, KeyboardButton, ChatMemberUpdated, Chat
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler, ChatMemberHandler, PollAnswerHandler
-from sqlalchemy import create_engine, func
-from sqlalchemy.orm import sessionmaker
-from database import Base, User, UserPreferences, Meeting, Rating, WeeklyPoll, PollResponse, Chat, BotInstance
+from sqlalchemy import select, func, delete, insert, update as sql_update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from database import Base, User, UserPreferences, Meeting, WeeklyPoll, PollResponse, Chat, BotInstance, chunked, create_async_db_engine, poll_response_upsert
+from pairing import create_pairs, load_pair_history, record_pair_history
+from compatibility import load_profiles, match_by_preferences
+from interest_index import PROFILE_FIELDS, index_profile
+from fanout import FanOutDispatcher
+from polls import poll_router, close_replaced_polls, PollAnswerBuffer
+from profile_cache import profile_cache
+from aggregates import record_meetings, reconcile_user_aggregates, get_user_stats
+from db_pool import pool_metrics, warm_up
+from schema import check_schema
+from webhook import BOT_MODE, run_webhook
+from leader import LeaderElection
+import sharding
+from persistence import CONVERSATION_TTL, DatabasePersistence, conversation_reloader
+from state_store import purge_state_stores, state_store_stats
+from metrics import (InstrumentedRequest, instrument_handlers, instrument_scheduler,
+                     start_metrics_server, stop_metrics_server)
 import uuid
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import asyncio
@@ -22,27 +37,72 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not TELEGRAM_BOT_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN not found in environment variables")
 
+# Адрес Bot API (для нагрузочных тестов можно указать fake_telegram.py)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
 # Настройка базы данных
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///random_coffee.db')
 
-# Создаем движок базы данных
-engine = create_engine(DATABASE_URL)
+# Создавать таблицы при старте вместо проверки ревизии (только для разработки)
+DB_CREATE_TABLES = os.getenv('DB_CREATE_TABLES', 'false').lower() in ('1', 'true', 'yes')
+
+# Асинхронный движок (asyncpg для PostgreSQL, aiosqlite для SQLite) создается
+# при старте в init_engine(), импорт модуля к базе не подключается
+engine = None
 
-# Создаем все таблицы
-Base.metadata.create_all(engine)
+# Фабрика асинхронных сессий, привязывается к движку в init_engine()
+Session = async_sessionmaker(expire_on_commit=False)
 
-# Создаем фабрику сессий
-Session = sessionmaker(bind=engine)
+
+def init_engine():
+    """Создает движок базы данных, если он еще не создан"""
+    global engine
+    if engine is None:
+        engine = create_async_db_engine(DATABASE_URL)
+        Session.configure(bind=engine)
+    return engine
 
 
 def get_session():
-    """Создает и возвращает новую сессию базы данных"""
-    session = Session()
-    try:
-        yield session
-    finally:
-        session.close()
+    """Создает новую асинхронную сессию базы данных.
+
+    Используется как `async with get_session() as session:` — каждый обработчик
+    ждет только свои запросы и не блокирует цикл событий.
+    """
+    return Session()
+
+
+async def init_models():
+    """Создает недостающие таблицы (для разработки и тестов)"""
+    async with init_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+# Write-behind режим для ответов на опросы
+POLL_WRITE_BEHIND = os.getenv('POLL_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+poll_answer_buffer = PollAnswerBuffer(
+    get_session,
+    interval_ms=int(os.getenv('POLL_FLUSH_INTERVAL_MS', '500')),
+    max_entries=int(os.getenv('POLL_FLUSH_MAX_ENTRIES', '500')),
+    max_attempts=int(os.getenv('POLL_FLUSH_MAX_ATTEMPTS', '5'))
+)
+
+# Учитывать предпочтения участников (UserPreferences) при распределении пар.
+# Выключено по умолчанию: при несовместимых предпочтениях участник может
+# остаться без пары, чего pairing.create_pairs не допускает
+PAIRING_USE_PREFERENCES = os.getenv('PAIRING_USE_PREFERENCES', 'false').lower() in ('1', 'true', 'yes')
+
+# Идентификатор этой реплики бота
+INSTANCE_ID = str(uuid.uuid4())
+
+# Запись реплики без heartbeat дольше этого считается устаревшей
+INSTANCE_STALE_AFTER = timedelta(minutes=3)
 
+# Задачи планировщика выполняет только держатель аренды лидерства
+leader_election = LeaderElection(get_session, INSTANCE_ID)
+
+# Состояния разговоров и черновики профилей переживают перезапуск
+persistence = DatabasePersistence(get_session)
 
 # Настройка логирования
 logging.basicConfig(
@@ -74,21 +134,14 @@ logger = logging.getLogger(__name__)
     SETTINGS_VISIBILITY
 ) = range(16)
 
-# Словарь для хранения состояний пользователей
-user_states = {}
-
-# Словарь для хранения активных встреч
-active_meetings = {}
-
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /start"""
     chat = update.effective_chat
-    session = next(get_session())
+    session = get_session()
 
     try:
         # Проверяем, есть ли чат в базе данных
-        db_chat = session.query(Chat).filter_by(chat_id=chat.id).first()
+        db_chat = await session.scalar(select(Chat).filter_by(chat_id=chat.id))
         if not db_chat:
             # Создаем новую запись о чате
             db_chat = Chat(
@@ -98,7 +151,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 joined_at=datetime.utcnow()
             )
             session.add(db_chat)
-            session.commit()
+            await session.commit()
 
             keyboard = [
                 [
@@ -149,7 +202,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in start command: {e}")
         await update.message.reply_text("Произошла ошибка при регистрации чата.")
     finally:
-        session.close()
+        await session.close()
 
 
 async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -157,11 +210,10 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    session = next(get_session())
+    session = get_session()
     try:
         # Проверяем, не зарегистрирован ли уже пользователь
-        existing_user = session.query(User).filter(
-            User.telegram_id == query.from_user.id).first()
+        existing_user = await profile_cache.load(session, query.from_user.id)
 
         if existing_user:
             keyboard = [
@@ -194,7 +246,7 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("Произошла ошибка при начале регистрации.")
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
 
 
 async def enter_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -369,12 +421,12 @@ async def enter_hobbies(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
         # Сохраняем пользователя в базу данных
-        session = next(get_session())
-        try:
+        async with get_session() as session:
             session.add(user)
-            session.commit()
-        finally:
-            session.close()
+            await session.flush()
+            await index_profile(session, user)
+            await session.commit()
+        await profile_cache.invalidate(update.effective_user.id)
 
         # Формируем текст профиля
         profile_text = (
@@ -420,36 +472,67 @@ async def enter_hobbies(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ENTER_HOBBIES
 
 
+def format_profile(user) -> str:
+    """Текст профиля пользователя"""
+    if not user:
+        return "👤 Ваш профиль:\n\nПрофиль не найден. Пожалуйста, зарегистрируйтесь."
+    return (
+        "👤 Ваш профиль:\n\n"
+        f"👤 Имя: {user.nickname}\n"
+        f"🏙 Город: {user.city or 'Не указан'}\n"
+        f"🔗 Соц.сеть: {user.social_link or 'Не указана'}\n"
+        f"ℹ️ О себе: {user.about or 'Не указано'}\n"
+        f"💼 Работа: {user.job or 'Не указана'}\n"
+        f"📅 Дата рождения: {user.birth_date.strftime('%d.%m.%Y') if user.birth_date else 'Не указана'}\n"
+        f"🎯 Хобби: {user.hobbies or 'Не указаны'}\n"
+        f"👁 Видимость: {'Публичный' if user.is_visible else 'Приватный'}\n"
+        f"📆 Дата регистрации: {user.created_at.strftime('%d.%m.%Y')}"
+    )
+
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка команды /profile"""
+    session = get_session()
+    try:
+        user = await profile_cache.load(session, update.effective_user.id)
+        await update.message.reply_text(format_profile(user))
+    except Exception as e:
+        logger.error(f"Error in profile: {e}")
+        await update.message.reply_text("Произошла ошибка при получении профиля.")
+    finally:
+        await session.close()
+
+
+FAQ_TEXT = (
+    "❓ Частые вопросы\n\n"
+    "☕️ Как попасть во встречи? Зарегистрируйтесь и отвечайте \"Да\" "
+    "в еженедельном опросе по понедельникам.\n"
+    "👥 Когда приходят пары? Во вторник бот публикует пары в чате.\n"
+    "🔁 Будут ли повторы? Бот старается не сводить тех, кто уже встречался.\n"
+    "👁 Кто видит мой профиль? В настройках можно сделать профиль приватным."
+)
+
+
+async def faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка команды /faq"""
+    await update.message.reply_text(FAQ_TEXT)
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатий на кнопки"""
     query = update.callback_query
     await query.answer()
-    session = next(get_session())
+    session = get_session()
 
     try:
         if query.data == 'register':
             await register(update, context)
         elif query.data == 'profile':
             # Получаем профиль из базы данных
-            user = session.query(User).filter(
-                User.telegram_id == query.from_user.id).first()
-            if user:
-                profile_text = (
-                    "👤 Ваш профиль:\n\n"
-                    f"👤 Имя: {user.nickname}\n"
-                    f"🏙 Город: {user.city or 'Не указан'}\n"
-                    f"🔗 Соц.сеть: {user.social_link or 'Не указана'}\n"
-                    f"ℹ️ О себе: {user.about or 'Не указано'}\n"
-                    f"💼 Работа: {user.job or 'Не указана'}\n"
-                    f"📅 Дата рождения: {user.birth_date.strftime('%d.%m.%Y') if user.birth_date else 'Не указана'}\n"
-                    f"🎯 Хобби: {user.hobbies or 'Не указаны'}\n"
-                    f"👁 Видимость: {'Публичный' if user.is_visible else 'Приватный'}\n"
-                    f"📆 Дата регистрации: {user.created_at.strftime('%d.%m.%Y')}"
-                )
-            else:
-                profile_text = "👤 Ваш профиль:\n\nПрофиль не найден. Пожалуйста, зарегистрируйтесь."
-
-            await query.message.reply_text(profile_text)
+            user = await profile_cache.load(session, query.from_user.id)
+            await query.message.reply_text(format_profile(user))
+        elif query.data == 'faq':
+            await query.message.reply_text(FAQ_TEXT)
         elif query.data == 'settings':
             await settings(update, context)
         elif query.data.startswith('set_'):
@@ -463,190 +546,204 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"Error in button_handler: {e}")
         await query.message.reply_text("Произошла ошибка при обработке запроса.")
+    finally:
+        await session.close()
+
+
+async def deactivate_chats(session, chat_ids):
+    """Помечает чаты, в которые бот больше не может писать, неактивными"""
+    if not chat_ids:
+        return
+    await session.execute(
+        sql_update(Chat).filter(Chat.chat_id.in_(chat_ids)).values(is_active=False))
+    await session.commit()
+    logger.info(f"Deactivated {len(chat_ids)} chats without access")
 
 
 async def create_weekly_poll(context: ContextTypes.DEFAULT_TYPE):
     """Создает еженедельный опрос"""
-    session = next(get_session())
+    session = get_session()
     try:
         # Получаем все активные чаты
-        active_chats = session.query(Chat).filter_by(is_active=True).all()
+        active_chats = (await session.scalars(
+            select(Chat).filter_by(is_active=True))).all()
 
-        for chat in active_chats:
-            # Создаем новый опрос для этого чата
-            week_start = datetime.utcnow()
-            week_end = week_start + timedelta(days=7)
+        # Отправляем опросы во все чаты с учетом лимитов Telegram
+        result = await FanOutDispatcher().run(
+            (chat.chat_id, lambda chat=chat: context.bot.send_poll(
+                chat_id=chat.chat_id,
+                question="Привет! Будете участвовать во встречах Random Coffee на следующей неделе? ☕️",
+                options=["Да", "Нет"],
+                is_anonymous=False
+            ))
+            for chat in active_chats
+        )
 
-            poll = WeeklyPoll(
+        # Сохраняем опросы для чатов, куда они были доставлены
+        week_start = datetime.utcnow()
+        week_end = week_start + timedelta(days=7)
+        polls = [
+            WeeklyPoll(
                 chat_id=chat.id,
+                message_id=result.sent[chat.chat_id].message_id,
+                telegram_poll_id=result.sent[chat.chat_id].poll.id,
                 week_start=week_start,
                 week_end=week_end,
                 status='active',
-                created_at=datetime.utcnow()
+                created_at=week_start
             )
-            session.add(poll)
-            session.commit()
+            for chat in active_chats if chat.chat_id in result.sent
+        ]
+        # Новый опрос заменяет прошлый: прежний закрываем и убираем из маршрутизатора
+        await close_replaced_polls(session, [poll.chat_id for poll in polls])
+        session.add_all(polls)
+        await session.commit()
 
-            # Отправляем опрос в чат
-            message = await context.bot.send_poll(
-                chat_id=chat.chat_id,
-                question="Привет! Будете участвовать во встречах Random Coffee на следующей неделе? ☕️",
-                options=["Да", "Нет"],
-                is_anonymous=False
-            )
+        # Ответы на новые опросы маршрутизируются без запросов к базе
+        for poll in polls:
+            poll_router.register(poll.telegram_poll_id, poll.id)
 
-            # Сохраняем ID сообщения
-            poll.message_id = message.message_id
-            session.commit()
+        await deactivate_chats(session, result.forbidden)
     except Exception as e:
         logger.error(f"Error sending poll to chat: {e}")
+    finally:
+        await session.close()
 
 
-async def distribute_pairs(context: ContextTypes.DEFAULT_TYPE):
-    """Распределяет пары для встреч"""
-    session = next(get_session())
-    try:
-        # Получаем все активные чаты
-        active_chats = session.query(Chat).filter_by(is_active=True).all()
+# Сообщение участнику, которому не нашлось пары с учетом его предпочтений
+UNPAIRED_TEXT = (
+    "😔 На этой неделе не нашлось собеседника, который подходит под ваши предпочтения "
+    "(возраст, языки, опыт участников). Попробуйте расширить их в настройках — "
+    "и до встречи на следующей неделе!"
+)
+
+
+async def announce_pairs(session, context):
+    """Распределяет пары во всех активных чатах и рассылает объявления"""
+    # Все буферизованные ответы должны попасть в базу до чтения
+    await poll_answer_buffer.flush()
 
-        for chat in active_chats:
+    # Получаем все активные чаты
+    active_chats = (await session.scalars(
+        select(Chat).filter_by(is_active=True))).all()
+
+    announcements = []
+    for chat in active_chats:
+        try:
             # Получаем последний опрос для этого чата
-            latest_poll = session.query(WeeklyPoll)\
-                .filter_by(chat_id=chat.id)\
-                .order_by(WeeklyPoll.created_at.desc())\
-                .first()
+            latest_poll = await session.scalar(
+                select(WeeklyPoll)
+                .filter_by(chat_id=chat.id)
+                .order_by(WeeklyPoll.created_at.desc())
+                .limit(1))
 
             if not latest_poll:
                 continue
 
-            # Получаем положительные ответы
-            positive_responses = session.query(PollResponse)\
-                .filter_by(poll_id=latest_poll.id, response=True)\
-                .all()
-
-            # Получаем ID пользователей, готовых к встрече
-            user_ids = [response.user_id for response in positive_responses]
+            # Получаем пользователей, которые ответили "Да"
+            user_ids = list((await session.scalars(
+                select(PollResponse.user_id)
+                .filter_by(poll_id=latest_poll.id, response=True))).all())
 
             if len(user_ids) < 2:
-                await context.bot.send_message(
-                    chat_id=chat.chat_id,
-                    text="Недостаточно участников для создания пар на этой неделе."
-                )
+                announcements.append(
+                    (chat.chat_id, "Недостаточно участников для создания пар на этой неделе.", None))
                 continue
 
-            # Получаем историю встреч
-            past_meetings = session.query(Meeting)\
-                .filter(Meeting.user1_id.in_(user_ids))\
-                .filter(Meeting.user2_id.in_(user_ids))\
-                .all()
-
-            # Создаем словарь прошлых встреч
-            meeting_history = {}
-            for meeting in past_meetings:
-                for user_id in [meeting.user1_id, meeting.user2_id]:
-                    if user_id not in meeting_history:
-                        meeting_history[user_id] = set()
-                    meeting_history[user_id].add(
-                        meeting.user2_id if user_id == meeting.user1_id else meeting.user1_id)
-
-            # Создаем пары
-            pairs = create_pairs(user_ids, meeting_history)
-
-            # Сохраняем пары и формируем сообщение
-            message = await save_pairs_and_create_message(session, pairs, chat.chat_id)
-            await context.bot.send_message(chat_id=chat.chat_id, text=message, parse_mode='Markdown')
+            # Получаем историю встреч только между участниками этой недели
+            history = await load_pair_history(session, user_ids)
 
-    except Exception as e:
-        logger.error(f"Error creating pairs for chat: {e}")
-    finally:
-        session.close()
-
-
-def create_pairs(user_ids, meeting_history):
-    """Создает пары пользователей с учетом истории встреч"""
-    random.shuffle(user_ids)
-    pairs = []
-    unpaired = []
-    used = set()
-
-    for user1 in user_ids:
-        if user1 in used:
-            continue
+            # Создаем пары с учетом истории встреч и предпочтений
+            unpaired = []
+            if PAIRING_USE_PREFERENCES:
+                profiles = await load_profiles(session, user_ids)
+                pairs, unpaired = match_by_preferences(user_ids, history, profiles)
+            else:
+                pairs = create_pairs(user_ids, history)
 
-        # Ищем подходящего партнера
-        best_partner = None
-        min_meetings = float('inf')
+            # Сохраняем пары в базу данных и формируем сообщение
+            message = await save_pairs_and_create_message(session, pairs, chat.chat_id)
+            announcements.append((chat.chat_id, message, 'Markdown'))
 
-        for user2 in user_ids:
-            if user2 == user1 or user2 in used:
-                continue
+            # Тем, кому не нашлось пары по их предпочтениям, пишем лично
+            if unpaired:
+                telegram_ids = (await session.scalars(
+                    select(User.telegram_id).filter(User.id.in_(unpaired)))).all()
+                announcements.extend((telegram_id, UNPAIRED_TEXT, None) for telegram_id in telegram_ids)
+        except Exception as e:
+            # Ошибка в одном чате не должна останавливать остальные
+            logger.error(f"Error creating pairs for chat {chat.chat_id}: {e}")
+            await session.rollback()
+
+    # Рассылаем объявления с учетом лимитов Telegram
+    result = await FanOutDispatcher().run(
+        (chat_id, lambda chat_id=chat_id, text=text, parse_mode=parse_mode: context.bot.send_message(
+            chat_id=chat_id, text=text, parse_mode=parse_mode))
+        for chat_id, text, parse_mode in announcements
+    )
+    await deactivate_chats(session, result.forbidden)
 
-            meetings_count = len(meeting_history.get(
-                user1, set()).intersection({user2}))
-            if meetings_count < min_meetings:
-                min_meetings = meetings_count
-                best_partner = user2
-            if meetings_count == 0:
-                break
-
-        if best_partner:
-            pairs.append((user1, best_partner))
-            used.add(user1)
-            used.add(best_partner)
-        else:
-            unpaired.append(user1)
-
-    # Обрабатываем непарных пользователей
-    if unpaired:
-        if pairs:
-            last_pair = list(pairs[-1])
-            last_pair.extend(unpaired)
-            pairs[-1] = tuple(last_pair)
-        else:
-            pairs.append(tuple(unpaired))
 
-    return pairs
+async def distribute_pairs(context: ContextTypes.DEFAULT_TYPE):
+    """Распределяет пары для встреч"""
+    session = get_session()
+    try:
+        await announce_pairs(session, context)
+    except Exception as e:
+        logger.error(f"Error creating pairs for chat: {e}")
+    finally:
+        await session.close()
 
 
 async def save_pairs_and_create_message(session, pairs, chat_id):
     """Сохраняет пары в базу данных и создает сообщение"""
     message = "🎉 Пары для встреч на следующую неделю:\n\n"
-
+    met_at = datetime.utcnow()
+
+    # Загружаем участников пачками по SQL_CHUNK
+    user_ids = {user_id for pair in pairs for user_id in pair}
+    users = {}
+    for chunk in chunked(sorted(user_ids)):
+        users.update((row.id, row) for row in (await session.execute(
+            select(User.id, User.username, User.telegram_id)
+            .filter(User.id.in_(chunk)))).all())
+
+    meetings = []
+    pair_history = {}
     for pair in pairs:
-        # Получаем информацию о пользователях
-        users = []
+        # Формируем упоминания из уже загруженных строк
+        mentions = []
         for user_id in pair:
-            user = session.query(User).filter_by(id=user_id).first()
+            user = users.get(user_id)
             if user:
-                users.append(
+                mentions.append(
                     f"@{user.username}" if user.username else f"[Пользователь](tg://user?id={user.telegram_id})")
 
         # Добавляем пару в сообщение
-        message += "👥 " + " и ".join(users) + "\n"
-
-        # Сохраняем встречи в базу данных
-        if len(pair) == 2:
-            user1, user2 = pair
-            session.add(Meeting(
-                user1_id=user1,
-                user2_id=user2,
-                scheduled_time=datetime.utcnow(),
-                status='scheduled',
-                created_at=datetime.utcnow()
-            ))
-        elif len(pair) >= 3:
-            for i in range(len(pair)):
-                for j in range(i + 1, len(pair)):
-                    session.add(Meeting(
-                        user1_id=pair[i],
-                        user2_id=pair[j],
-                        scheduled_time=datetime.utcnow(),
-                        status='scheduled',
-                        created_at=datetime.utcnow()
-                    ))
+        message += "👥 " + " и ".join(mentions) + "\n"
+
+        # Встречи между всеми участниками пары или группы
+        for i in range(len(pair)):
+            for j in range(i + 1, len(pair)):
+                meetings.append({
+                    'user1_id': pair[i],
+                    'user2_id': pair[j],
+                    'scheduled_time': met_at,
+                    'status': 'scheduled',
+                    'created_at': met_at
+                })
+                key = (min(pair[i], pair[j]), max(pair[i], pair[j]))
+                pair_history[key] = pair_history.get(key, 0) + 1
 
     message += "\nПожалуйста, договоритесь о времени и формате встречи в личных сообщениях 😊"
-    session.commit()
+
+    # Встречи, история пар и счетчики пишутся пакетно в одной транзакции
+    if meetings:
+        await session.execute(insert(Meeting), meetings)
+        await record_meetings(session, meetings)
+    if pair_history:
+        await record_pair_history(session, pair_history, met_at)
+    await session.commit()
     return message
 
 
@@ -655,11 +752,10 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    session = next(get_session())
+    session = get_session()
     try:
         # Проверяем, зарегистрирован ли пользователь
-        user = session.query(User).filter(
-            User.telegram_id == query.from_user.id).first()
+        user = await profile_cache.load(session, query.from_user.id)
         if not user:
             await query.message.reply_text("⚠️ Сначала нужно зарегистрироваться!")
             return ConversationHandler.END
@@ -709,7 +805,7 @@ async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("Произошла ошибка при открытии настроек.")
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
 
 
 async def update_visibility(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -717,23 +813,24 @@ async def update_visibility(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    session = next(get_session())
+    session = get_session()
     try:
-        user = session.query(User).filter(
-            User.telegram_id == query.from_user.id).first()
+        user = await session.scalar(select(User).filter(
+            User.telegram_id == query.from_user.id))
         if not user:
             await query.message.reply_text("Произошла ошибка при получении данных пользователя.")
             return ConversationHandler.END
 
         visibility = query.data.split('_')[1]  # 'public' или 'private'
-        user.is_visible = (visibility == 'public')
-        session.commit()
+        user.show_profile = (visibility == 'public')
+        await session.commit()
+        await profile_cache.invalidate(query.from_user.id)
 
         keyboard = [[InlineKeyboardButton(
             "◀️ Назад", callback_data='settings')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        visibility_text = "Публичный" if user.is_visible else "Приватный"
+        visibility_text = "Публичный" if user.show_profile else "Приватный"
         await query.message.reply_text(
             f"✅ Видимость профиля изменена на: {visibility_text}",
             reply_markup=reply_markup
@@ -744,24 +841,58 @@ async def update_visibility(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("Произошла ошибка при обновлении видимости профиля.")
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
+
+
+REGISTRATION_OFFER_TEXT = ("Отлично! Для участия в Random Coffee нужно зарегистрироваться. "
+                           "Нажмите кнопку ниже, чтобы начать регистрацию:")
+
+
+def registration_offer_keyboard():
+    return InlineKeyboardMarkup([[InlineKeyboardButton(
+        "👤 Регистрация", callback_data='register')]])
+
+
+async def offer_registration(context, telegram_user_id):
+    """Предлагает зарегистрироваться пользователю, ответившему "Да" """
+    logger.info(
+        f"User {telegram_user_id} answered Yes but is not registered. Sending registration offer.")
+    try:
+        await context.bot.send_message(
+            chat_id=telegram_user_id,
+            text=REGISTRATION_OFFER_TEXT,
+            reply_markup=registration_offer_keyboard()
+        )
+        logger.info(
+            f"Successfully sent registration offer to user {telegram_user_id}")
+    except Exception as e:
+        logger.error(
+            f"Failed to send registration offer to user {telegram_user_id}: {e}")
+
+
+async def offer_registrations(bot, telegram_user_ids):
+    """То же для незарегистрированных, найденных при записи буфера ответов"""
+    result = await FanOutDispatcher().run(
+        (telegram_user_id, lambda telegram_user_id=telegram_user_id: bot.send_message(
+            chat_id=telegram_user_id, text=REGISTRATION_OFFER_TEXT,
+            reply_markup=registration_offer_keyboard()))
+        for telegram_user_id in telegram_user_ids
+    )
+    logger.info(f"Sent {len(result.sent)} registration offers to poll participants")
 
 
 async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка ответов на опросы"""
     answer = update.poll_answer
-    session = next(get_session())
+    session = get_session()
     try:
         logger.info(
             f"Received poll answer from user {answer.user.id} for poll {answer.poll_id}")
 
-        # Получаем пользователя и опрос
-        user = session.query(User).filter(
-            User.telegram_id == answer.user.id).first()
-        poll = session.query(WeeklyPoll).filter(
-            WeeklyPoll.message_id == answer.poll_id).first()
+        # Опрос ищем по poll.id от Telegram, обычно без обращения к базе
+        poll_id = await poll_router.resolve(session, answer.poll_id)
 
-        if not poll:
+        if poll_id is None:
             logger.warning(f"Poll not found: poll_id={answer.poll_id}")
             return
 
@@ -777,6 +908,16 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.info(
             f"User {answer.user.id} answered {'Yes' if response else 'No'}")
 
+        if POLL_WRITE_BEHIND:
+            # Ответ попадет в базу со следующим пакетным сбросом
+            # Регистрацию незарегистрированным предложит offer_registrations после записи
+            poll_answer_buffer.add(
+                poll_id, answer.user.id, answer.user.username, response)
+            return
+
+        user = (await session.execute(select(User.id, User.nickname).filter(
+            User.telegram_id == answer.user.id))).first()
+
         # Если пользователь не найден, создаем запись о его ответе
         if not user:
             logger.info(
@@ -787,57 +928,26 @@ async def handle_poll_answer(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 created_at=datetime.utcnow()
             )
             session.add(user)
-            session.commit()
-            logger.info(
-                f"Created new user record for user_id={answer.user.id}")
-
-        # Обновляем или создаем ответ
-        existing_response = session.query(PollResponse).filter(
-            PollResponse.poll_id == poll.id,
-            PollResponse.user_id == user.id
-        ).first()
-
-        if existing_response:
-            existing_response.response = response
-            existing_response.created_at = datetime.utcnow()
-            logger.info(
-                f"Updated existing response for user {user.id} and poll {poll.id}")
-        else:
-            new_response = PollResponse(
-                poll_id=poll.id,
-                user_id=user.id,
-                response=response,
-                created_at=datetime.utcnow()
-            )
-            session.add(new_response)
-            logger.info(
-                f"Created new response for user {user.id} and poll {poll.id}")
-
-        session.commit()
+            await session.flush()
+
+        # Создаем или обновляем ответ одним запросом
+        await session.execute(poll_response_upsert(session.bind.dialect.name, {
+            'poll_id': poll_id,
+            'user_id': user.id,
+            'response': response,
+            'created_at': datetime.utcnow()
+        }))
+        await session.commit()
+        logger.info(f"Saved response for user {user.id} and poll {poll_id}")
 
         # Если пользователь ответил "Да" и не зарегистрирован, предлагаем регистрацию
         if response and not user.nickname:
-            logger.info(
-                f"User {user.id} answered Yes but is not registered. Sending registration offer.")
-            keyboard = [[InlineKeyboardButton(
-                "👤 Регистрация", callback_data='register')]]
-            try:
-                await context.bot.send_message(
-                    chat_id=answer.user.id,
-                    text="Отлично! Для участия в Random Coffee нужно зарегистрироваться. "
-                         "Нажмите кнопку ниже, чтобы начать регистрацию:",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                logger.info(
-                    f"Successfully sent registration offer to user {answer.user.id}")
-            except Exception as e:
-                logger.error(
-                    f"Failed to send registration offer to user {answer.user.id}: {e}")
+            await offer_registration(context, answer.user.id)
 
     except Exception as e:
         logger.error(f"Error in handle_poll_answer: {e}", exc_info=True)
     finally:
-        session.close()
+        await session.close()
 
 
 def get_next_monday(hour=10, minute=0):
@@ -852,157 +962,13 @@ def get_next_monday(hour=10, minute=0):
 
 async def send_weekly_poll(context: ContextTypes.DEFAULT_TYPE):
     """Отправляет еженедельный опрос"""
-    session = next(get_session())
+    session = get_session()
     try:
-        # Получаем все активные чаты
-        active_chats = session.query(Chat).filter_by(is_active=True).all()
-
-        for chat in active_chats:
-            # Получаем последний опрос для этого чата
-            latest_poll = session.query(WeeklyPoll)\
-                .filter_by(chat_id=chat.id)\
-                .order_by(WeeklyPoll.created_at.desc())\
-                .first()
-
-            if not latest_poll:
-                continue
-
-            # Получаем пользователей, которые ответили "Да"
-            positive_responses = session.query(PollResponse)\
-                .filter_by(poll_id=latest_poll.id, response=True)\
-                .all()
-
-            # Получаем ID пользователей, готовых к встрече
-            user_ids = [response.user_id for response in positive_responses]
-
-            if len(user_ids) < 2:
-                await context.bot.send_message(
-                    chat_id=chat.chat_id,
-                    text="Недостаточно участников для создания пар на этой неделе."
-                )
-                continue
-
-            # Получаем историю встреч
-            past_meetings = session.query(Meeting)\
-                .filter(Meeting.user1_id.in_(user_ids))\
-                .filter(Meeting.user2_id.in_(user_ids))\
-                .all()
-
-            # Создаем словарь прошлых встреч
-            meeting_history = {}
-            for meeting in past_meetings:
-                if meeting.user1_id not in meeting_history:
-                    meeting_history[meeting.user1_id] = set()
-                if meeting.user2_id not in meeting_history:
-                    meeting_history[meeting.user2_id] = set()
-                meeting_history[meeting.user1_id].add(meeting.user2_id)
-                meeting_history[meeting.user2_id].add(meeting.user1_id)
-
-            # Перемешиваем список пользователей
-            random.shuffle(user_ids)
-
-            # Создаем пары с учетом истории встреч
-            pairs = []
-            unpaired = []
-            used = set()
-
-            for user1 in user_ids:
-                if user1 in used:
-                    continue
-
-                # Ищем подходящего партнера
-                best_partner = None
-                min_meetings = float('inf')
-
-                for user2 in user_ids:
-                    if user2 == user1 or user2 in used:
-                        continue
-
-                    # Проверяем историю встреч
-                    meetings_count = len(meeting_history.get(
-                        user1, set()).intersection({user2}))
-
-                    if meetings_count < min_meetings:
-                        min_meetings = meetings_count
-                        best_partner = user2
-
-                    # Если нашли пользователя, с которым встреч не было, сразу берем его
-                    if meetings_count == 0:
-                        break
-
-                if best_partner:
-                    pairs.append((user1, best_partner))
-                    used.add(user1)
-                    used.add(best_partner)
-                else:
-                    unpaired.append(user1)
-
-            # Если остались непарные пользователи, добавляем их к последней паре или создаем новую
-            if unpaired:
-                if pairs:
-                    # Если есть хотя бы одна пара, добавляем непарных к последней паре
-                    last_pair = list(pairs[-1])
-                    last_pair.extend(unpaired)
-                    pairs[-1] = tuple(last_pair)
-                else:
-                    # Если пар нет совсем, создаем одну из оставшихся
-                    pairs.append(tuple(unpaired))
-
-            # Сохраняем пары в базу данных и отправляем сообщение
-            message = "🎉 Пары для встреч на следующую неделю:\n\n"
-
-            for pair in pairs:
-                # Получаем информацию о пользователях
-                users = []
-                for user_id in pair:
-                    user = session.query(User).filter_by(id=user_id).first()
-                    if user:
-                        if user.username:
-                            users.append(f"@{user.username}")
-                        else:
-                            users.append(
-                                f"[Пользователь](tg://user?id={user.telegram_id})")
-
-                # Добавляем пару в сообщение
-                message += "👥 " + " и ".join(users) + "\n"
-
-                # Сохраняем встречу в базу данных
-                if len(pair) == 2:
-                    user1, user2 = pair
-                    meeting = Meeting(
-                        user1_id=user1,
-                        user2_id=user2,
-                        scheduled_time=datetime.utcnow(),
-                        status='scheduled',
-                        created_at=datetime.utcnow()
-                    )
-                    session.add(meeting)
-                elif len(pair) >= 3:
-                    # Создаем встречи между всеми участниками группы
-                    for i in range(len(pair)):
-                        for j in range(i + 1, len(pair)):
-                            meeting = Meeting(
-                                user1_id=pair[i],
-                                user2_id=pair[j],
-                                scheduled_time=datetime.utcnow(),
-                                status='scheduled',
-                                created_at=datetime.utcnow()
-                            )
-                            session.add(meeting)
-
-            message += "\nПожалуйста, договоритесь о времени и формате встречи в личных сообщениях 😊"
-
-            # Сохраняем изменения в базе данных
-            session.commit()
-
-            # Отправляем сообщение в конкретный чат
-            await context.bot.send_message(
-                chat_id=chat.chat_id,
-                text=message,
-                parse_mode='Markdown'
-            )
+        await announce_pairs(session, context)
     except Exception as e:
         logger.error(f"Error sending poll to chat: {e}")
+    finally:
+        await session.close()
 
 
 async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1011,12 +977,12 @@ async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_T
         for member in update.message.new_chat_members:
             if member.id == context.bot.id:
                 # Bot was added to a new chat
-                session = next(get_session())
+                session = get_session()
                 try:
                     chat = update.effective_chat
                     # Check if chat already exists
-                    db_chat = session.query(Chat).filter_by(
-                        chat_id=chat.id).first()
+                    db_chat = await session.scalar(select(Chat).filter_by(
+                        chat_id=chat.id))
                     if not db_chat:
                         # Register new chat
                         db_chat = Chat(
@@ -1026,7 +992,7 @@ async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_T
                             joined_at=datetime.utcnow()
                         )
                         session.add(db_chat)
-                        session.commit()
+                        await session.commit()
 
                         await update.message.reply_text(
                             "Спасибо, что добавили меня! Я бот для организации случайных кофе-встреч. "
@@ -1036,110 +1002,100 @@ async def handle_new_chat_member(update: Update, context: ContextTypes.DEFAULT_T
                 except Exception as e:
                     logger.error(f"Error handling new chat member: {e}")
                 finally:
-                    session.close()
+                    await session.close()
 
 
 async def handle_left_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка удаления бота из чата"""
     if update.message.left_chat_member and update.message.left_chat_member.id == context.bot.id:
         # Bot was removed from the chat
-        session = next(get_session())
+        session = get_session()
         try:
             chat = update.effective_chat
             # Mark chat as inactive
-            db_chat = session.query(Chat).filter_by(chat_id=chat.id).first()
+            db_chat = await session.scalar(select(Chat).filter_by(chat_id=chat.id))
             if db_chat:
                 db_chat.is_active = False
-                session.commit()
+                await session.commit()
         except Exception as e:
             logger.error(f"Error handling left chat member: {e}")
         finally:
-            session.close()
+            await session.close()
 
 
-def is_bot_running():
-    """Проверяет, не запущен ли уже экземпляр бота"""
-    session = next(get_session())
+async def register_bot_instance():
+    """Регистрирует текущий экземпляр бота и удаляет записи упавших реплик"""
+    session = get_session()
     try:
-        # Проверяем, есть ли активные экземпляры бота
-        running_instances = session.query(BotInstance).count()
-
-        if running_instances > 0:
-            # Проверяем, не устарели ли записи (старше 1 минуты)
-            cutoff_time = datetime.utcnow() - timedelta(minutes=1)
-            stale_instances = session.query(BotInstance).filter(
-                BotInstance.last_heartbeat < cutoff_time
-            ).all()
-
-            # Удаляем устаревшие записи
-            for instance in stale_instances:
-                session.delete(instance)
-            session.commit()
-
-            # Проверяем оставшиеся записи
-            running_instances = session.query(BotInstance).count()
-            if running_instances > 0:
-                logger.warning(
-                    f"Found {running_instances} running bot instances")
-                return True
-        return False
+        cutoff_time = datetime.utcnow() - INSTANCE_STALE_AFTER
+        await session.execute(delete(BotInstance).filter(
+            BotInstance.last_heartbeat < cutoff_time
+        ))
+        session.add(BotInstance(
+            instance_id=INSTANCE_ID,
+            last_heartbeat=datetime.utcnow()
+        ))
+        await session.commit()
+        running_instances = await session.scalar(
+            select(func.count()).select_from(BotInstance))
+        logger.info(
+            f"Registered bot instance {INSTANCE_ID}, {running_instances} running")
+        return INSTANCE_ID
     except Exception as e:
-        logger.error(f"Error checking bot instances: {e}")
-        return True  # В случае ошибки предполагаем худшее
+        logger.error(f"Error registering bot instance: {e}")
+        return None
     finally:
-        session.close()
+        await session.close()
 
 
-def register_bot_instance():
-    """Регистрирует новый экземпляр бота"""
-    session = next(get_session())
+async def unregister_bot_instance():
+    """Удаляет запись о текущем экземпляре бота"""
+    session = get_session()
     try:
-        # Удаляем все устаревшие записи
-        cutoff_time = datetime.utcnow() - timedelta(minutes=1)
-        stale_instances = session.query(BotInstance).filter(
-            BotInstance.last_heartbeat < cutoff_time
-        ).all()
-        for instance in stale_instances:
-            session.delete(instance)
-        session.commit()
-
-        # Проверяем, есть ли активные экземпляры
-        if session.query(BotInstance).count() > 0:
-            logger.warning("Another bot instance is already running")
-            return False
-
-        # Создаем запись о новом экземпляре
-        instance = BotInstance(
-            instance_id=str(uuid.uuid4()),
-            last_heartbeat=datetime.utcnow()
-        )
-        session.add(instance)
-        session.commit()
-        logger.info(f"Registered new bot instance: {instance.instance_id}")
-        return True
+        await session.execute(delete(BotInstance).filter(
+            BotInstance.instance_id == INSTANCE_ID))
+        await session.commit()
+        logger.info("Bot instance record removed")
     except Exception as e:
-        logger.error(f"Error registering bot instance: {e}")
-        return False
+        logger.error(f"Error removing bot instance: {e}")
     finally:
-        session.close()
+        await session.close()
 
 
-async def update_heartbeat(context: ContextTypes.DEFAULT_TYPE):
+async def update_heartbeat(context: ContextTypes.DEFAULT_TYPE = None):
     """Обновляет время последнего heartbeat для текущего экземпляра"""
-    session = next(get_session())
+    session = get_session()
     try:
-        latest_instance = session.query(BotInstance).order_by(
-            BotInstance.last_heartbeat.desc()
-        ).first()
-        if latest_instance:
-            latest_instance.last_heartbeat = datetime.utcnow()
-            session.commit()
-            logger.debug(
-                f"Heartbeat updated for instance {latest_instance.instance_id}")
+        result = await session.execute(
+            sql_update(BotInstance)
+            .where(BotInstance.instance_id == INSTANCE_ID)
+            .values(last_heartbeat=datetime.utcnow()))
+        if result.rowcount == 0:
+            # Запись удалили как устаревшую (например, после долгой паузы)
+            session.add(BotInstance(
+                instance_id=INSTANCE_ID, last_heartbeat=datetime.utcnow()))
+        await session.commit()
+        logger.debug(f"Heartbeat updated for instance {INSTANCE_ID}")
     except Exception as e:
         logger.error(f"Error updating heartbeat: {e}")
     finally:
-        session.close()
+        await session.close()
+
+
+async def reconcile_aggregates(context: ContextTypes.DEFAULT_TYPE = None):
+    """Пересчитывает счетчики пользователей, исправляя расхождения"""
+    session = get_session()
+    try:
+        await reconcile_user_aggregates(session)
+    except Exception as e:
+        logger.error(f"Error reconciling user aggregates: {e}")
+    finally:
+        await session.close()
+
+
+async def log_pool_metrics(context: ContextTypes.DEFAULT_TYPE = None):
+    """Пишет в лог состояние пула соединений"""
+    logger.info(f"Database pool: {pool_metrics.snapshot()}")
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1156,10 +1112,10 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 async def update_profile_field(update: Update, context: ContextTypes.DEFAULT_TYPE, field_name: str, field_display_name: str):
     """Универсальная функция для обновления полей профиля"""
-    session = next(get_session())
+    session = get_session()
     try:
-        user = session.query(User).filter(
-            User.telegram_id == update.effective_user.id).first()
+        user = await session.scalar(select(User).filter(
+            User.telegram_id == update.effective_user.id))
         if not user:
             await update.message.reply_text("Произошла ошибка при получении данных пользователя.")
             return ConversationHandler.END
@@ -1181,7 +1137,11 @@ async def update_profile_field(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # Обновляем значение поля
         setattr(user, field_name, value)
-        session.commit()
+        # Вектор интересов пересчитывается только при изменении текста профиля
+        if field_name in PROFILE_FIELDS:
+            await index_profile(session, user)
+        await session.commit()
+        await profile_cache.invalidate(update.effective_user.id)
 
         keyboard = [[InlineKeyboardButton(
             "◀️ Назад", callback_data='settings')]]
@@ -1193,7 +1153,7 @@ async def update_profile_field(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(f"Произошла ошибка при обновлении {field_display_name}.")
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1225,199 +1185,298 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(help_text)
 
 
+async def update_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await update_profile_field(update, context, 'city', "Город")
+
+
+async def update_social_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await update_profile_field(update, context, 'social_link', "Соц.сеть")
+
+
+async def update_about(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await update_profile_field(update, context, 'about', "О себе")
+
+
+async def update_job(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await update_profile_field(update, context, 'job', "Место работы")
+
+
+async def update_birth_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await update_profile_field(update, context, 'birth_date', "Дата рождения")
+
+
+async def update_avatar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await update_profile_field(update, context, 'avatar', "Аватар")
+
+
+async def update_hobbies(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await update_profile_field(update, context, 'hobbies', "Хобби")
+
+
+# Подписи уровней опыта и достижений для /stats
+EXPERIENCE_LEVEL_TITLES = {
+    'newbie': "🌱 Новичок",
+    'regular': "🌿 Регуляр",
+    'expert': "🌳 Эксперт",
+}
+ACHIEVEMENT_TITLES = {
+    'first_meeting': "🎯 Первая встреча",
+    'meetings_5': "🔥 5 встреч",
+    'meetings_10': "💫 10 встреч",
+    'meetings_20': "🌟 20 встреч",
+    'top_rated': "⭐️ Отличный собеседник",
+}
+
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка команды /stats"""
-    session = next(get_session())
+    session = get_session()
     try:
-        # Получаем пользователя
-        user = session.query(User).filter(
-            User.telegram_id == update.effective_user.id).first()
-        if not user:
+        # Статистика, уровень и достижения приходят одним запросом
+        user_stats = await get_user_stats(session, update.effective_user.id)
+        if not user_stats:
             await update.message.reply_text("⚠️ Сначала нужно зарегистрироваться!")
             return
 
-        # Получаем все встречи пользователя
-        total_meetings = len(user.meetings_as_user1) + \
-            len(user.meetings_as_user2)
-        completed_meetings = session.query(Meeting).filter(
-            ((Meeting.user1_id == user.id) | (Meeting.user2_id == user.id)) &
-            (Meeting.status == 'completed')
-        ).count()
-
-        # Получаем средний рейтинг
-        ratings = session.query(Rating).filter(
-            Rating.to_user_id == user.id).all()
-        avg_rating = sum([r.rating for r in ratings]) / \
-            len(ratings) if ratings else 0
-
-        # Определяем уровень опыта
-        experience_level = "🌱 Новичок"
-        if total_meetings >= 10:
-            experience_level = "🌿 Регуляр"
-        if total_meetings >= 20:
-            experience_level = "🌳 Эксперт"
-
         stats_text = (
             "📊 Ваша статистика:\n\n"
-            f"👥 Всего встреч: {total_meetings}\n"
-            f"✅ Завершённых встреч: {completed_meetings}\n"
-            f"⭐️ Средняя оценка: {avg_rating:.1f}\n"
-            f"📈 Уровень опыта: {experience_level}\n"
-            f"📅 В клубе с: {user.created_at.strftime('%d.%m.%Y')}\n\n"
+            f"👥 Всего встреч: {user_stats['total_meetings']}\n"
+            f"✅ Завершённых встреч: {user_stats['completed_meetings']}\n"
+            f"⭐️ Средняя оценка: {user_stats['avg_rating']:.1f}\n"
+            f"📈 Уровень опыта: {EXPERIENCE_LEVEL_TITLES[user_stats['experience_level']]}\n"
+            f"📅 В клубе с: {user_stats['registration_date'].strftime('%d.%m.%Y')}\n\n"
             "🏆 Достижения:\n"
         )
 
         # Добавляем достижения
-        if total_meetings >= 1:
-            stats_text += "🎯 Первая встреча\n"
-        if total_meetings >= 5:
-            stats_text += "🔥 5 встреч\n"
-        if total_meetings >= 10:
-            stats_text += "💫 10 встреч\n"
-        if total_meetings >= 20:
-            stats_text += "🌟 20 встреч\n"
-        if avg_rating >= 4.5:
-            stats_text += "⭐️ Отличный собеседник\n"
+        for achievement in user_stats['achievements']:
+            stats_text += ACHIEVEMENT_TITLES[achievement] + "\n"
 
         await update.message.reply_text(stats_text)
     except Exception as e:
         logger.error(f"Error in stats: {e}")
         await update.message.reply_text("Произошла ошибка при получении статистики.")
     finally:
-        session.close()
-
-
-async def main():
-    """Основная функция запуска бота"""
-    session = None
-    try:
-        # Проверяем, не запущен ли уже бот
-        if is_bot_running():
-            logger.error("Another instance of the bot is already running")
-            return
+        await session.close()
+
+
+async def on_shutdown(application: Application):
+    """Записывает буферизованные ответы и закрывает соединения перед остановкой"""
+    await leader_election.stop()
+    await unregister_bot_instance()
+    await poll_answer_buffer.stop()
+    await stop_metrics_server()
+    logger.info(f"Poll answer buffer stopped: {poll_answer_buffer.stats()}")
+    logger.info(f"Profile cache stats: {profile_cache.stats()}")
+    logger.info(f"Persistence stats: {persistence.stats()}")
+    logger.info(f"State stores: {state_store_stats()}")
+    logger.info(f"Database pool: {pool_metrics.snapshot()}")
+    await engine.dispose()
+
+
+async def start_services():
+    """Подключается к базе и запускает фоновые службы реплики.
+
+    SchemaOutOfDateError не перехватывается: с устаревшей схемой бот не стартует.
+    """
+    init_engine()
+    if DB_CREATE_TABLES:
+        await init_models()
+    else:
+        # Схему ведет Alembic: при отставании базы останавливаемся сразу
+        await check_schema(engine)
+
+    # Открываем соединения заранее, чтобы первые запросы не ждали подключения
+    await warm_up(engine)
+
+    # Загружаем активные опросы в маршрутизатор ответов
+    async with get_session() as warm_up_session:
+        await poll_router.warm_up(warm_up_session)
+
+    # Регистрируем реплику: обновления обрабатывают все запущенные реплики
+    if not await register_bot_instance():
+        logger.error("Failed to register bot instance")
+        return False
 
-        # Регистрируем новый экземпляр бота
-        instance_id = register_bot_instance()
-        if not instance_id:
-            logger.error("Failed to register bot instance")
-            return
+    # Участвуем в выборе лидера для задач планировщика
+    await leader_election.try_acquire()
+    leader_election.start()
+
+    if POLL_WRITE_BEHIND:
+        poll_answer_buffer.start()
+
+    await start_metrics_server()
+    return True
+
+
+def build_application():
+    """Создает приложение со всеми обработчиками"""
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN)\
+        .persistence(persistence).post_shutdown(on_shutdown)\
+        .request(InstrumentedRequest(connection_pool_size=256))
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    application = builder.build()
+    poll_answer_buffer.on_unregistered = lambda telegram_user_ids: offer_registrations(
+        application.bot, telegram_user_ids)
+
+    # Добавляем обработчики команд
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("profile", profile))
+    application.add_handler(CommandHandler("settings", settings))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("faq", faq))
+    application.add_handler(CommandHandler("cancel", start))
+
+    # Добавляем обработчик разговора для регистрации
+    conv_handler = ConversationHandler(
+        name='registration',
+        persistent=True,
+        conversation_timeout=CONVERSATION_TTL,
+        entry_points=[CallbackQueryHandler(
+            register, pattern='^register$')],
+        states={
+            ENTER_NAME: [
+                MessageHandler(filters.TEXT & ~
+                               filters.COMMAND, enter_name),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+            ENTER_CITY: [
+                MessageHandler(filters.TEXT & ~
+                               filters.COMMAND, enter_city),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+            ENTER_SOCIAL_LINK: [
+                MessageHandler(filters.TEXT & ~
+                               filters.COMMAND, enter_social_link),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+            ENTER_ABOUT: [
+                MessageHandler(filters.TEXT & ~
+                               filters.COMMAND, enter_about),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+            ENTER_JOB: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, enter_job),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+            ENTER_BIRTH_DATE: [
+                MessageHandler(filters.TEXT & ~
+                               filters.COMMAND, enter_birth_date),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+            ENTER_AVATAR: [
+                MessageHandler(filters.PHOTO, enter_avatar),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+            ENTER_HOBBIES: [
+                MessageHandler(filters.TEXT & ~
+                               filters.COMMAND, enter_hobbies),
+                CallbackQueryHandler(register, pattern='^register$')
+            ],
+        },
+        fallbacks=[CommandHandler('cancel', start)],
+        per_chat=True,
+        per_user=True,
+        # С per_message=True разговор не видит текстовые ответы пользователя
+        per_message=False
+    )
 
-        # Создаем приложение
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
-        # Добавляем обработчики команд
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("profile", profile))
-        application.add_handler(CommandHandler("settings", settings))
-        application.add_handler(CommandHandler("stats", stats))
-        application.add_handler(CommandHandler("faq", faq))
-        application.add_handler(CommandHandler("cancel", start))
-
-        # Добавляем обработчик разговора для регистрации
-        conv_handler = ConversationHandler(
-            entry_points=[CallbackQueryHandler(
-                register, pattern='^register$')],
-            states={
-                ENTER_NAME: [
-                    MessageHandler(filters.TEXT & ~
-                                   filters.COMMAND, enter_name),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-                ENTER_CITY: [
-                    MessageHandler(filters.TEXT & ~
-                                   filters.COMMAND, enter_city),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-                ENTER_SOCIAL_LINK: [
-                    MessageHandler(filters.TEXT & ~
-                                   filters.COMMAND, enter_social_link),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-                ENTER_ABOUT: [
-                    MessageHandler(filters.TEXT & ~
-                                   filters.COMMAND, enter_about),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-                ENTER_JOB: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, enter_job),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-                ENTER_BIRTH_DATE: [
-                    MessageHandler(filters.TEXT & ~
-                                   filters.COMMAND, enter_birth_date),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-                ENTER_AVATAR: [
-                    MessageHandler(filters.PHOTO, enter_avatar),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-                ENTER_HOBBIES: [
-                    MessageHandler(filters.TEXT & ~
-                                   filters.COMMAND, enter_hobbies),
-                    CallbackQueryHandler(register, pattern='^register$')
-                ],
-            },
-            fallbacks=[CommandHandler('cancel', start)],
-            per_chat=True,
-            per_user=True,
-            per_message=True
-        )
+    # Добавляем обработчик разговора для настроек
+    settings_handler = ConversationHandler(
+        name='settings',
+        persistent=True,
+        conversation_timeout=CONVERSATION_TTL,
+        entry_points=[CallbackQueryHandler(
+            settings, pattern='^settings$')],
+        states={
+            SETTINGS_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_city)],
+            SETTINGS_SOCIAL_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_social_link)],
+            SETTINGS_ABOUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_about)],
+            SETTINGS_JOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_job)],
+            SETTINGS_BIRTH_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_birth_date)],
+            SETTINGS_AVATAR: [MessageHandler(filters.PHOTO, update_avatar)],
+            SETTINGS_HOBBIES: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_hobbies)],
+            SETTINGS_VISIBILITY: [CallbackQueryHandler(
+                update_visibility, pattern='^visibility_')]
+        },
+        fallbacks=[CommandHandler('cancel', start)],
+        per_chat=True,
+        per_user=True,
+        # С per_message=True разговор не видит текстовые ответы пользователя
+        per_message=False
+    )
 
-        # Добавляем обработчик разговора для настроек
-        settings_handler = ConversationHandler(
-            entry_points=[CallbackQueryHandler(
-                settings, pattern='^settings$')],
-            states={
-                SETTINGS_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_city)],
-                SETTINGS_SOCIAL_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_social_link)],
-                SETTINGS_ABOUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_about)],
-                SETTINGS_JOB: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_job)],
-                SETTINGS_BIRTH_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_birth_date)],
-                SETTINGS_AVATAR: [MessageHandler(filters.PHOTO, update_avatar)],
-                SETTINGS_HOBBIES: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_hobbies)],
-                SETTINGS_VISIBILITY: [CallbackQueryHandler(
-                    update_visibility, pattern='^visibility_')]
-            },
-            fallbacks=[CommandHandler('cancel', start)],
-            per_chat=True,
-            per_user=True,
-            per_message=True
-        )
+    application.add_handler(conv_handler)
+    application.add_handler(settings_handler)
+    # Разговоры, начатые на другой реплике, подгружаются до обработки обновления
+    application.add_handler(conversation_reloader(
+        persistence, [conv_handler, settings_handler]), group=-1)
+
+    # Добавляем обработчики для кнопок и опросов
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(PollAnswerHandler(handle_poll_answer))
+
+    # Время, ошибки, запросы к базе и вызовы Bot API по каждому обработчику
+    instrument_handlers(application)
+    return application
+
+
+def start_scheduler(application):
+    """Запускает задачи планировщика"""
+    # Рассылки и пересчеты выполняет только лидер, heartbeat и метрики — каждая реплика
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(leader_election.leader_only(send_weekly_poll), 'cron',
+                      day_of_week='mon', hour=10, minute=0,
+                      timezone='Europe/Moscow', args=[application])
+    scheduler.add_job(leader_election.leader_only(distribute_pairs), 'cron',
+                      day_of_week='tue', hour=10, minute=0,
+                      timezone='Europe/Moscow', args=[application])
+    scheduler.add_job(update_heartbeat, 'interval', minutes=1)
+    scheduler.add_job(leader_election.leader_only(reconcile_aggregates), 'cron',
+                      hour=4, minute=0, timezone='Europe/Moscow')
+    scheduler.add_job(log_pool_metrics, 'interval', minutes=5)
+    scheduler.add_job(persistence.expire, 'interval', minutes=10, args=[application])
+    scheduler.add_job(purge_state_stores, 'interval', minutes=10)
+    instrument_scheduler(scheduler)
+    scheduler.start()
+    # Задачи, пропущенные без лидера, выполнит реплика, получившая аренду
+    leader_election.attach(scheduler)
+    return scheduler
+
+
+async def create_worker_application():
+    """Готовит реплику для процесса-воркера (см. sharding.py)"""
+    global POLL_WRITE_BEHIND
+    if POLL_WRITE_BEHIND and sharding.BOT_WORKERS > 1:
+        # Перед распределением пар лидер сбрасывает только свой буфер
+        logger.warning("POLL_WRITE_BEHIND is ignored with BOT_WORKERS > 1: writing poll answers directly")
+        POLL_WRITE_BEHIND = False
+    if not await start_services():
+        raise RuntimeError("Failed to start bot services")
+    application = build_application()
+    start_scheduler(application)
+    return application
 
-        application.add_handler(conv_handler)
-        application.add_handler(settings_handler)
 
-        # Добавляем обработчики для кнопок и опросов
-        application.add_handler(CallbackQueryHandler(button))
-        application.add_handler(PollAnswerHandler(handle_poll_answer))
+async def main():
+    """Основная функция запуска бота"""
+    if not await start_services():
+        return
 
-        # Настраиваем планировщик задач
-        scheduler = AsyncIOScheduler()
-        scheduler.add_job(send_weekly_poll, 'cron', day_of_week='mon',
-                          hour=10, minute=0, timezone='Europe/Moscow')
-        scheduler.add_job(distribute_pairs, 'cron', day_of_week='tue',
-                          hour=10, minute=0, timezone='Europe/Moscow')
-        scheduler.add_job(update_heartbeat, 'interval', minutes=1)
-        scheduler.start()
+    try:
+        application = build_application()
+        start_scheduler(application)
 
-        logger.info("Bot is starting...")
-        await application.run_polling()
+        logger.info(f"Bot is starting in {BOT_MODE} mode...")
+        if BOT_MODE == 'webhook':
+            await run_webhook(application)
+        else:
+            await application.run_polling()
 
     except Exception as e:
         logger.error(f"Error in main: {e}")
-        if session:
-            try:
-                # Удаляем запись о текущем экземпляре бота
-                session.query(BotInstance).filter(
-                    BotInstance.instance_id == instance_id).delete()
-                session.commit()
-                logger.info("Bot instance record removed")
-            except Exception as e:
-                logger.error(f"Error removing bot instance: {e}")
-    finally:
-        if session:
-            session.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,382 @@
+"""Распределение пар с учетом предпочтений участников (UserPreferences).
+
+Для участников недели строится матрица стоимостей "каждый с каждым":
+
+* жесткие ограничения — маска, такие пары не составляются:
+  возраст (User.birth_date) вне age_range_min..age_range_max партнера,
+  only_new_users / only_experienced против числа встреч (total_meetings;
+  опытным считается уровень regular из aggregates.py), разные языки, если
+  оба их указали;
+* мягкие — веса: похожие интересы (косинус векторов из interest_index.py
+  и preferred_interests с весами IDF по участникам недели) удешевляют пару,
+  несовпадающее удобное время и прошлые встречи (стоимость из
+  pairing.History) удорожают.
+
+Пары выбираются жадно по матрице: сначала участники с наименьшим числом
+допустимых партнеров, каждому — самый дешевый свободный. Нечетный участник
+и те, кому не нашлось допустимой пары, присоединяются к группе, где все
+с ними совместимы; если такой нет, участник на этой неделе остается без пары.
+
+С NumPy матрица считается векторно целиком, пока участников не больше
+DENSE_MAX_PARTICIPANTS; больше (или без NumPy) — поблочно: участники
+перемешиваются и делятся на блоки, оставшиеся без пары сводятся общим
+последним блоком.
+"""
+import logging
+import math
+import random
+from datetime import datetime
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, Union
+
+from sqlalchemy import select
+
+from aggregates import EXPERIENCE_LEVELS
+from database import User, UserPreferences
+from interest_index import load_vectors, normalize, profile_vector, tokenize, weight_by_idf
+from pairing import History
+
+try:
+    import numpy as np
+except ImportError:  # без NumPy работает поблочный расчет на чистом Python
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Участник считается опытным с этого числа встреч
+EXPERIENCED_MIN_MEETINGS = min(threshold for threshold, _ in EXPERIENCE_LEVELS)
+
+# Вес похожести интересов (косинус от 0 до 1)
+INTEREST_WEIGHT = 1.0
+
+# Вес preferred_interests относительно текста профиля
+PREFERRED_INTERESTS_WEIGHT = 0.5
+
+# Штраф, если оба указали удобное время и оно не совпадает
+MEETING_TIME_PENALTY = 0.5
+
+# Множитель стоимости прошлых встреч из pairing.History
+REPEAT_WEIGHT = 2.0
+
+# Плотный расчет держит несколько матриц n×n (стоимости float32, маски bool,
+# временные uint64 в _disjoint): на 3000 участников пик ~190 МБ, на 5000 —
+# уже ~425 МБ, что близко к лимиту памяти небольшого контейнера
+DENSE_MAX_PARTICIPANTS = 3000
+
+# Произведений весов в одной пачке _cosine
+COSINE_CHUNK = 1 << 20
+
+# Размер блока при поблочном расчете (NumPy / чистый Python)
+BLOCK_SIZE = 2000
+PURE_PYTHON_BLOCK_SIZE = 300
+
+# Максимальный размер группы при присоединении оставшихся участников
+MAX_GROUP_SIZE = 3
+
+def _options(text: Optional[str]) -> Set[str]:
+    # Списки в UserPreferences хранятся строкой через запятую
+    return {item.strip().lower() for item in (text or '').split(',') if item.strip()}
+
+
+class Profile:
+    """Данные участника, нужные для совместимости"""
+
+    __slots__ = ('user_id', 'age', 'age_min', 'age_max', 'total_meetings', 'only_new_users',
+                 'only_experienced', 'languages', 'meeting_times', 'interests')
+
+    def __init__(self, user_id: int, age: Optional[float] = None, age_min: Optional[int] = None,
+                 age_max: Optional[int] = None, total_meetings: int = 0,
+                 only_new_users: bool = False, only_experienced: bool = False,
+                 languages: Iterable[str] = (), meeting_times: Iterable[str] = (),
+                 interests: Union[Mapping[str, float], Iterable[str]] = ()):
+        self.user_id = user_id
+        self.age = age
+        self.age_min = age_min
+        self.age_max = age_max
+        self.total_meetings = total_meetings or 0
+        self.only_new_users = bool(only_new_users)
+        self.only_experienced = bool(only_experienced)
+        self.languages = frozenset(languages)
+        self.meeting_times = frozenset(meeting_times)
+        # Вектор интересов {термин: вес}; просто набор слов — с равными весами
+        self.interests = dict(interests) if isinstance(interests, Mapping) else normalize(
+            dict.fromkeys(interests, 1.0))
+
+    @classmethod
+    def from_row(cls, row, now: datetime, interests: Mapping[str, float]) -> 'Profile':
+        age = (now - row.birth_date).days / 365.25 if row.birth_date else None
+        return cls(row.id, age, row.age_range_min, row.age_range_max, row.total_meetings,
+                   row.only_new_users, row.only_experienced,
+                   _options(row.preferred_languages), _options(row.preferred_meeting_times),
+                   interests)
+
+    def accepts(self, other: 'Profile') -> bool:
+        """Подходит ли other по жестким ограничениям этого участника"""
+        if other.age is not None:
+            if self.age_min is not None and other.age < self.age_min:
+                return False
+            if self.age_max is not None and other.age > self.age_max:
+                return False
+        experienced = other.total_meetings >= EXPERIENCED_MIN_MEETINGS
+        if self.only_new_users and experienced:
+            return False
+        if self.only_experienced and not experienced:
+            return False
+        return True
+
+
+def _interests(vector: Dict[str, float], preferred: Optional[str]) -> Dict[str, float]:
+    """Вектор профиля вместе с preferred_interests"""
+    terms = set(tokenize(preferred))
+    if not terms:
+        return vector
+    merged = dict(vector)
+    extra = PREFERRED_INTERESTS_WEIGHT / math.sqrt(len(terms))
+    for term in terms:
+        merged[term] = merged.get(term, 0.0) + extra
+    return normalize(merged)
+
+
+async def load_profiles(session, user_ids: Sequence[int], now: Optional[datetime] = None) -> Dict[int, Profile]:
+    """Профили, предпочтения и векторы интересов участников двумя запросами"""
+    now = now or datetime.utcnow()
+    vectors = await load_vectors(session, user_ids)
+    rows = (await session.execute(
+        select(User.id, User.birth_date, User.hobbies, User.about, User.job, User.total_meetings,
+               UserPreferences.age_range_min, UserPreferences.age_range_max,
+               UserPreferences.preferred_languages, UserPreferences.preferred_interests,
+               UserPreferences.preferred_meeting_times, UserPreferences.only_new_users,
+               UserPreferences.only_experienced)
+        .outerjoin(UserPreferences, UserPreferences.user_id == User.id)
+        .filter(User.id.in_(user_ids)))).all()
+    # Еще не проиндексированный профиль (до interest_index.py --rebuild) считаем на лету
+    interests = weight_by_idf([
+        _interests(vectors.get(row.id) or profile_vector(row.hobbies, row.about, row.job),
+                   row.preferred_interests)
+        for row in rows])
+    return {row.id: Profile.from_row(row, now, vector) for row, vector in zip(rows, interests)}
+
+
+def pair_cost(a: Profile, b: Profile, history: History) -> float:
+    """Стоимость пары; math.inf, если нарушено жесткое ограничение"""
+    if a.user_id == b.user_id or not (a.accepts(b) and b.accepts(a)):
+        return math.inf
+    if a.languages and b.languages and not a.languages & b.languages:
+        return math.inf
+    cost = REPEAT_WEIGHT * history.get(a.user_id, {}).get(b.user_id, 0.0)
+    if a.meeting_times and b.meeting_times and not a.meeting_times & b.meeting_times:
+        cost += MEETING_TIME_PENALTY
+    if a.interests and b.interests:
+        small, large = sorted((a.interests, b.interests), key=len)
+        cost -= INTEREST_WEIGHT * sum(weight * large.get(term, 0.0) for term, weight in small.items())
+    return cost
+
+
+def _bitmasks(sets: List[frozenset]):
+    """Множества как битовые маски (значений немного: языки, время встреч)"""
+    bits = {value: i for i, value in enumerate(sorted(set().union(*sets)))}
+    if len(bits) > 63:
+        return None
+    return np.array([sum(1 << bits[value] for value in values) for values in sets], dtype=np.uint64)
+
+
+def _disjoint(sets: List[frozenset]):
+    """Матрица: оба указали значения и они не пересекаются"""
+    masks = _bitmasks(sets)
+    if masks is None:
+        return np.array([[bool(a and b and not a & b) for b in sets] for a in sets])
+    specified = masks != 0
+    return ((masks[:, None] & masks[None, :]) == 0) & specified[:, None] & specified[None, :]
+
+
+def _cosine(vectors: List[Dict[str, float]]):
+    """Косинус векторов интересов "каждый с каждым" по спискам участников термина.
+
+    Плотная матрица участники × словарь не строится: каждый термин добавляет
+    внешнее произведение весов своих участников. Термины одной длины списка
+    обрабатываются вместе, пачками не больше COSINE_CHUNK произведений, поэтому
+    память — матрица n×n плюс пачка, а работа — сумма квадратов длин списков.
+    """
+    n = len(vectors)
+    postings: Dict[str, Tuple[List[int], List[float]]] = {}
+    for row, vector in enumerate(vectors):
+        for term, weight in vector.items():
+            rows, weights = postings.setdefault(term, ([], []))
+            rows.append(row)
+            weights.append(weight)
+    by_length: Dict[int, Tuple[list, list]] = {}
+    for rows, weights in postings.values():
+        # Термины, которые есть только у одного участника, в скалярные произведения не входят
+        if len(rows) > 1:
+            group = by_length.setdefault(len(rows), ([], []))
+            group[0].append(rows)
+            group[1].append(weights)
+
+    similarity = np.zeros(n * n, dtype=np.float32)
+    for length, (rows, weights) in by_length.items():
+        step = max(COSINE_CHUNK // (length * length), 1)
+        for start in range(0, len(rows), step):
+            chunk_rows = np.array(rows[start:start + step], dtype=np.int64)
+            chunk_weights = np.array(weights[start:start + step], dtype=np.float32)
+            index = chunk_rows[:, :, None] * n + chunk_rows[:, None, :]
+            np.add.at(similarity, index.ravel(),
+                      (chunk_weights[:, :, None] * chunk_weights[:, None, :]).ravel())
+    return similarity.reshape(n, n)
+
+
+def cost_matrix(profiles: List[Profile], history: History):
+    """Матрица стоимостей (NumPy float32, недопустимые пары — inf)"""
+    n = len(profiles)
+    nan = float('nan')
+    age = np.array([nan if p.age is None else p.age for p in profiles], dtype=np.float32)
+    age_min = np.array([-np.inf if p.age_min is None else p.age_min for p in profiles], dtype=np.float32)
+    age_max = np.array([np.inf if p.age_max is None else p.age_max for p in profiles], dtype=np.float32)
+    experienced = np.array([p.total_meetings >= EXPERIENCED_MIN_MEETINGS for p in profiles])
+    only_new = np.array([p.only_new_users for p in profiles])
+    only_experienced = np.array([p.only_experienced for p in profiles])
+
+    # accepts[a, b]: b подходит a; с NaN сравнения ложны, поэтому неизвестный возраст проверяем отдельно
+    unknown_age = np.isnan(age)[None, :]
+    accepts = unknown_age | ((age[None, :] >= age_min[:, None]) & (age[None, :] <= age_max[:, None]))
+    accepts &= ~(only_new[:, None] & experienced[None, :])
+    accepts &= ~(only_experienced[:, None] & ~experienced[None, :])
+    allowed = accepts & accepts.T
+    allowed &= ~_disjoint([p.languages for p in profiles])
+    np.fill_diagonal(allowed, False)
+
+    cost = MEETING_TIME_PENALTY * _disjoint([p.meeting_times for p in profiles]).astype(np.float32)
+    cost -= INTEREST_WEIGHT * _cosine([p.interests for p in profiles])
+
+    # Прошлые встречи: история разреженная, заполняем по индексам
+    index = {p.user_id: i for i, p in enumerate(profiles)}
+    rows, columns, values = [], [], []
+    for user_id, i in index.items():
+        for partner_id, past_cost in history.get(user_id, {}).items():
+            j = index.get(partner_id)
+            if j is not None and past_cost:
+                rows.append(i)
+                columns.append(j)
+                values.append(past_cost)
+    if rows:
+        cost[rows, columns] += REPEAT_WEIGHT * np.array(values, dtype=np.float32)
+
+    cost[~allowed] = np.inf
+    return cost
+
+
+def _match_dense(cost, rng: random.Random) -> Tuple[List[Tuple[int, int]], List[int]]:
+    """Жадное паросочетание по матрице: сначала самые ограниченные участники"""
+    n = cost.shape[0]
+    order = list(range(n))
+    rng.shuffle(order)
+    feasible = np.isfinite(cost).sum(axis=1)
+    order.sort(key=lambda i: feasible[i])
+
+    free = np.ones(n, dtype=bool)
+    pairs, unmatched = [], []
+    for i in order:
+        if not free[i]:
+            continue
+        free[i] = False
+        row = np.where(free, cost[i], np.inf)
+        j = int(np.argmin(row))
+        if not np.isfinite(row[j]):
+            unmatched.append(i)
+            continue
+        free[j] = False
+        pairs.append((i, j))
+    return pairs, unmatched
+
+
+def _match_python(profiles: List[Profile], history: History,
+                  rng: random.Random) -> Tuple[List[Tuple[int, int]], List[int]]:
+    """То же без NumPy; для блоков размером до PURE_PYTHON_BLOCK_SIZE"""
+    n = len(profiles)
+    cost = [[pair_cost(a, b, history) for b in profiles] for a in profiles]
+    order = list(range(n))
+    rng.shuffle(order)
+    order.sort(key=lambda i: sum(1 for value in cost[i] if value != math.inf))
+
+    free = [True] * n
+    pairs, unmatched = [], []
+    for i in order:
+        if not free[i]:
+            continue
+        free[i] = False
+        best, best_cost = None, math.inf
+        for j in range(n):
+            if free[j] and cost[i][j] < best_cost:
+                best, best_cost = j, cost[i][j]
+        if best is None:
+            unmatched.append(i)
+            continue
+        free[best] = False
+        pairs.append((i, best))
+    return pairs, unmatched
+
+
+def _match(profiles: List[Profile], history: History, rng: random.Random):
+    if np is not None:
+        return _match_dense(cost_matrix(profiles, history), rng)
+    return _match_python(profiles, history, rng)
+
+
+def match_by_preferences(user_ids: Sequence[int], meeting_history: History, profiles: Dict[int, Profile],
+                         rng: Optional[random.Random] = None) -> Tuple[List[tuple], List[int]]:
+    """Создает пары с учетом предпочтений и истории встреч.
+
+    profiles: {user_id: Profile} (см. load_profiles); участники без профиля
+    считаются участниками без ограничений. Возвращает список кортежей, как
+    pairing.create_pairs, и участников, которым не нашлось допустимой пары.
+    """
+    rng = rng or random.Random()
+    order = list(dict.fromkeys(user_ids))
+    rng.shuffle(order)
+    members = [profiles.get(user_id) or Profile(user_id) for user_id in order]
+
+    block_size = PURE_PYTHON_BLOCK_SIZE if np is None else (
+        len(members) if len(members) <= DENSE_MAX_PARTICIPANTS else BLOCK_SIZE)
+    groups: List[list] = []
+    leftovers: List[Profile] = []
+    for start in range(0, len(members), max(block_size, 2)):
+        block = members[start:start + block_size]
+        pairs, unmatched = _match(block, meeting_history, rng)
+        groups.extend([block[i], block[j]] for i, j in pairs)
+        leftovers.extend(block[i] for i in unmatched)
+
+    # Оставшиеся из разных блоков могут подойти друг другу; их тоже сводим
+    # блоками, чтобы не выйти за память плотного расчета
+    if len(leftovers) > 1 and len(members) > block_size:
+        pooled, leftovers = leftovers, []
+        for start in range(0, len(pooled), block_size):
+            block = pooled[start:start + block_size]
+            pairs, unmatched = _match(block, meeting_history, rng)
+            groups.extend([block[i], block[j]] for i, j in pairs)
+            leftovers.extend(block[i] for i in unmatched)
+
+    unpaired = []
+    for member in leftovers:
+        best, best_cost = None, math.inf
+        for group in groups:
+            if len(group) >= MAX_GROUP_SIZE:
+                continue
+            group_cost = sum(pair_cost(member, other, meeting_history) for other in group)
+            if group_cost < best_cost:
+                best, best_cost = group, group_cost
+        if best is None:
+            unpaired.append(member.user_id)
+        else:
+            best.append(member)
+    if unpaired:
+        logger.warning(f"{len(unpaired)} participants have no compatible partner this week: {unpaired}")
+    return [tuple(member.user_id for member in group) for group in groups], unpaired
+
+
+def create_preference_pairs(user_ids: Sequence[int], meeting_history: History,
+                            rng: Optional[random.Random] = None, *,
+                            profiles: Optional[Dict[int, Profile]] = None) -> List[tuple]:
+    """match_by_preferences с сигнатурой pairing.create_pairs.
+
+    Подходит для --engine в benchmark_pairing.py и --strategy в
+    pairing_simulator.py; без profiles у участников нет ограничений.
+    """
+    return match_by_preferences(user_ids, meeting_history, profiles or {}, rng)[0]
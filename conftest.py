@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+import pytest
+
+# Ручные скрипты: обращаются к настоящему Telegram с токеном из .env
+collect_ignore = ['manual_test.py', 'simple_test.py', 'test_connection.py']
+
+# Тесты не должны трогать рабочую базу и требовать настоящий токен бота
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'test:token')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+    tempfile.mkdtemp(prefix='random_coffee_test_'), 'test.db')
+
+
+@pytest.fixture
+def sql_profile():
+    """Профиль SQL теста: NPlusOneError, если запрос повторился больше
+    sql_profile.threshold раз"""
+    from sql_profiler import profile_scope
+
+    with profile_scope('test', mode='fail') as profile:
+        yield profile
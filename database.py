@@ -1,11 +1,11 @@
 from datetime import datetime
 import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Text, Float, Boolean, BigInteger
+from sqlalchemy import create_engine, make_url, Column, Integer, String, DateTime, ForeignKey, Text, Float, Boolean, BigInteger, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from typing import Dict
-from sqlalchemy import or_
+from sqlalchemy.ext.asyncio import create_async_engine
+from db_pool import engine_options
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -33,7 +33,11 @@ class User(Base):
     is_active = Column(Boolean, default=True)
     show_profile = Column(Boolean, default=True)
     experience_level = Column(Integer, default=0)
+    # Денормализованные счетчики, обновляются вместе со встречами и оценками
     total_meetings = Column(Integer, default=0)
+    completed_meetings = Column(Integer, default=0)
+    rating_sum = Column(Float, default=0.0)
+    rating_count = Column(Integer, default=0)
     average_rating = Column(Float, default=0.0)
     last_active = Column(DateTime, default=datetime.utcnow)
     settings = Column(Text)  # JSON строка для дополнительных настроек
@@ -74,8 +78,10 @@ class Meeting(Base):
     __tablename__ = 'meetings'
 
     id = Column(Integer, primary_key=True)
-    user1_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    user2_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user1_id = Column(Integer, ForeignKey('users.id'),
+                      nullable=False, index=True)
+    user2_id = Column(Integer, ForeignKey('users.id'),
+                      nullable=False, index=True)
     scheduled_time = Column(DateTime)
     status = Column(String(50))  # scheduled, completed, cancelled
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -95,7 +101,8 @@ class Rating(Base):
     id = Column(Integer, primary_key=True)
     meeting_id = Column(Integer, ForeignKey('meetings.id'), nullable=False)
     from_user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    to_user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    to_user_id = Column(Integer, ForeignKey('users.id'),
+                        nullable=False, index=True)
     rating = Column(Float)
     comment = Column(String(500))
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -125,10 +132,16 @@ class Chat(Base):
 class WeeklyPoll(Base):
     """Модель для хранения еженедельных опросов"""
     __tablename__ = 'weekly_polls'
+    __table_args__ = (
+        Index('ix_weekly_polls_chat_id_created_at', 'chat_id', 'created_at'),
+        UniqueConstraint('telegram_poll_id',
+                         name='uq_weekly_polls_telegram_poll_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer, ForeignKey('chats.id'), nullable=False)
-    message_id = Column(Integer)
+    message_id = Column(Integer, index=True)
+    telegram_poll_id = Column(String(64))  # poll.id от Telegram
     week_start = Column(DateTime)
     week_end = Column(DateTime)
     status = Column(String(50))  # active, closed
@@ -141,6 +154,11 @@ class WeeklyPoll(Base):
 
 class PollResponse(Base):
     __tablename__ = 'poll_responses'
+    __table_args__ = (
+        UniqueConstraint('poll_id', 'user_id',
+                         name='uq_poll_responses_poll_id_user_id'),
+        Index('ix_poll_responses_poll_id_response', 'poll_id', 'response'),
+    )
 
     id = Column(Integer, primary_key=True)
     poll_id = Column(Integer, ForeignKey('weekly_polls.id'), nullable=False)
@@ -153,6 +171,114 @@ class PollResponse(Base):
     user = relationship("User", back_populates="poll_responses")
 
 
+class PairHistory(Base):
+    """Сводная история встреч пары: одна строка на пару (min_id, max_id)"""
+    __tablename__ = 'pair_history'
+
+    user_low_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    user_high_id = Column(Integer, ForeignKey('users.id'),
+                          primary_key=True, index=True)
+    meet_count = Column(Integer, nullable=False, default=0)
+    last_met_at = Column(DateTime)
+
+
+class InterestTerm(Base):
+    """Вес термина в векторе интересов пользователя (см. interest_index.py)"""
+    __tablename__ = 'interest_terms'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    term = Column(String(64), primary_key=True)
+    weight = Column(Float, nullable=False)
+
+    __table_args__ = (
+        # Инвертированный индекс: по термину сразу находятся пользователи и веса
+        Index('ix_interest_terms_term', 'term', 'user_id', 'weight'),
+    )
+
+
+# Строк в одном многострочном INSERT и значений в одном списке IN: asyncpg
+# принимает не больше 32767 параметров в запросе, SQLite — 32766
+SQL_CHUNK = 1000
+
+
+def chunked(items, size: int = SQL_CHUNK):
+    """Части последовательности по size элементов"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _dialect_insert(dialect_name: str, model):
+    """INSERT с поддержкой ON CONFLICT для PostgreSQL и SQLite"""
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+
+def pair_history_upsert(dialect_name: str, rows):
+    """INSERT ... ON CONFLICT для pair_history: увеличивает счетчик и время последней встречи.
+
+    rows: список словарей с ключами user_low_id, user_high_id, meet_count, last_met_at.
+    """
+    stmt = _dialect_insert(dialect_name, PairHistory).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[PairHistory.user_low_id, PairHistory.user_high_id],
+        set_={
+            'meet_count': PairHistory.meet_count + stmt.excluded.meet_count,
+            'last_met_at': stmt.excluded.last_met_at,
+        }
+    )
+
+
+def poll_response_upsert(dialect_name: str, rows):
+    """INSERT ... ON CONFLICT (poll_id, user_id) DO UPDATE для ответов на опрос.
+
+    rows: словарь или список словарей с ключами poll_id, user_id, response, created_at.
+    """
+    stmt = _dialect_insert(dialect_name, PollResponse).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[PollResponse.poll_id, PollResponse.user_id],
+        set_={
+            'response': stmt.excluded.response,
+            'created_at': stmt.excluded.created_at,
+        }
+    )
+
+
+def conversation_state_upsert(dialect_name: str, rows):
+    """INSERT ... ON CONFLICT (name, key) DO UPDATE для состояний разговоров"""
+    stmt = _dialect_insert(dialect_name, ConversationState).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[ConversationState.name, ConversationState.key],
+        set_={
+            'state': stmt.excluded.state,
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+
+
+def user_data_upsert(dialect_name: str, rows):
+    """INSERT ... ON CONFLICT (user_id) DO UPDATE для user_data"""
+    stmt = _dialect_insert(dialect_name, PersistedUserData).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[PersistedUserData.user_id],
+        set_={
+            'data': stmt.excluded.data,
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+
+
+def job_run_upsert(dialect_name: str, rows):
+    """INSERT ... ON CONFLICT (name) DO UPDATE для последних запусков задач"""
+    stmt = _dialect_insert(dialect_name, ScheduledJobRun).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[ScheduledJobRun.name],
+        set_={'last_run_at': stmt.excluded.last_run_at}
+    )
+
+
 class BotInstance(Base):
     """Модель для отслеживания экземпляров бота"""
     __tablename__ = 'bot_instances'
@@ -161,74 +287,93 @@ class BotInstance(Base):
     last_heartbeat = Column(DateTime, nullable=False)
 
 
-def init_db():
-    """Инициализация базы данных"""
-    database_url = os.getenv('DATABASE_URL', 'sqlite:///random_coffee.db')
-    engine = create_engine(database_url)
+class ConversationState(Base):
+    """Состояние ConversationHandler для ключа разговора (см. persistence.py)"""
+    __tablename__ = 'conversation_states'
 
-    # Удаляем все существующие таблицы
-    Base.metadata.drop_all(engine)
+    name = Column(String(64), primary_key=True)
+    key = Column(String(128), primary_key=True)
+    state = Column(Text, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)
 
-    # Создаем все таблицы заново
-    Base.metadata.create_all(engine)
 
-    return engine
+class PersistedUserData(Base):
+    """context.user_data пользователя в JSON (см. persistence.py)"""
+    __tablename__ = 'persisted_user_data'
 
+    user_id = Column(BigInteger, primary_key=True)
+    data = Column(Text, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)
 
-# Создаем глобальную сессию базы данных
-db = init_db()
-
-
-def get_user_stats(self, user_id: int) -> Dict:
-    """Получить статистику пользователя"""
-    with self.get_session() as session:
-        user = session.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
-            return None
-
-        # Получаем все встречи пользователя
-        meetings = session.query(Meeting).filter(
-            or_(
-                Meeting.user1_id == user.id,
-                Meeting.user2_id == user.id
-            )
-        ).all()
-
-        # Получаем все оценки пользователя
-        ratings = session.query(Rating).filter(
-            Rating.rated_user_id == user.id
-        ).all()
-
-        # Подсчитываем статистику
-        total_meetings = len(meetings)
-        completed_meetings = len(
-            [m for m in meetings if m.status == 'completed'])
-        avg_rating = sum(r.rating for r in ratings) / \
-            len(ratings) if ratings else 0
-
-        # Определяем уровень опыта
-        experience_level = "Новичок"
-        if completed_meetings >= 10:
-            experience_level = "Опытный"
-        elif completed_meetings >= 5:
-            experience_level = "Средний"
-
-        # Получаем достижения
-        achievements = []
-        if completed_meetings >= 1:
-            achievements.append("Первая встреча")
-        if completed_meetings >= 5:
-            achievements.append("5 встреч")
-        if completed_meetings >= 10:
-            achievements.append("10 встреч")
-        if avg_rating >= 4.5:
-            achievements.append("Высокий рейтинг")
-
-        return {
-            "total_meetings": total_meetings,
-            "completed_meetings": completed_meetings,
-            "avg_rating": round(avg_rating, 1),
-            "experience_level": experience_level,
-            "registration_date": user.created_at.strftime("%d.%m.%Y"),
-            "achievements": achievements
-        }
+
+class LeaderLease(Base):
+    """Аренда лидерства: задачи планировщика выполняет только держатель"""
+    __tablename__ = 'leader_leases'
+
+    name = Column(String(64), primary_key=True)
+    holder_id = Column(String(36), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    acquired_at = Column(DateTime, nullable=False)
+
+
+class ScheduledJobRun(Base):
+    """Последний успешный запуск задачи лидера (см. leader.py)"""
+    __tablename__ = 'scheduled_job_runs'
+
+    name = Column(String(128), primary_key=True)
+    last_run_at = Column(DateTime, nullable=False)
+
+
+# Асинхронные драйверы для поддерживаемых СУБД
+ASYNC_DRIVERS = {
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+
+def get_async_database_url(database_url: str) -> str:
+    """Преобразует URL базы данных в URL с асинхронным драйвером"""
+    if database_url.startswith('postgres://'):
+        # Heroku до сих пор отдает устаревшую схему postgres://
+        database_url = 'postgresql://' + database_url[len('postgres://'):]
+    url = make_url(database_url)
+    driver = ASYNC_DRIVERS.get(url.drivername, url.drivername)
+    return url.set(drivername=driver).render_as_string(hide_password=False)
+
+
+def _engine_options(url, is_async: bool, kwargs):
+    """Параметры пула из окружения; явные kwargs имеют приоритет"""
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        # База в памяти живет в одном соединении, пул для нее не нужен
+        return kwargs
+    options = engine_options(url.get_backend_name(), is_async)
+    options.update(kwargs)
+    return options
+
+
+def create_db_engine(database_url: str, **kwargs):
+    """Создает синхронный движок с настройками пула из окружения"""
+    if database_url.startswith('postgres://'):
+        database_url = 'postgresql://' + database_url[len('postgres://'):]
+    return create_engine(database_url, **_engine_options(make_url(database_url), False, kwargs))
+
+
+def create_async_db_engine(database_url: str, **kwargs):
+    """Создает асинхронный движок с настройками пула из окружения"""
+    async_url = get_async_database_url(database_url)
+    return create_async_engine(async_url, **_engine_options(make_url(async_url), True, kwargs))
+
+
+def init_db(database_url: str = None):
+    """Создает недостающие таблицы (локальная разработка и тесты).
+
+    Рабочая база ведется миграциями Alembic; при импорте модуля к базе
+    никто не подключается.
+    """
+    database_url = database_url or os.getenv('DATABASE_URL', 'sqlite:///random_coffee.db')
+    engine = create_db_engine(database_url)
+    Base.metadata.create_all(engine)
+    return engine
@@ -0,0 +1,166 @@
+"""Настройки пула соединений и телеметрия пула.
+
+Все движки создаются через database.create_db_engine/create_async_db_engine,
+которые берут параметры пула из переменных окружения:
+
+    DB_POOL_SIZE             постоянных соединений в пуле (5)
+    DB_MAX_OVERFLOW          дополнительных соединений сверх пула (10)
+    DB_POOL_TIMEOUT          ожидание свободного соединения, с (30)
+    DB_POOL_RECYCLE          пересоздание соединения старше N секунд (1800, -1 — никогда)
+    DB_POOL_PRE_PING         проверять соединение перед выдачей (true)
+    DB_CONNECT_TIMEOUT       таймаут установки соединения с PostgreSQL, с (10)
+    DB_STATEMENT_CACHE_SIZE  кэш подготовленных выражений asyncpg (100)
+    DB_POOL_WARMUP           сколько соединений открыть при старте (0)
+
+Пул считает выданные соединения, overflow и гистограмму времени ожидания
+соединения; снимок доступен через pool_metrics.snapshot().
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Dict
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+
+def _env_bool(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes')
+
+
+def get_pool_settings() -> Dict:
+    """Параметры пула из переменных окружения"""
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', 'true'),
+        'connect_timeout': float(os.getenv('DB_CONNECT_TIMEOUT', '10')),
+        'statement_cache_size': int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100')),
+        'warmup': int(os.getenv('DB_POOL_WARMUP', '0')),
+    }
+
+
+class PoolMetrics:
+    """Счетчики пула и гистограмма ожидания соединения"""
+
+    # Верхние границы корзин гистограммы (секунды)
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # После engine.dispose() старый пул заменяется новым и собирается GC
+        self._pools = weakref.WeakSet()
+        self.wait_counts = [0] * (len(self.BUCKETS) + 1)
+        self.wait_sum = 0.0
+        self.checkouts = 0
+        self.timeouts = 0
+
+    def track(self, pool):
+        self._pools.add(pool)
+
+    def observe_wait(self, seconds: float):
+        with self._lock:
+            self.wait_counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.wait_sum += seconds
+            self.checkouts += 1
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> Dict:
+        """Текущее состояние всех пулов процесса"""
+        with self._lock:
+            return {
+                'size': sum(pool.size() for pool in self._pools),
+                'checked_out': sum(pool.checkedout() for pool in self._pools),
+                'overflow': sum(max(pool.overflow(), 0) for pool in self._pools),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_sum': self.wait_sum,
+                'wait_buckets': dict(zip(self.BUCKETS + (float('inf'),),
+                                         self.wait_counts)),
+            }
+
+
+# Общая телеметрия процесса
+pool_metrics = PoolMetrics()
+
+
+class _InstrumentedPoolMixin:
+    """Замеряет время выдачи соединения из пула"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pool_metrics.track(self)
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except exc.TimeoutError:
+            pool_metrics.observe_timeout()
+            raise
+        pool_metrics.observe_wait(time.perf_counter() - started)
+        return connection
+
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+    """QueuePool с телеметрией"""
+
+
+class InstrumentedAsyncPool(_InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool с телеметрией"""
+
+
+def engine_options(backend: str, is_async: bool, settings: Dict = None) -> Dict:
+    """Аргументы create_engine/create_async_engine для указанной СУБД"""
+    settings = settings or get_pool_settings()
+    if backend == 'sqlite' and is_async:
+        # aiosqlite держит поток на каждое соединение; SQLAlchemy по умолчанию
+        # открывает их без пула, так и оставляем
+        return {'connect_args': {'timeout': 30}}
+    options = {
+        'poolclass': InstrumentedAsyncPool if is_async else InstrumentedQueuePool,
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_recycle': settings['pool_recycle'],
+        'pool_pre_ping': settings['pool_pre_ping'],
+    }
+    if backend == 'postgresql':
+        if is_async:
+            options['connect_args'] = {
+                'timeout': settings['connect_timeout'],
+                'statement_cache_size': settings['statement_cache_size'],
+            }
+        else:
+            options['connect_args'] = {
+                'connect_timeout': int(settings['connect_timeout'])}
+    elif backend == 'sqlite':
+        # Конкурентные писатели SQLite ждут освобождения блокировки, а не падают
+        options['connect_args'] = {'timeout': 30}
+    return options
+
+
+async def warm_up(engine, connections: int = None):
+    """Открывает заранее N соединений, чтобы первые запросы не ждали подключения"""
+    if connections is None:
+        connections = get_pool_settings()['warmup']
+    if connections <= 0:
+        return
+    opened = []
+    try:
+        for _ in range(connections):
+            opened.append(await engine.connect())
+    finally:
+        for connection in opened:
+            await connection.close()
+    logger.info(f"Warmed up {len(opened)} database connections")
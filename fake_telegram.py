@@ -0,0 +1,242 @@
+"""Локальная замена Telegram для нагрузочного тестирования режима вебхука.
+
+1. Заглушка Bot API: отвечает ok на все исходящие вызовы бота и считает их.
+
+    python fake_telegram.py api --port 8081
+
+   Бот запускается против нее без сети:
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot BOT_MODE=webhook \\
+    WEBHOOK_URL=http://127.0.0.1:8443 WEBHOOK_SECRET_TOKEN=secret python bot.py
+
+2. Генератор нагрузки: шлет синтетические обновления на вебхук так же, как
+   Telegram (POST JSON с секретным заголовком, keep-alive соединения).
+
+    python fake_telegram.py load --webhook-url http://127.0.0.1:8443/telegram \\
+        --secret secret --updates 5000 --concurrency 40 --api-url http://127.0.0.1:8081
+
+   С --api-url дополнительно ждет, пока бот перестанет отвечать, и считает
+   сквозную пропускную способность по числу исходящих вызовов.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Dict
+from urllib.parse import parse_qsl
+
+import httpx
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+from webhook import SECRET_HEADER
+
+BOT_USER = {
+    'id': 1000000001,
+    'is_bot': True,
+    'first_name': 'Random Coffee',
+    'username': 'random_coffee_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False,
+}
+
+COMMANDS = ('/start', '/help', '/stats', '/settings')
+
+
+def _parse_params(headers, body: bytes) -> Dict:
+    if not body:
+        return {}
+    if headers.get('Content-Type', '').startswith('application/json'):
+        return json.loads(body)
+    params = {}
+    for name, value in parse_qsl(body.decode()):
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+class _MethodHandler(RequestHandler):
+    def initialize(self, api: 'FakeBotAPI'):
+        self.api = api
+
+    def get(self, api_method: str):
+        if api_method == '_stats':
+            self.write(dict(self.api.calls))
+            return
+        self.write({'ok': True, 'result': self.api.call(
+            api_method, _parse_params(self.request.headers, self.request.body))})
+
+    post = get
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: /bot<token>/<method>"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self.port = None
+        self._server = None
+
+    def _message(self, params: Dict) -> Dict:
+        chat_id = params.get('chat_id', 0)
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if int(chat_id) > 0 else 'group'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+        if 'question' in params:
+            message['poll'] = {
+                'id': str(message['message_id']),
+                'question': params['question'],
+                'options': [{'text': option, 'voter_count': 0}
+                            for option in params.get('options', [])],
+                'total_voter_count': 0,
+                'is_closed': False,
+                'is_anonymous': bool(params.get('is_anonymous', True)),
+                'type': 'regular',
+                'allows_multiple_answers': False,
+            }
+        return message
+
+    def call(self, api_method: str, params: Dict):
+        self.calls[api_method] += 1
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method.startswith('send') or api_method.startswith('edit'):
+            return self._message(params)
+        return True
+
+    async def start(self, host: str, port: int) -> int:
+        sockets = bind_sockets(port, host)
+        self._server = HTTPServer(Application([(r'.*/([^/]+)', _MethodHandler, {'api': self})]))
+        self._server.add_sockets(sockets)
+        self.port = sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
+
+
+def make_update(update_id: int, users: int) -> Dict:
+    """Синтетическое обновление: команда из личного чата"""
+    user_id = 200000 + random.randrange(users)
+    text = random.choice(COMMANDS)
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}',
+                     'username': f'user{user_id}'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        },
+    }
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def _api_calls(client, api_url) -> int:
+    response = await client.get(api_url.rstrip('/') + '/_stats')
+    return sum(response.json().values())
+
+
+async def load(args):
+    """Шлет обновления на вебхук и печатает задержки"""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    statuses = Counter()
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+    limits = httpx.Limits(max_connections=args.concurrency,
+                          max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+        calls_before = await _api_calls(client, args.api_url) if args.api_url else 0
+
+        async def one(update_id):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await client.post(
+                        args.webhook_url, json=make_update(update_id, args.users),
+                        headers=headers)
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(1, args.updates + 1)))
+        elapsed = time.perf_counter() - started
+
+        print(f"Обновлений: {args.updates} за {elapsed:.2f} с "
+              f"({args.updates / elapsed:.1f}/с), статусы: {dict(statuses)}")
+        print(f"Задержка приема: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f} мс")
+
+        if args.api_url:
+            # Ждем, пока бот обработает очередь и перестанет слать ответы
+            calls, last_change = calls_before, time.perf_counter()
+            while time.perf_counter() - last_change < 1:
+                await asyncio.sleep(0.1)
+                current = await _api_calls(client, args.api_url)
+                if current != calls:
+                    calls, last_change = current, time.perf_counter()
+            total = last_change - started
+            print(f"Исходящих вызовов Bot API: {calls - calls_before} за {total:.2f} с "
+                  f"({(calls - calls_before) / total:.1f}/с)")
+
+
+async def serve_api(args):
+    api = FakeBotAPI()
+    await api.start(args.host, args.port)
+    print(f"Bot API-заглушка: http://{args.host}:{api.port}/bot")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+        print(f"Вызовы: {dict(api.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    api = commands.add_parser('api', help='заглушка Bot API')
+    api.add_argument('--host', default='127.0.0.1')
+    api.add_argument('--port', type=int, default=8081)
+
+    load_parser = commands.add_parser('load', help='нагрузка на вебхук')
+    load_parser.add_argument('--webhook-url', default='http://127.0.0.1:8443/telegram')
+    load_parser.add_argument('--secret', default='')
+    load_parser.add_argument('--updates', type=int, default=2000)
+    load_parser.add_argument('--concurrency', type=int, default=40)
+    load_parser.add_argument('--users', type=int, default=500)
+    load_parser.add_argument('--api-url', default='')
+
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve_api(args) if args.command == 'api' else load(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
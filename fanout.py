@@ -0,0 +1,152 @@
+"""Рассылка сообщений по многим чатам с учетом лимитов Telegram.
+
+Bot API допускает около 30 сообщений в секунду суммарно и примерно одно
+сообщение в секунду в один чат. Диспетчер отправляет сообщения конкурентно,
+но через общий token bucket и интервал на чат, повторяет запросы после
+RetryAfter и сетевых ошибок, а ошибки одного чата не прерывают рассылку.
+Token bucket один на процесс (shared_bucket), поэтому одновременные
+рассылки делят общий лимит и вместе ждут после RetryAfter.
+"""
+import asyncio
+import logging
+import os
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит сообщений в секунду
+FANOUT_RATE = float(os.getenv('FANOUT_RATE', '30'))
+
+# Минимальный интервал между сообщениями в один чат (секунды)
+FANOUT_PER_CHAT_INTERVAL = float(os.getenv('FANOUT_PER_CHAT_INTERVAL', '1'))
+
+# Сколько раз повторять отправку после временной ошибки
+FANOUT_MAX_RETRIES = int(os.getenv('FANOUT_MAX_RETRIES', '3'))
+
+
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until,
+                                 time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Ждет свободный токен"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Общие token bucket процесса по циклам событий (в работе бота цикл один)
+_shared_buckets = weakref.WeakKeyDictionary()
+
+
+def shared_bucket() -> TokenBucket:
+    """Token bucket на FANOUT_RATE, общий для всех рассылок цикла событий"""
+    loop = asyncio.get_running_loop()
+    bucket = _shared_buckets.get(loop)
+    if bucket is None:
+        bucket = _shared_buckets[loop] = TokenBucket(FANOUT_RATE)
+    return bucket
+
+
+class FanOutResult:
+    """Итог рассылки"""
+
+    def __init__(self):
+        self.sent: Dict[int, object] = {}
+        self.forbidden: List[int] = []
+        self.failed: Dict[int, Exception] = {}
+
+    def __repr__(self):
+        return (f"FanOutResult(sent={len(self.sent)}, "
+                f"forbidden={len(self.forbidden)}, failed={len(self.failed)})")
+
+
+class FanOutDispatcher:
+    """Конкурентная рассылка с глобальным и поканальным ограничением скорости"""
+
+    def __init__(self, per_chat_interval: float = FANOUT_PER_CHAT_INTERVAL,
+                 max_retries: int = FANOUT_MAX_RETRIES, bucket: Optional[TokenBucket] = None):
+        self.bucket = bucket if bucket is not None else shared_bucket()
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_last_sent: Dict[int, float] = {}
+
+    async def _wait_for_chat(self, chat_id: int):
+        last_sent = self._chat_last_sent.get(chat_id)
+        if last_sent is not None:
+            delay = last_sent + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _send_one(self, chat_id: int, send: Callable[[], Awaitable], result: FanOutResult):
+        lock = self._chat_locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_for_chat(chat_id)
+                await self.bucket.acquire()
+                try:
+                    result.sent[chat_id] = await send()
+                    self._chat_last_sent[chat_id] = time.monotonic()
+                    return
+                except RetryAfter as e:
+                    logger.warning(
+                        f"Flood control for chat {chat_id}, retry in {e.retry_after}s")
+                    self.bucket.pause(float(e.retry_after))
+                    error = e
+                except Forbidden as e:
+                    logger.warning(f"Bot has no access to chat {chat_id}: {e}")
+                    result.forbidden.append(chat_id)
+                    return
+                except BadRequest as e:
+                    # BadRequest наследует NetworkError, но повтор не поможет
+                    logger.error(f"Bad request for chat {chat_id}: {e}")
+                    result.failed[chat_id] = e
+                    return
+                except (TimedOut, NetworkError) as e:
+                    logger.warning(
+                        f"Network error for chat {chat_id} (attempt {attempt + 1}): {e}")
+                    await asyncio.sleep(min(2 ** attempt, 30))
+                    error = e
+                except Exception as e:
+                    logger.error(f"Error sending to chat {chat_id}: {e}")
+                    result.failed[chat_id] = e
+                    return
+            result.failed[chat_id] = error
+
+    async def run(self, jobs: Iterable[Tuple[int, Callable[[], Awaitable]]]) -> FanOutResult:
+        """Выполняет рассылку.
+
+        jobs: пары (chat_id, send), где send() возвращает корутину отправки.
+        """
+        result = FanOutResult()
+        await asyncio.gather(*(self._send_one(chat_id, send, result)
+                               for chat_id, send in jobs))
+        logger.info(f"Fan-out finished: {result}")
+        return result
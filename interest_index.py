@@ -0,0 +1,253 @@
+"""Индекс интересов пользователей по тексту профиля.
+
+Хобби, "о себе" и работа (User.hobbies, about, job) разбиваются на слова,
+из которых убираются стоп-слова; русские слова приводятся к основе
+стеммером Портера. Из основ строится разреженный вектор: вес термина —
+(1 + log tf), умноженный на вес поля, вектор нормирован по длине. Векторы
+хранятся в таблице interest_terms (инвертированный индекс по термину) и
+пересчитываются только при изменении текста профиля: в enter_hobbies и
+update_profile_field.
+
+similar_users — top-k похожих пользователей (косинус с весами IDF общих
+терминов) одним запросом по индексу; load_vectors отдает векторы для
+compatibility.py.
+
+Заполнить индекс для уже зарегистрированных пользователей:
+    python interest_index.py --rebuild
+"""
+import argparse
+import asyncio
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import case, delete, func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import InterestTerm, User, create_async_db_engine, create_db_engine
+
+# Вес поля профиля в векторе интересов
+FIELD_WEIGHTS = {
+    'hobbies': 1.0,
+    'about': 0.6,
+    'job': 0.4,
+}
+
+# Поля, при изменении которых вектор пересчитывается
+PROFILE_FIELDS = tuple(FIELD_WEIGHTS)
+
+# Сколько самых весомых терминов хранится на пользователя
+MAX_TERMS = 64
+
+# Длина термина ограничена колонкой interest_terms.term
+MAX_TERM_LENGTH = 64
+
+STOP_WORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только
+ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни
+быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где
+есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под будет ж
+тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее
+сейчас были куда зачем всех никогда можно при наконец два об другой хоть после над больше
+тот через эти нас про всего них какая много разве три эту моя впрочем хорошо свою этой
+перед иногда лучше чуть том нельзя такой им более всегда конечно всю между люблю очень
+также свой свои своих нравится занимаюсь увлекаюсь работаю
+the and or of in on at to for with a an is are i my me love like
+""".split())
+
+_WORD = re.compile(r'[a-zа-я0-9]+')
+
+# Стеммер Портера для русского языка (вариант snowball)
+_PERFECTIVE_GERUND = re.compile(r'((ив|ивши|ившись|ыв|ывши|ывшись)|((?<=[ая])(в|вши|вшись)))$')
+_REFLEXIVE = re.compile(r'(с[яь])$')
+_ADJECTIVE = re.compile(r'(ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя|ою|ею)$')
+_PARTICIPLE = re.compile(r'((ивш|ывш|ующ)|((?<=[ая])(ем|нн|вш|ющ|щ)))$')
+_VERB = re.compile(r'((ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт|ены|ить|ыть|ишь|ую|ю)'
+                   r'|((?<=[ая])(ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)))$')
+_NOUN = re.compile(r'(а|ев|ов|ие|ье|е|иями|ями|ами|еи|ии|и|ией|ей|ой|ий|й|иям|ям|ием|ем|ам|ом|о|у|ах|иях|ях|ы|ь|ию|ью|ю|ия|ья|я)$')
+_RV = re.compile(r'^(.*?[аеиоуыэюя])(.*)$')
+_DERIVATIONAL = re.compile(r'.*[^аеиоуыэюя]+[аеиоуыэюя]+[^аеиоуыэюя]+[аеиоуыэюя]+.*ость?$')
+_DERIVATIONAL_SUFFIX = re.compile(r'ость?$')
+_SUPERLATIVE = re.compile(r'(ейше|ейш)$')
+
+
+def stem(word: str) -> str:
+    """Основа слова: русские слова — стеммером Портера, латиница — без окончания -s"""
+    if word[0] < 'а':
+        return word[:-1] if len(word) > 3 and word.endswith('s') and not word.endswith('ss') else word
+    match = _RV.match(word)
+    if not match:
+        return word
+    prefix, rv = match.groups()
+    result = _PERFECTIVE_GERUND.sub('', rv, 1)
+    if result == rv:
+        rv = _REFLEXIVE.sub('', rv, 1)
+        result = _ADJECTIVE.sub('', rv, 1)
+        if result != rv:
+            rv = _PARTICIPLE.sub('', result, 1)
+        else:
+            result = _VERB.sub('', rv, 1)
+            rv = _NOUN.sub('', rv, 1) if result == rv else result
+    else:
+        rv = result
+    if rv.endswith('и'):
+        rv = rv[:-1]
+    if _DERIVATIONAL.match(rv):
+        rv = _DERIVATIONAL_SUFFIX.sub('', rv, 1)
+    if rv.endswith('ь'):
+        rv = rv[:-1]
+    else:
+        rv = _SUPERLATIVE.sub('', rv, 1)
+        if rv.endswith('нн'):
+            rv = rv[:-1]
+    return prefix + rv
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    """Основы значимых слов текста"""
+    if not text:
+        return []
+    words = _WORD.findall(text.lower().replace('ё', 'е'))
+    return [stem(word)[:MAX_TERM_LENGTH] for word in words
+            if len(word) > 2 and word not in STOP_WORDS and not word.isdigit()]
+
+
+def normalize(weights: Dict[str, float]) -> Dict[str, float]:
+    """Вектор единичной длины"""
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    return {term: weight / norm for term, weight in weights.items()} if norm else {}
+
+
+def profile_vector(hobbies: Optional[str] = None, about: Optional[str] = None,
+                   job: Optional[str] = None) -> Dict[str, float]:
+    """Разреженный вектор интересов по тексту профиля"""
+    weights: Dict[str, float] = {}
+    for field, text in (('hobbies', hobbies), ('about', about), ('job', job)):
+        for term, count in Counter(tokenize(text)).items():
+            weights[term] = weights.get(term, 0.0) + FIELD_WEIGHTS[field] * (1 + math.log(count))
+    if len(weights) > MAX_TERMS:
+        weights = dict(sorted(weights.items(), key=lambda item: -item[1])[:MAX_TERMS])
+    return normalize(weights)
+
+
+def _rows(user_id: int, vector: Dict[str, float]) -> List[Dict]:
+    return [{'user_id': user_id, 'term': term, 'weight': weight} for term, weight in vector.items()]
+
+
+async def index_profile(session, user) -> Dict[str, float]:
+    """Пересчитывает вектор пользователя; коммит остается за вызывающим"""
+    vector = profile_vector(user.hobbies, user.about, user.job)
+    await session.execute(delete(InterestTerm).filter(InterestTerm.user_id == user.id))
+    if vector:
+        await session.execute(insert(InterestTerm), _rows(user.id, vector))
+    return vector
+
+
+async def load_vectors(session, user_ids: Sequence[int]) -> Dict[int, Dict[str, float]]:
+    """Сохраненные векторы пользователей одним запросом"""
+    vectors: Dict[int, Dict[str, float]] = {}
+    rows = await session.execute(
+        select(InterestTerm.user_id, InterestTerm.term, InterestTerm.weight)
+        .filter(InterestTerm.user_id.in_(user_ids)))
+    for user_id, term, weight in rows:
+        vectors.setdefault(user_id, {})[term] = weight
+    return vectors
+
+
+def idf(document_frequency: int, documents: int) -> float:
+    return math.log((1 + documents) / (1 + document_frequency)) + 1
+
+
+def weight_by_idf(vectors: List[Dict[str, float]]) -> List[Dict[str, float]]:
+    """Векторы с весами IDF по этому же набору (например, участникам недели)"""
+    frequencies = Counter(term for vector in vectors for term in vector)
+    return [normalize({term: weight * idf(frequencies[term], len(vectors)) for term, weight in vector.items()})
+            for vector in vectors]
+
+
+async def similar_users(session, user_id: int, k: int = 10,
+                        candidates: Optional[Iterable[int]] = None) -> List[Tuple[int, float]]:
+    """Top-k пользователей с самыми похожими интересами: [(user_id, score)].
+
+    candidates ограничивает поиск, например участниками недели.
+    """
+    vector = (await load_vectors(session, [user_id])).get(user_id)
+    if not vector:
+        return []
+    documents = await session.scalar(select(func.count(func.distinct(InterestTerm.user_id))))
+    frequencies = dict((await session.execute(
+        select(InterestTerm.term, func.count())
+        .filter(InterestTerm.term.in_(list(vector)))
+        .group_by(InterestTerm.term))).all())
+    # Общий термин весит больше, если он редкий
+    term_weights = {term: weight * idf(frequencies.get(term, 1), documents) ** 2
+                    for term, weight in vector.items()}
+
+    score = func.sum(InterestTerm.weight * case(term_weights, value=InterestTerm.term, else_=0.0))
+    query = (select(InterestTerm.user_id, score.label('score'))
+             .filter(InterestTerm.term.in_(list(vector)), InterestTerm.user_id != user_id)
+             .group_by(InterestTerm.user_id)
+             .order_by(score.desc(), InterestTerm.user_id)
+             .limit(k))
+    if candidates is not None:
+        query = query.filter(InterestTerm.user_id.in_(list(candidates)))
+    return [(row.user_id, row.score) for row in await session.execute(query)]
+
+
+def rebuild_index(connection, batch_size: int = 1000) -> int:
+    """Пересчитывает векторы всех пользователей (синхронное соединение)"""
+    indexed = 0
+    last_id = 0
+    while True:
+        users = connection.execute(
+            select(User.id, User.hobbies, User.about, User.job)
+            .filter(User.id > last_id)
+            .order_by(User.id)
+            .limit(batch_size)).all()
+        if not users:
+            return indexed
+        last_id = users[-1].id
+        rows = [row for user in users
+                for row in _rows(user.id, profile_vector(user.hobbies, user.about, user.job))]
+        connection.execute(delete(InterestTerm).filter(
+            InterestTerm.user_id.in_([user.id for user in users])))
+        if rows:
+            connection.execute(insert(InterestTerm), rows)
+        indexed += len(users)
+
+
+async def _show_similar(database_url: str, user_id: int, k: int):
+    engine = create_async_db_engine(database_url)
+    try:
+        async with AsyncSession(engine) as session:
+            for similar_id, score in await similar_users(session, user_id, k):
+                print(f"{similar_id:>10} {score:.3f}")
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL', 'sqlite:///random_coffee.db'))
+    parser.add_argument('--rebuild', action='store_true', help='пересчитать векторы всех пользователей')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--similar', type=int, metavar='USER_ID',
+                        help='показать похожих пользователей (id из таблицы users)')
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.rebuild:
+        engine = create_db_engine(args.database_url)
+        try:
+            with engine.begin() as connection:
+                print(f"Проиндексировано пользователей: {rebuild_index(connection, args.batch_size)}")
+        finally:
+            engine.dispose()
+    if args.similar is not None:
+        asyncio.run(_show_similar(args.database_url, args.similar, args.k))
+
+
+if __name__ == '__main__':
+    main()
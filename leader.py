@@ -0,0 +1,232 @@
+"""Выбор лидера через аренду в базе данных.
+
+Реплик бота может быть сколько угодно: обновления обрабатывают все, а задачи
+планировщика (опрос, распределение пар, пересчет счетчиков) выполняет только
+держатель аренды. Аренда — строка leader_leases, которую захватывают
+compare-and-set обновлением:
+
+    UPDATE leader_leases SET holder_id = :me, expires_at = :now + ttl
+    WHERE name = :name AND (holder_id = :me OR expires_at < :now)
+
+Это работает одинаково на PostgreSQL и SQLite. Лидер продлевает аренду
+каждые LEADER_RENEW_INTERVAL секунд; если он упал, другая реплика захватит
+аренду не позже чем через LEADER_LEASE_TTL. Лидер, который не смог продлить
+аренду, перестает считать себя лидером раньше, чем она истечет для других.
+
+Успешные запуски задач leader_only записываются в scheduled_job_runs. Если
+срабатывание задачи пришлось на время без лидера (реплики перезапускались,
+аренда истекла), новый лидер при получении аренды запускает ее один раз.
+"""
+import asyncio
+import functools
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+from sqlalchemy import case, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from database import LeaderLease, ScheduledJobRun, job_run_upsert
+
+logger = logging.getLogger(__name__)
+
+# Время жизни аренды (секунды): за это время реплики переживают падение лидера
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', '30'))
+
+# Как часто продлевать аренду и пытаться ее захватить (секунды)
+LEADER_RENEW_INTERVAL = float(os.getenv('LEADER_RENEW_INTERVAL', str(LEADER_LEASE_TTL / 3)))
+
+
+class LeaderElection:
+    """Аренда лидерства с периодическим продлением"""
+
+    def __init__(self, session_factory, instance_id: str, name: str = 'scheduler',
+                 ttl: float = LEADER_LEASE_TTL, renew_interval: float = LEADER_RENEW_INTERVAL):
+        if renew_interval >= ttl:
+            raise ValueError("Leader lease must be renewed more often than it expires")
+        self.session_factory = session_factory
+        self.instance_id = instance_id
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        # Лидерство считается действующим до этого момента (time.monotonic)
+        self._leader_until = 0.0
+        self._was_leader = False
+        self._task = None
+        self._scheduler = None
+        self._catch_up_task = None
+        self.elections = 0
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._leader_until
+
+    async def _acquire(self, session, now: datetime) -> bool:
+        expires_at = now + timedelta(seconds=self.ttl)
+        result = await session.execute(
+            update(LeaderLease)
+            .where(LeaderLease.name == self.name,
+                   or_(LeaderLease.holder_id == self.instance_id,
+                       LeaderLease.expires_at < now))
+            .values(holder_id=self.instance_id,
+                    expires_at=expires_at,
+                    acquired_at=case((LeaderLease.holder_id == self.instance_id,
+                                      LeaderLease.acquired_at), else_=now)))
+        if result.rowcount == 1:
+            await session.commit()
+            return True
+
+        if await session.scalar(select(LeaderLease.name).where(LeaderLease.name == self.name)):
+            await session.rollback()
+            return False
+
+        # Аренды еще нет: первая реплика создает строку, остальные получат IntegrityError
+        session.add(LeaderLease(name=self.name, holder_id=self.instance_id,
+                                expires_at=expires_at, acquired_at=now))
+        try:
+            await session.commit()
+            return True
+        except IntegrityError:
+            await session.rollback()
+            return False
+
+    async def try_acquire(self) -> bool:
+        """Один раунд захвата или продления аренды"""
+        started = time.monotonic()
+        session = self.session_factory()
+        try:
+            if await self._acquire(session, datetime.utcnow()):
+                # Запас в один интервал продления: лидер слагает полномочия
+                # раньше, чем аренда истечет для остальных реплик
+                self._leader_until = started + self.ttl - self.renew_interval
+            else:
+                self._leader_until = 0.0
+        except Exception as e:
+            # Без связи с базой лидерство доживает до своего срока
+            logger.error(f"Error renewing leader lease: {e}")
+        finally:
+            await session.close()
+
+        leader = self.is_leader
+        if leader != self._was_leader:
+            if leader:
+                self.elections += 1
+                logger.info(f"Instance {self.instance_id} became the leader")
+                self._schedule_catch_up()
+            else:
+                logger.warning(f"Instance {self.instance_id} lost leadership")
+            self._was_leader = leader
+        return leader
+
+    async def release(self):
+        """Отдает аренду, чтобы другая реплика стала лидером без ожидания TTL"""
+        self._leader_until = 0.0
+        self._was_leader = False
+        session = self.session_factory()
+        try:
+            await session.execute(
+                update(LeaderLease)
+                .where(LeaderLease.name == self.name,
+                       LeaderLease.holder_id == self.instance_id)
+                .values(expires_at=datetime.utcnow()))
+            await session.commit()
+        except Exception as e:
+            logger.error(f"Error releasing leader lease: {e}")
+        finally:
+            await session.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            await self.try_acquire()
+
+    def start(self):
+        """Запускает периодическое продление аренды (первый раунд — try_acquire)"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Останавливает продление и отдает аренду"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.release()
+
+    def leader_only(self, job):
+        """Оборачивает задачу планировщика: на не-лидере она пропускается"""
+        @functools.wraps(job)
+        async def wrapper(*args, **kwargs):
+            if not self.is_leader:
+                logger.info(f"Skipping {job.__name__}: instance is not the leader")
+                return None
+            result = await job(*args, **kwargs)
+            await self._record_run(job.__name__)
+            return result
+        wrapper.leader_job = job.__name__
+        return wrapper
+
+    async def _record_run(self, name: str):
+        session = self.session_factory()
+        try:
+            await session.execute(job_run_upsert(
+                session.bind.dialect.name, {'name': name, 'last_run_at': datetime.utcnow()}))
+            await session.commit()
+        except Exception as e:
+            logger.error(f"Error recording run of {name}: {e}")
+        finally:
+            await session.close()
+
+    def attach(self, scheduler):
+        """Задачи leader_only планировщика догоняются при получении лидерства"""
+        self._scheduler = scheduler
+        if self.is_leader:
+            self._schedule_catch_up()
+
+    def _schedule_catch_up(self):
+        if self._scheduler is not None and (
+                self._catch_up_task is None or self._catch_up_task.done()):
+            self._catch_up_task = asyncio.ensure_future(self.catch_up())
+
+    async def catch_up(self) -> List[str]:
+        """Запускает задачи, чье срабатывание после их последнего запуска пропущено"""
+        jobs = [job for job in self._scheduler.get_jobs() if getattr(job.func, 'leader_job', None)]
+        if not jobs:
+            return []
+        session = self.session_factory()
+        try:
+            last_runs = dict((await session.execute(
+                select(ScheduledJobRun.name, ScheduledJobRun.last_run_at)
+                .filter(ScheduledJobRun.name.in_([job.func.leader_job for job in jobs])))).all())
+        except Exception as e:
+            logger.error(f"Error loading scheduled job runs: {e}")
+            return []
+        finally:
+            await session.close()
+
+        now = datetime.now(timezone.utc)
+        caught_up = []
+        for job in jobs:
+            last_run = last_runs.get(job.func.leader_job)
+            if last_run is None:
+                # Задача еще ни разу не выполнялась: пропускать нечего
+                continue
+            due = job.trigger.get_next_fire_time(
+                None, last_run.replace(tzinfo=timezone.utc) + timedelta(seconds=1))
+            # Срабатывание в пределах misfire_grace_time планировщик выполнит сам
+            if due is None or due > now - timedelta(seconds=job.misfire_grace_time or 1):
+                continue
+            if not self.is_leader:
+                break
+            logger.warning(f"Catching up {job.func.leader_job} missed at {due.isoformat()}")
+            try:
+                await job.func(*job.args, **job.kwargs)
+                caught_up.append(job.func.leader_job)
+            except Exception as e:
+                logger.error(f"Error catching up {job.func.leader_job}: {e}")
+        return caught_up
@@ -0,0 +1,383 @@
+"""Метрики обработчиков, задач, запросов к базе и вызовов Bot API.
+
+Метрики отдаются в текстовом формате Prometheus по GET /metrics на
+METRICS_LISTEN:METRICS_PORT (сервер не запускается, если порт не задан);
+там же GET /health для балансировщика и проверок платформы:
+
+    bot_handler_duration_seconds     время обработчика (handler, update_type)
+    bot_handler_calls_total          вызовы обработчика по status (ok/error)
+    bot_handler_in_flight            обработчики, выполняющиеся сейчас
+    bot_job_duration_seconds         то же для задач планировщика (job)
+    bot_job_runs_total
+    bot_job_in_flight
+    bot_db_statements_total          SQL-запросы (handler, update_type)
+    bot_telegram_api_calls_total     вызовы Bot API (handler, update_type, method)
+    bot_db_pool_*                    состояние пула соединений (db_pool.py)
+
+Запросы к базе и вызовы Bot API относятся к обработчику или задаче, внутри
+которых выполнены; вне их handler="none". Обертки также открывают область
+профилирования SQL (sql_profiler.py).
+"""
+import contextvars
+import functools
+import logging
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+from sqlalchemy.engine import Engine
+from telegram import Update
+from telegram.ext import ConversationHandler
+from telegram.request import HTTPXRequest
+
+from db_pool import pool_metrics
+from sql_profiler import profile_scope
+
+logger = logging.getLogger(__name__)
+
+# Порт сервера метрик; пусто — сервер не запускается
+METRICS_PORT = int(os.getenv('METRICS_PORT') or 0)
+
+# Метрики доступны только локально, наружу их отдает агент
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+
+METRICS_PATH = '/metrics'
+HEALTH_PATH = '/health'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы гистограмм (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+NO_HANDLER = ('none', 'none')
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+        # Счетчики SQL обновляются из потоков синхронных движков
+        self._lock = threading.Lock()
+
+    def samples(self) -> Dict[tuple, object]:
+        """Значения по наборам меток"""
+        with self._lock:
+            return dict(self._values)
+
+    def _header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, *labels, value: float):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Счетчики по корзинам, сумма и количество
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, *labels) -> int:
+        entry = self._values.get(labels)
+        return entry[2] if entry else 0
+
+    def render(self) -> List[str]:
+        lines = self._header()
+        with self._lock:
+            items = sorted((labels, [list(counts), total, count])
+                           for labels, (counts, total, count) in self._values.items())
+        names = self.labelnames + ('le',)
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (_format_value(bound),))} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Метрики процесса и функции, собирающие значения при чтении"""
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[_Metric]]] = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=(),
+                  buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], Iterable[_Metric]]):
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Общий реестр процесса
+registry = MetricsRegistry()
+
+handler_duration = registry.histogram(
+    'bot_handler_duration_seconds', 'Update handler latency', ('handler', 'update_type'))
+handler_calls = registry.counter(
+    'bot_handler_calls_total', 'Update handler calls', ('handler', 'update_type', 'status'))
+handler_in_flight = registry.gauge(
+    'bot_handler_in_flight', 'Update handlers currently running', ('handler',))
+job_duration = registry.histogram(
+    'bot_job_duration_seconds', 'Scheduled job latency', ('job',))
+job_runs = registry.counter(
+    'bot_job_runs_total', 'Scheduled job runs', ('job', 'status'))
+job_in_flight = registry.gauge(
+    'bot_job_in_flight', 'Scheduled jobs currently running', ('job',))
+db_statements = registry.counter(
+    'bot_db_statements_total', 'SQL statements executed', ('handler', 'update_type'))
+telegram_api_calls = registry.counter(
+    'bot_telegram_api_calls_total', 'Telegram Bot API calls',
+    ('handler', 'update_type', 'method'))
+
+
+def _pool_metrics():
+    snapshot = pool_metrics.snapshot()
+    for name, key, documentation in (
+            ('bot_db_pool_size', 'size', 'Connections held by the pool'),
+            ('bot_db_pool_checked_out', 'checked_out', 'Connections in use'),
+            ('bot_db_pool_overflow', 'overflow', 'Overflow connections open')):
+        gauge = Gauge(name, documentation)
+        gauge.set(value=snapshot[key])
+        yield gauge
+    for name, key, documentation in (
+            ('bot_db_pool_checkouts_total', 'checkouts', 'Connection checkouts'),
+            ('bot_db_pool_timeouts_total', 'timeouts', 'Connection checkout timeouts')):
+        counter = Counter(name, documentation)
+        counter.inc(amount=snapshot[key])
+        yield counter
+
+
+registry.add_collector(_pool_metrics)
+
+
+# Обработчик или задача, внутри которых выполняется код: (handler, update_type)
+_current = contextvars.ContextVar('metrics_handler', default=NO_HANDLER)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    db_statements.inc(*_current.get())
+
+
+def update_type(update) -> str:
+    """Тип обновления: message, callback_query, poll_answer..."""
+    if isinstance(update, Update):
+        for field in Update.ALL_TYPES:
+            if getattr(update, field, None) is not None:
+                return field
+    return 'other'
+
+
+def instrument_callback(callback, name: Optional[str] = None):
+    """Оборачивает обработчик обновлений метриками"""
+    name = name or getattr(callback, '__name__', 'handler')
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        labels = (name, update_type(update))
+        token = _current.set(labels)
+        handler_in_flight.inc(name)
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            with profile_scope(f"{name} ({labels[1]})"):
+                result = await callback(update, context)
+            status = 'ok'
+            return result
+        finally:
+            handler_duration.observe(*labels, value=time.perf_counter() - started)
+            handler_calls.inc(*labels, status)
+            handler_in_flight.dec(name)
+            _current.reset(token)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        for nested in handler.entry_points + handler.fallbacks:
+            _instrument_handler(nested)
+        for handlers in handler.states.values():
+            for nested in handlers:
+                _instrument_handler(nested)
+        return
+    callback = getattr(handler, 'callback', None)
+    if callback is not None and not getattr(callback, 'instrumented', False):
+        handler.callback = instrument_callback(callback)
+
+
+def instrument_handlers(application):
+    """Оборачивает метриками все зарегистрированные обработчики"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+
+def instrument_job(func, name: Optional[str] = None):
+    """Оборачивает задачу планировщика метриками"""
+    name = name or func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _current.set((name, 'job'))
+        job_in_flight.inc(name)
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            with profile_scope(f"job {name}"):
+                result = await func(*args, **kwargs)
+            status = 'ok'
+            return result
+        finally:
+            job_duration.observe(name, value=time.perf_counter() - started)
+            job_runs.inc(name, status)
+            job_in_flight.dec(name)
+            _current.reset(token)
+
+    return wrapper
+
+
+def instrument_scheduler(scheduler):
+    """Оборачивает метриками все задачи планировщика"""
+    for job in scheduler.get_jobs():
+        job.modify(func=instrument_job(job.func, job.name))
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, считающий вызовы Bot API по обработчикам"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        telegram_api_calls.inc(*_current.get(), url.rsplit('/', 1)[-1])
+        return await super().do_request(url, method, *args, **kwargs)
+
+
+class _MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(registry.render())
+
+
+class _HealthHandler(RequestHandler):
+    def get(self):
+        self.write({'status': 'ok'})
+
+
+_server: Optional[HTTPServer] = None
+
+
+async def start_metrics_server(port: Optional[int] = None, host: Optional[str] = None) -> Optional[int]:
+    """Запускает сервер метрик, если задан порт; возвращает порт"""
+    global _server
+    port = METRICS_PORT if port is None else port
+    if not port or _server is not None:
+        return None
+    try:
+        sockets = bind_sockets(port, host or METRICS_LISTEN)
+    except OSError as e:
+        logger.error(f"Error starting metrics server on port {port}: {e}")
+        return None
+    _server = HTTPServer(Application([(METRICS_PATH, _MetricsHandler), (HEALTH_PATH, _HealthHandler)]))
+    _server.add_sockets(sockets)
+    port = sockets[0].getsockname()[1]
+    logger.info(f"Metrics server listening on {host or METRICS_LISTEN}:{port}")
+    return port
+
+
+async def stop_metrics_server():
+    global _server
+    if _server is not None:
+        _server.stop()
+        await _server.close_all_connections()
+        _server = None
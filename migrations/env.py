@@ -1,4 +1,3 @@
-from database import Base
 from logging.config import fileConfig
 import os
 import sys
@@ -9,6 +8,7 @@ from alembic import context
 
 # Add the parent directory to Python path
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from database import Base  # noqa: E402
 
 
 # Load environment variables
@@ -20,8 +20,10 @@ config = context.config
 
 # Interpret the config file for Python logging.
 # This line sets up loggers basically.
+# schema.migrate() запускает Alembic внутри процесса бота: существующие
+# логгеры бота не отключаем
 if config.config_file_name is not None:
-    fileConfig(config.config_file_name)
+    fileConfig(config.config_file_name, disable_existing_loggers=False)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
@@ -69,7 +71,7 @@ def run_migrations_online() -> None:
     and associate a connection with the context.
 
     """
-    configuration = config.get_section(config.config_file_section)
+    configuration = config.get_section(config.config_ini_section)
     configuration["sqlalchemy.url"] = get_url()
     connectable = engine_from_config(
         configuration,
@@ -0,0 +1,57 @@
+"""add hot path indexes
+
+Revision ID: add_hot_path_indexes
+Revises: add_pair_history_table
+Create Date: 2026-10-16 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_hot_path_indexes'
+down_revision = 'add_pair_history_table'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Индексы для поиска встреч пользователя
+    op.create_index('ix_meetings_user1_id', 'meetings', ['user1_id'])
+    op.create_index('ix_meetings_user2_id', 'meetings', ['user2_id'])
+
+    # Удаляем дубликаты ответов, оставляя самый поздний, и запрещаем новые
+    op.execute("""
+        DELETE FROM poll_responses
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM poll_responses GROUP BY poll_id, user_id
+        )
+    """)
+    with op.batch_alter_table('poll_responses') as batch_op:
+        batch_op.create_unique_constraint(
+            'uq_poll_responses_poll_id_user_id', ['poll_id', 'user_id'])
+    op.create_index('ix_poll_responses_poll_id_response',
+                    'poll_responses', ['poll_id', 'response'])
+
+    # Индексы для поиска опросов
+    op.create_index('ix_weekly_polls_chat_id_created_at',
+                    'weekly_polls', ['chat_id', 'created_at'])
+    op.create_index('ix_weekly_polls_message_id',
+                    'weekly_polls', ['message_id'])
+
+    # Индекс для рейтингов пользователя
+    op.create_index('ix_ratings_to_user_id', 'ratings', ['to_user_id'])
+
+
+def downgrade():
+    op.drop_index('ix_ratings_to_user_id', table_name='ratings')
+    op.drop_index('ix_weekly_polls_message_id', table_name='weekly_polls')
+    op.drop_index('ix_weekly_polls_chat_id_created_at',
+                  table_name='weekly_polls')
+    op.drop_index('ix_poll_responses_poll_id_response',
+                  table_name='poll_responses')
+    with op.batch_alter_table('poll_responses') as batch_op:
+        batch_op.drop_constraint(
+            'uq_poll_responses_poll_id_user_id', type_='unique')
+    op.drop_index('ix_meetings_user2_id', table_name='meetings')
+    op.drop_index('ix_meetings_user1_id', table_name='meetings')
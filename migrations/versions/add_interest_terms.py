@@ -0,0 +1,35 @@
+"""add interest terms table
+
+Revision ID: add_interest_terms
+Revises: add_persistence_tables
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_interest_terms'
+down_revision = 'add_persistence_tables'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Векторы интересов пользователей (interest_index.py); заполняются
+    # командой python interest_index.py --rebuild
+    op.create_table(
+        'interest_terms',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('term', sa.String(64), nullable=False),
+        sa.Column('weight', sa.Float(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('user_id', 'term')
+    )
+    op.create_index('ix_interest_terms_term',
+                    'interest_terms', ['term', 'user_id', 'weight'])
+
+
+def downgrade():
+    op.drop_index('ix_interest_terms_term', table_name='interest_terms')
+    op.drop_table('interest_terms')
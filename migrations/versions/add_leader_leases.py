@@ -0,0 +1,31 @@
+"""add leader leases table
+
+Revision ID: add_leader_leases
+Revises: add_user_aggregates
+Create Date: 2026-10-16 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_leader_leases'
+down_revision = 'add_user_aggregates'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Аренда лидерства для задач планировщика
+    op.create_table(
+        'leader_leases',
+        sa.Column('name', sa.String(64), nullable=False),
+        sa.Column('holder_id', sa.String(36), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.Column('acquired_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('leader_leases')
@@ -0,0 +1,37 @@
+"""add pair history table
+
+Revision ID: add_pair_history_table
+Revises: update_user_fields
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_pair_history_table'
+down_revision = 'update_user_fields'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Создаем сводную таблицу истории пар
+    op.create_table(
+        'pair_history',
+        sa.Column('user_low_id', sa.Integer(), nullable=False),
+        sa.Column('user_high_id', sa.Integer(), nullable=False),
+        sa.Column('meet_count', sa.Integer(), nullable=False),
+        sa.Column('last_met_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_low_id'], ['users.id']),
+        sa.ForeignKeyConstraint(['user_high_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('user_low_id', 'user_high_id')
+    )
+    op.create_index('ix_pair_history_user_high_id',
+                    'pair_history', ['user_high_id'])
+
+
+def downgrade():
+    # Удаляем таблицу pair_history
+    op.drop_index('ix_pair_history_user_high_id', table_name='pair_history')
+    op.drop_table('pair_history')
@@ -0,0 +1,46 @@
+"""add conversation persistence tables
+
+Revision ID: add_persistence_tables
+Revises: add_leader_leases
+Create Date: 2026-10-16 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_persistence_tables'
+down_revision = 'add_leader_leases'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Состояния ConversationHandler и user_data (persistence.py)
+    op.create_table(
+        'conversation_states',
+        sa.Column('name', sa.String(64), nullable=False),
+        sa.Column('key', sa.String(128), nullable=False),
+        sa.Column('state', sa.Text(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name', 'key')
+    )
+    op.create_index('ix_conversation_states_updated_at',
+                    'conversation_states', ['updated_at'])
+
+    op.create_table(
+        'persisted_user_data',
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('data', sa.Text(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+    op.create_index('ix_persisted_user_data_updated_at',
+                    'persisted_user_data', ['updated_at'])
+
+
+def downgrade():
+    op.drop_index('ix_persisted_user_data_updated_at', table_name='persisted_user_data')
+    op.drop_table('persisted_user_data')
+    op.drop_index('ix_conversation_states_updated_at', table_name='conversation_states')
+    op.drop_table('conversation_states')
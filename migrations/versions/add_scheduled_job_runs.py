@@ -0,0 +1,29 @@
+"""add scheduled job runs table
+
+Revision ID: add_scheduled_job_runs
+Revises: add_interest_terms
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_scheduled_job_runs'
+down_revision = 'add_interest_terms'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Последние успешные запуски задач лидера: новый лидер догоняет пропущенные
+    op.create_table(
+        'scheduled_job_runs',
+        sa.Column('name', sa.String(128), nullable=False),
+        sa.Column('last_run_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('scheduled_job_runs')
@@ -0,0 +1,31 @@
+"""add telegram poll id
+
+Revision ID: add_telegram_poll_id
+Revises: add_hot_path_indexes
+Create Date: 2026-10-16 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_telegram_poll_id'
+down_revision = 'add_hot_path_indexes'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Настоящий poll.id от Telegram, по которому приходят ответы
+    with op.batch_alter_table('weekly_polls') as batch_op:
+        batch_op.add_column(
+            sa.Column('telegram_poll_id', sa.String(64), nullable=True))
+        batch_op.create_unique_constraint(
+            'uq_weekly_polls_telegram_poll_id', ['telegram_poll_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('weekly_polls') as batch_op:
+        batch_op.drop_constraint(
+            'uq_weekly_polls_telegram_poll_id', type_='unique')
+        batch_op.drop_column('telegram_poll_id')
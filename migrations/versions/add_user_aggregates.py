@@ -0,0 +1,44 @@
+"""add user aggregates
+
+Revision ID: add_user_aggregates
+Revises: add_telegram_poll_id
+Create Date: 2026-10-16 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'add_user_aggregates'
+down_revision = 'add_telegram_poll_id'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Денормализованные счетчики для /stats
+    op.add_column('users', sa.Column('completed_meetings',
+                  sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('users', sa.Column('rating_sum',
+                  sa.Float(), nullable=False, server_default='0.0'))
+    op.add_column('users', sa.Column('rating_count',
+                  sa.Integer(), nullable=False, server_default='0'))
+
+    # Заполняем счетчики по существующим встречам и оценкам
+    op.execute("""
+        UPDATE users SET
+            total_meetings = (SELECT COUNT(*) FROM meetings
+                              WHERE meetings.user1_id = users.id OR meetings.user2_id = users.id),
+            completed_meetings = (SELECT COUNT(*) FROM meetings
+                                  WHERE (meetings.user1_id = users.id OR meetings.user2_id = users.id)
+                                  AND meetings.status = 'completed'),
+            rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM ratings WHERE ratings.to_user_id = users.id),
+            rating_count = (SELECT COUNT(rating) FROM ratings WHERE ratings.to_user_id = users.id),
+            average_rating = (SELECT COALESCE(AVG(rating), 0) FROM ratings WHERE ratings.to_user_id = users.id)
+    """)
+
+
+def downgrade():
+    op.drop_column('users', 'rating_count')
+    op.drop_column('users', 'rating_sum')
+    op.drop_column('users', 'completed_meetings')
@@ -0,0 +1,260 @@
+"""Движок распределения пар для Random Coffee.
+
+Пары строятся приближенно, а не как паросочетание минимальной стоимости.
+Стоимость пары — штраф за повторную встречу (сколько раз люди уже
+встречались и как давно). История обычно разреженная: у каждого участника
+k прошлых собеседников при n участниках, k << n, поэтому почти все пары
+новые. Точное взвешенное паросочетание (Blossom) на полном графе из 10k+
+участников — O(n³) и миллионы рёбер, поэтому алгоритм работает за O(n·k):
+
+1. Жадно строим паросочетание из новых пар (стоимость 0), обходя свободных
+   участников по связному списку — на каждого уходит не больше deg + 1 проверок.
+2. Ищем увеличивающие пути длины 3 (u - a = b - w) и переставляем пары:
+   проход по парам стоит O(n + рёбер истории), проходы повторяются, пока
+   находятся пути.
+3. Оставшихся участников (они уже встречались со всеми свободными) сводим
+   жадно: каждому — самого "дешевого" из оставшихся.
+4. Нечетного участника добавляем в ту пару, где он даст наименьший штраф.
+
+Ограничения приближения:
+
+* паросочетание без увеличивающих путей длины 1 и 3 содержит не меньше 2/3
+  максимального числа новых пар; пути длины 5 и больше не ищутся, поэтому
+  повторных встреч может оказаться больше, чем в оптимуме;
+* шаги 1–2 не различают прошлые встречи по числу и давности: это учитывается
+  только при сведении оставшихся (шаг 3) и выборе пары для нечетного (шаг 4),
+  и выбор там тоже жадный.
+"""
+import random
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import select
+
+from database import PairHistory, chunked, pair_history_upsert
+
+# Штраф за каждую прошлую встречу пары
+REPEAT_PENALTY = 1.0
+
+# Дополнительный штраф за недавнюю встречу: 1 / (1 + недель с последней встречи)
+RECENCY_PENALTY = 1.0
+
+History = Dict[int, Dict[int, float]]
+
+
+def pair_cost(times_met: int, last_met_at: Optional[datetime], now: Optional[datetime] = None) -> float:
+    """Стоимость повторной встречи пары"""
+    if not times_met:
+        return 0.0
+    cost = REPEAT_PENALTY * times_met
+    if last_met_at is not None:
+        now = now or datetime.utcnow()
+        weeks = max((now - last_met_at).days, 0) / 7
+        cost += RECENCY_PENALTY / (1 + weeks)
+    return cost
+
+
+def build_history(meetings: Iterable, now: Optional[datetime] = None) -> History:
+    """Строит граф стоимостей из встреч (объектов с user1_id, user2_id, created_at)"""
+    stats: Dict[Tuple[int, int], list] = {}
+    for meeting in meetings:
+        key = (min(meeting.user1_id, meeting.user2_id),
+               max(meeting.user1_id, meeting.user2_id))
+        entry = stats.setdefault(key, [0, None])
+        entry[0] += 1
+        created_at = getattr(meeting, 'created_at', None)
+        if created_at is not None and (entry[1] is None or created_at > entry[1]):
+            entry[1] = created_at
+
+    history: History = {}
+    for (user1, user2), (times_met, last_met_at) in stats.items():
+        cost = pair_cost(times_met, last_met_at, now)
+        history.setdefault(user1, {})[user2] = cost
+        history.setdefault(user2, {})[user1] = cost
+    return history
+
+
+def build_pair_history(rows: Iterable, now: Optional[datetime] = None) -> History:
+    """Строит граф стоимостей из строк pair_history (user_low_id, user_high_id, meet_count, last_met_at)"""
+    history: History = {}
+    for row in rows:
+        cost = pair_cost(row.meet_count, row.last_met_at, now)
+        history.setdefault(row.user_low_id, {})[row.user_high_id] = cost
+        history.setdefault(row.user_high_id, {})[row.user_low_id] = cost
+    return history
+
+
+async def load_pair_history(session, user_ids: Sequence[int], now: Optional[datetime] = None) -> History:
+    """История встреч между участниками.
+
+    Список участников в IN разбит на части (database.SQL_CHUNK): по каждой
+    части запрашиваются строки с ней в user_low_id, второй участник
+    отбирается уже здесь.
+    """
+    participants = set(user_ids)
+    rows = []
+    for chunk in chunked(sorted(participants)):
+        rows.extend(row for row in (await session.execute(
+            select(PairHistory.user_low_id, PairHistory.user_high_id,
+                   PairHistory.meet_count, PairHistory.last_met_at)
+            .filter(PairHistory.user_low_id.in_(chunk)))).all()
+            if row.user_high_id in participants)
+    return build_pair_history(rows, now)
+
+
+async def record_pair_history(session, meet_counts: Dict[Tuple[int, int], int], met_at: datetime):
+    """Добавляет встречи пар (user_low_id, user_high_id) -> число в pair_history (без commit)"""
+    rows = [{'user_low_id': low, 'user_high_id': high, 'meet_count': count, 'last_met_at': met_at}
+            for (low, high), count in meet_counts.items()]
+    for chunk in chunked(rows):
+        await session.execute(pair_history_upsert(session.bind.dialect.name, chunk))
+
+
+def _cost(history: History, user1: int, user2: int) -> float:
+    return history.get(user1, {}).get(user2, 0.0)
+
+
+def _greedy_zero_cost(order: Sequence[int], history: History) -> Tuple[Dict[int, int], List[int]]:
+    """Жадное паросочетание по рёбрам нулевой стоимости"""
+    # Двусвязный список свободных участников: удаление за O(1)
+    next_free = {user: order[i + 1] if i + 1 < len(order) else None
+                 for i, user in enumerate(order)}
+    prev_free = {user: order[i - 1] if i > 0 else None
+                 for i, user in enumerate(order)}
+    head = order[0] if order else None
+
+    def unlink(user):
+        nonlocal head
+        prev_user, next_user = prev_free[user], next_free[user]
+        if prev_user is None:
+            head = next_user
+        else:
+            next_free[prev_user] = next_user
+        if next_user is not None:
+            prev_free[next_user] = prev_user
+
+    mate: Dict[int, int] = {}
+    leftovers: List[int] = []
+    for user in order:
+        if user in mate:
+            continue
+        unlink(user)
+        met = history.get(user, {})
+        candidate = head
+        while candidate is not None and met.get(candidate, 0.0) > 0:
+            candidate = next_free[candidate]
+        if candidate is None:
+            leftovers.append(user)
+            continue
+        unlink(candidate)
+        mate[user] = candidate
+        mate[candidate] = user
+    return mate, leftovers
+
+
+def _augment(mate: Dict[int, int], leftovers: List[int], history: History, order: Sequence[int]) -> List[int]:
+    """Увеличивающие пути длины 3: u - a = b - w превращаем в u = a, b = w.
+
+    Для каждой пары (a, b) первого свободного участника, с которым a не
+    встречался, ищем проходом по списку свободных: проход останавливается на
+    первом подходящем, поэтому стоит не больше числа прошлых собеседников a
+    среди свободных плюс один. Полный проход по парам — O(n + рёбер истории).
+    """
+    free = list(leftovers)
+    position = {user: i for i, user in enumerate(free)}
+
+    def take(user):
+        i = position.pop(user)
+        last = free.pop()
+        if last != user:
+            free[i] = last
+            position[last] = i
+
+    def first_free(met, skip=None):
+        for user in free:
+            if user != skip and met.get(user, 0.0) <= 0:
+                return user
+        return None
+
+    changed = True
+    while changed and len(free) >= 2:
+        changed = False
+        # Каждая пара встречается в order дважды — проверяются обе ориентации
+        for partner in order:
+            mate_partner = mate.get(partner)
+            if mate_partner is None or len(free) < 2:
+                continue
+            met_partner = history.get(partner, {})
+            met_mate = history.get(mate_partner, {})
+            user = first_free(met_partner)
+            if user is None:
+                continue
+            other = first_free(met_mate, skip=user)
+            if other is None:
+                # Возможно, mate_partner подходит только user: пробуем наоборот
+                other = first_free(met_mate)
+                user = first_free(met_partner, skip=other) if other is not None else None
+                if user is None:
+                    continue
+            mate[user], mate[partner] = partner, user
+            mate[mate_partner], mate[other] = other, mate_partner
+            take(user)
+            take(other)
+            changed = True
+    return free
+
+
+def create_pairs(user_ids: Sequence[int], meeting_history: History, rng: Optional[random.Random] = None) -> List[tuple]:
+    """Создает пары пользователей, избегая повторных встреч (приближенно, см. модуль).
+
+    meeting_history: {user_id: {partner_id: стоимость}} — см. build_history.
+    Возвращает список кортежей; при нечетном числе участников один кортеж
+    содержит троих.
+    """
+    order = list(dict.fromkeys(user_ids))
+    (rng or random).shuffle(order)
+    if len(order) < 2:
+        return [tuple(order)] if order else []
+
+    mate, leftovers = _greedy_zero_cost(order, meeting_history)
+    leftovers = _augment(mate, leftovers, meeting_history, order)
+
+    # Остальные уже встречались со всеми свободными: каждому — самого "дешевого"
+    # из оставшихся. Без сортировки всех L² пар: при плотной истории она дороже всего
+    remaining = set(leftovers)
+    for user in leftovers:
+        if user not in remaining:
+            continue
+        remaining.discard(user)
+        if not remaining:
+            break
+        met = meeting_history.get(user, {})
+        partner = min(remaining, key=lambda other: met.get(other, 0.0))
+        remaining.discard(partner)
+        mate[user], mate[partner] = partner, user
+
+    pairs = []
+    seen = set()
+    for user in order:
+        if user in mate and user not in seen:
+            pairs.append((user, mate[user]))
+            seen.update((user, mate[user]))
+
+    # Нечетный участник присоединяется к паре с наименьшим штрафом
+    odd = [user for user in order if user not in mate]
+    for user in odd:
+        best = min(range(len(pairs)), key=lambda i: sum(
+            _cost(meeting_history, user, member) for member in pairs[i]))
+        pairs[best] = pairs[best] + (user,)
+    return pairs
+
+
+def count_repeats(pairs: Iterable[tuple], meeting_history: History) -> int:
+    """Количество пар внутри групп, которые уже встречались"""
+    repeats = 0
+    for group in pairs:
+        for i in range(len(group)):
+            for j in range(i + 1, len(group)):
+                if _cost(meeting_history, group[i], group[j]) > 0:
+                    repeats += 1
+    return repeats
@@ -0,0 +1,339 @@
+"""Хранение состояний разговоров и user_data в базе данных.
+
+ConversationHandler регистрации и настроек держит состояние и черновик
+профиля (context.user_data) в памяти процесса: перезапуск терял начатые
+регистрации, а брошенные разговоры копились. DatabasePersistence хранит их
+в таблицах conversation_states и persisted_user_data:
+
+* запись пачками: PTB раз в PERSISTENCE_INTERVAL секунд передает все
+  изменения, и они пишутся одной транзакцией; неизменившиеся user_data
+  не пишутся;
+* ленивая загрузка: user_data пользователя читается из базы при первом его
+  обновлении в этом процессе, а не целиком при старте;
+* TTL: разговоры и user_data без активности дольше CONVERSATION_TTL
+  удаляются из памяти и базы (expire), поэтому память ограничена числом
+  активных пользователей.
+
+Состояния разговоров ConversationHandler загружает при старте, а разговоры,
+которых нет в памяти процесса, conversation_reloader подгружает из базы
+перед обработкой обновления: разговор, начатый на одной реплике или воркере,
+продолжается на другой. Изменения попадают в базу раз в PERSISTENCE_INTERVAL
+секунд, и разговор, уже загруженный в процесс, из базы не перечитывается,
+поэтому один чат в каждый момент должен обслуживать один процесс — это
+обеспечивает sharding.py.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import and_, delete, or_, select
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput, TypeHandler
+
+from database import (ConversationState, PersistedUserData, conversation_state_upsert,
+                      user_data_upsert)
+
+logger = logging.getLogger(__name__)
+
+# Время жизни брошенного разговора и user_data (секунды)
+CONVERSATION_TTL = float(os.getenv('CONVERSATION_TTL', str(24 * 60 * 60)))
+
+# Как часто PTB передает изменения в хранилище (секунды)
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '10'))
+
+# Строк в одном INSERT
+WRITE_CHUNK = 500
+
+
+def _encode_value(value):
+    # user_data хранит дату рождения как datetime
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode_value(obj: Dict):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__date__' in obj:
+        return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+def dumps(value) -> str:
+    return json.dumps(value, default=_encode_value, sort_keys=True, ensure_ascii=False)
+
+
+def loads(text: str):
+    return json.loads(text, object_hook=_decode_value)
+
+
+class DatabasePersistence(BasePersistence):
+    """BasePersistence поверх conversation_states и persisted_user_data"""
+
+    def __init__(self, session_factory, ttl: float = CONVERSATION_TTL,
+                 update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False,
+                                        user_data=True, callback_data=False),
+            update_interval=update_interval)
+        self.session_factory = session_factory
+        self.ttl = ttl
+        # Пользователи, загруженные в этот процесс: время обращения и последний записанный JSON
+        self._users: Dict[int, Tuple[float, Optional[str]]] = {}
+        # Изменения до записи: None означает удаление
+        self._pending_users: Dict[int, Optional[str]] = {}
+        self._pending_conversations: Dict[Tuple[str, str], Optional[str]] = {}
+        self._batch: Optional[asyncio.Future] = None
+        # Пользователи, выгружаемые из памяти по TTL: их строки удаляет expire
+        self._evicting = set()
+        self.loads = 0
+        self.writes = 0
+        self.batches = 0
+        self.expired = 0
+        self.conversation_loads = 0
+
+    # Данные, которые бот не хранит
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    # user_data
+
+    async def get_user_data(self):
+        """При старте ничего не загружаем: см. refresh_user_data"""
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        """Загружает user_data при первом обращении пользователя"""
+        entry = self._users.get(user_id)
+        if entry is not None:
+            self._users[user_id] = (time.monotonic(), entry[1])
+            return
+
+        session = self.session_factory()
+        try:
+            stored = await session.scalar(select(PersistedUserData.data).filter(
+                PersistedUserData.user_id == user_id))
+        finally:
+            await session.close()
+        self.loads += 1
+        if stored is not None:
+            user_data.update(loads(stored))
+        self._users[user_id] = (time.monotonic(), stored)
+
+    async def update_user_data(self, user_id: int, data: Dict):
+        _, written = self._users.get(user_id, (None, None))
+        encoded = dumps(data) if data else None
+        if encoded == written:
+            return
+        self._users[user_id] = (time.monotonic(), encoded)
+        self._pending_users[user_id] = encoded
+        await self._schedule()
+
+    async def drop_user_data(self, user_id: int):
+        self._users.pop(user_id, None)
+        if user_id in self._evicting:
+            # Строка могла обновиться на другой реплике, ее срок проверит expire
+            self._evicting.discard(user_id)
+            return
+        self._pending_users[user_id] = None
+        await self._schedule()
+
+    # Состояния разговоров
+
+    async def get_conversations(self, name: str) -> Dict:
+        """Незавершенные и не истекшие разговоры обработчика name"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        session = self.session_factory()
+        try:
+            rows = (await session.execute(
+                select(ConversationState.key, ConversationState.state)
+                .filter(ConversationState.name == name,
+                        ConversationState.updated_at >= cutoff))).all()
+        finally:
+            await session.close()
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def load_conversations(self, keys: Iterable[Tuple[str, Tuple[int, ...]]]) -> Dict:
+        """Не истекшие разговоры по списку (name, key) одним запросом"""
+        encoded = {(name, json.dumps(list(key))): (name, tuple(key)) for name, key in keys}
+        if not encoded:
+            return {}
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        session = self.session_factory()
+        try:
+            rows = (await session.execute(
+                select(ConversationState.name, ConversationState.key, ConversationState.state)
+                .filter(or_(*(and_(ConversationState.name == name, ConversationState.key == key)
+                              for name, key in encoded)),
+                        ConversationState.updated_at >= cutoff))).all()
+        finally:
+            await session.close()
+        self.conversation_loads += 1
+        return {encoded[(name, key)]: json.loads(state) for name, key, state in rows}
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]):
+        self._pending_conversations[(name, json.dumps(list(key)))] = (
+            None if new_state is None else json.dumps(new_state))
+        await self._schedule()
+
+    # Запись пачками
+
+    async def _schedule(self):
+        # PTB вызывает update_* одного прохода через asyncio.gather: первый вызов
+        # создает пачку, остальные попадают в нее же, и все ждут одной записи
+        if self._batch is None:
+            self._batch = asyncio.ensure_future(self._write_batch())
+        await asyncio.shield(self._batch)
+
+    async def _write_batch(self):
+        await asyncio.sleep(0)
+        self._batch = None
+        await self.flush()
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией"""
+        users, self._pending_users = self._pending_users, {}
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not users and not conversations:
+            return
+
+        now = datetime.utcnow()
+        session = self.session_factory()
+        try:
+            dialect_name = session.bind.dialect.name
+            user_rows = [{'user_id': user_id, 'data': data, 'updated_at': now}
+                         for user_id, data in users.items() if data is not None]
+            for start in range(0, len(user_rows), WRITE_CHUNK):
+                await session.execute(user_data_upsert(
+                    dialect_name, user_rows[start:start + WRITE_CHUNK]))
+            dropped_users = [user_id for user_id, data in users.items() if data is None]
+            if dropped_users:
+                await session.execute(delete(PersistedUserData).filter(
+                    PersistedUserData.user_id.in_(dropped_users)))
+
+            state_rows = [{'name': name, 'key': key, 'state': state, 'updated_at': now}
+                          for (name, key), state in conversations.items() if state is not None]
+            for start in range(0, len(state_rows), WRITE_CHUNK):
+                await session.execute(conversation_state_upsert(
+                    dialect_name, state_rows[start:start + WRITE_CHUNK]))
+            for name, key in (item for item, state in conversations.items() if state is None):
+                await session.execute(delete(ConversationState).filter(
+                    ConversationState.name == name, ConversationState.key == key))
+
+            await session.commit()
+            self.writes += len(users) + len(conversations)
+            self.batches += 1
+        except Exception as e:
+            # Возвращаем изменения в очередь: запишем со следующей пачкой
+            logger.error(f"Error writing persistence batch: {e}")
+            for user_id, data in users.items():
+                self._pending_users.setdefault(user_id, data)
+            for item, state in conversations.items():
+                self._pending_conversations.setdefault(item, state)
+        finally:
+            await session.close()
+
+    async def expire(self, application):
+        """Удаляет брошенные разговоры и user_data старше TTL"""
+        deadline = time.monotonic() - self.ttl
+        idle = [user_id for user_id, (accessed_at, _) in self._users.items()
+                if accessed_at < deadline]
+        for user_id in idle:
+            # drop_user_data приложения освобождает память и при следующем
+            # проходе вызывает drop_user_data хранилища
+            self._evicting.add(user_id)
+            application.drop_user_data(user_id)
+            self._users.pop(user_id, None)
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        session = self.session_factory()
+        try:
+            await session.execute(delete(ConversationState).filter(
+                ConversationState.updated_at < cutoff))
+            await session.execute(delete(PersistedUserData).filter(
+                PersistedUserData.updated_at < cutoff))
+            await session.commit()
+        finally:
+            await session.close()
+        self.expired += len(idle)
+        logger.info(f"Expired {len(idle)} idle users from persistence")
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики хранилища"""
+        return {
+            'users_in_memory': len(self._users),
+            'loads': self.loads,
+            'writes': self.writes,
+            'batches': self.batches,
+            'expired': self.expired,
+            'conversation_loads': self.conversation_loads,
+            'pending': len(self._pending_users) + len(self._pending_conversations),
+        }
+
+
+def conversation_reloader(persistence: DatabasePersistence, handlers) -> TypeHandler:
+    """Обработчик для группы -1: подгружает из базы разговоры, которых нет в памяти.
+
+    Разговор мог начаться на другой реплике или в другом воркере уже после
+    старта этого процесса; без подгрузки ConversationHandler не узнал бы его
+    состояние и пропустил бы сообщение.
+
+    Использует закрытые ConversationHandler._get_key, ._conversations и
+    TrackingDict.update_no_track, поэтому версия python-telegram-bot
+    закреплена в requirements.txt; test_persistence.py проверяет, что они
+    на месте.
+    """
+    async def reload(update: Update, context):
+        if update.message is None and update.callback_query is None:
+            return
+        missing = {}
+        for handler in handlers:
+            try:
+                key = handler._get_key(update)
+            except RuntimeError:
+                # У обновления нет чата или пользователя, нужных для ключа
+                continue
+            if key not in handler._conversations:
+                missing[(handler.name, key)] = handler
+        if not missing:
+            return
+        states = await persistence.load_conversations(missing)
+        for (name, key), state in states.items():
+            handler = missing[(name, key)]
+            if state != handler.END:
+                # Без пометки изменения: состояние уже записано в базе
+                handler._conversations.update_no_track({key: state})
+
+    return TypeHandler(Update, reload)
@@ -0,0 +1,278 @@
+"""Маршрутизация и запись ответов на опросы.
+
+Telegram присылает в PollAnswer только poll.id, поэтому для активных опросов
+держим в памяти отображение poll.id -> WeeklyPoll.id. Обращение к базе
+нужно только при промахе (например, после перезапуска). Новый опрос чата
+закрывает прежний (close_replaced_polls), и тот удаляется из кэша, поэтому
+кэш не больше числа активных чатов. Опросы закрывает лидер, а ответы
+принимают все воркеры (sharding.py), поэтому закрытие рассылается остальным
+воркерам через publish, как сброс кэша профилей.
+
+В режиме write-behind ответы копятся в PollAnswerBuffer и пишутся пачками.
+Если пачка не записалась, ответы пишутся по одному: ответ, который не удалось
+записать max_attempts раз подряд, отбрасывается с записью в лог, чтобы одна
+"ядовитая" строка не блокировала остальные. Незарегистрированных участников,
+ответивших "Да", буфер находит при записи и передает в on_unregistered, так
+что обработчик ответа не обращается к базе.
+
+Буфер живет в памяти процесса: перед распределением пар лидер сбрасывает
+только свой. Поэтому write-behind рассчитан на один процесс, принимающий
+ответы; воркеры sharding.py при BOT_WORKERS > 1 пишут ответы сразу.
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from sqlalchemy import insert, select, update
+
+from database import User, WeeklyPoll, poll_response_upsert
+
+logger = logging.getLogger(__name__)
+
+
+class PollRouter:
+    """Кэш poll.id -> WeeklyPoll.id для активных опросов"""
+
+    def __init__(self):
+        self._routes: Dict[str, int] = {}
+        # Рассылка закрытия опроса другим процессам (задает sharding.py)
+        self.publish: Optional[Callable[[str], None]] = None
+
+    def __len__(self):
+        return len(self._routes)
+
+    def register(self, telegram_poll_id: str, weekly_poll_id: int):
+        """Запоминает опрос"""
+        self._routes[telegram_poll_id] = weekly_poll_id
+
+    def invalidate(self, telegram_poll_id: str):
+        """Удаляет закрытый опрос из кэша, в том числе в других процессах"""
+        self.forget(telegram_poll_id)
+        if self.publish is not None:
+            self.publish(telegram_poll_id)
+
+    def forget(self, telegram_poll_id: str):
+        """Удаляет опрос из кэша только в этом процессе"""
+        self._routes.pop(telegram_poll_id, None)
+
+    async def resolve(self, session, telegram_poll_id: str) -> Optional[int]:
+        """Возвращает WeeklyPoll.id активного опроса по poll.id от Telegram"""
+        weekly_poll_id = self._routes.get(telegram_poll_id)
+        if weekly_poll_id is None:
+            weekly_poll_id = await session.scalar(
+                select(WeeklyPoll.id)
+                .filter(WeeklyPoll.telegram_poll_id == telegram_poll_id)
+                .filter(WeeklyPoll.status == 'active'))
+            if weekly_poll_id is not None:
+                self._routes[telegram_poll_id] = weekly_poll_id
+        return weekly_poll_id
+
+    async def warm_up(self, session):
+        """Загружает все активные опросы"""
+        rows = (await session.execute(
+            select(WeeklyPoll.telegram_poll_id, WeeklyPoll.id)
+            .filter(WeeklyPoll.status == 'active')
+            .filter(WeeklyPoll.telegram_poll_id.isnot(None)))).all()
+        self._routes.update({row.telegram_poll_id: row.id for row in rows})
+        logger.info(f"Poll router warmed up with {len(rows)} active polls")
+
+
+# Общий маршрутизатор процесса
+poll_router = PollRouter()
+
+
+async def close_replaced_polls(session, chat_ids, router: PollRouter = poll_router) -> int:
+    """Закрывает активные опросы чатов перед отправкой новых; коммит за вызывающим"""
+    if not chat_ids:
+        return 0
+    telegram_poll_ids = (await session.scalars(
+        update(WeeklyPoll)
+        .filter(WeeklyPoll.status == 'active')
+        .filter(WeeklyPoll.chat_id.in_(chat_ids))
+        .values(status='closed')
+        .returning(WeeklyPoll.telegram_poll_id))).all()
+    for telegram_poll_id in telegram_poll_ids:
+        router.invalidate(telegram_poll_id)
+    return len(telegram_poll_ids)
+
+
+def _is_transient(error: Exception) -> bool:
+    """Ошибка соединения с базой, а не самой строки"""
+    return isinstance(error, (OSError, asyncio.TimeoutError)) or getattr(
+        error, 'connection_invalidated', False)
+
+
+class PollAnswerBuffer:
+    """Write-behind буфер ответов на опросы.
+
+    Хранит последний ответ на пару (опрос, пользователь Telegram) и сбрасывает
+    накопленное одним многострочным upsert раз в interval_ms миллисекунд или
+    при накоплении max_entries записей. Повторные нажатия "Да"/"Нет" одного
+    пользователя схлопываются в одну запись.
+    """
+
+    def __init__(self, session_factory, interval_ms: int = 500, max_entries: int = 500,
+                 max_attempts: int = 5):
+        self._session_factory = session_factory
+        self.interval = interval_ms / 1000
+        self.max_entries = max_entries
+        self.max_attempts = max_attempts
+        self._pending: Dict[tuple, tuple] = {}
+        # Неудачные попытки записи ответа: (опрос, пользователь) -> число
+        self._attempts: Dict[tuple, int] = {}
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._flush_task = None
+        # Вызывается после записи с telegram_id незарегистрированных, ответивших "Да"
+        self.on_unregistered: Optional[Callable[[List[int]], Awaitable]] = None
+        self._notifications: Set[asyncio.Task] = set()
+        self.buffered = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, poll_id: int, telegram_user_id: int, username: Optional[str], response: bool):
+        """Запоминает ответ; при переполнении запускает сброс в фоне"""
+        self._pending[(poll_id, telegram_user_id)] = (
+            username, response, datetime.utcnow())
+        self.buffered += 1
+        if len(self._pending) >= self.max_entries and (
+                self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> int:
+        """Записывает накопленные ответы в базу одной транзакцией.
+
+        Если пачка не записалась, пишет ответы по одному. Ответы, которые
+        не удалось записать из-за недоступности базы, возвращаются в буфер
+        и ошибка пробрасывается.
+        """
+        unregistered: Set[int] = set()
+        try:
+            async with self._lock:
+                if not self._pending:
+                    return 0
+                pending, self._pending = self._pending, {}
+                try:
+                    async with self._session_factory() as session:
+                        unregistered.update(await self._write(session, pending))
+                except Exception as e:
+                    logger.warning(f"Poll answer batch of {len(pending)} failed, writing one by one: {e}")
+                    written = await self._write_one_by_one(pending, unregistered)
+                else:
+                    written = len(pending)
+                    self._attempts.clear()
+                self.flushed += written
+                self.flushes += 1
+                return written
+        finally:
+            self._notify(unregistered)
+
+    def _notify(self, telegram_ids: Set[int]):
+        # Рассылка не задерживает следующие сбросы
+        if not telegram_ids or self.on_unregistered is None:
+            return
+        task = asyncio.ensure_future(self.on_unregistered(sorted(telegram_ids)))
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    async def _write_one_by_one(self, pending, unregistered: Set[int]) -> int:
+        written = 0
+        error = None
+        for key, value in pending.items():
+            try:
+                async with self._session_factory() as session:
+                    unregistered.update(await self._write(session, {key: value}))
+            except Exception as e:
+                if _is_transient(e):
+                    # База недоступна: попытку не засчитываем
+                    error = e
+                    self._pending.setdefault(key, value)
+                    continue
+                attempts = self._attempts.get(key, 0) + 1
+                if attempts >= self.max_attempts:
+                    self._attempts.pop(key, None)
+                    self.dropped += 1
+                    logger.error(f"Dropping poll answer {key} after {attempts} failed attempts: {e}")
+                    continue
+                self._attempts[key] = attempts
+                # Возвращаем ответ в буфер, не затирая более свежий
+                self._pending.setdefault(key, value)
+            else:
+                self._attempts.pop(key, None)
+                written += 1
+        if error is not None:
+            raise error
+        return written
+
+    async def _write(self, session, pending) -> List[int]:
+        """Пишет ответы; возвращает незарегистрированных, ответивших "Да" """
+        telegram_ids = {telegram_id for _, telegram_id in pending}
+        users = {row.telegram_id: row for row in (await session.execute(
+            select(User.telegram_id, User.id, User.nickname)
+            .filter(User.telegram_id.in_(telegram_ids)))).all()}
+        user_ids = {telegram_id: row.id for telegram_id, row in users.items()}
+
+        # Пользователей, ответивших впервые, создаем одним запросом
+        missing = {telegram_id: username
+                   for (_, telegram_id), (username, _, _) in pending.items()
+                   if telegram_id not in user_ids}
+        if missing:
+            now = datetime.utcnow()
+            await session.execute(insert(User), [
+                {'telegram_id': telegram_id, 'username': username, 'created_at': now}
+                for telegram_id, username in missing.items()])
+            user_ids.update((await session.execute(
+                select(User.telegram_id, User.id)
+                .filter(User.telegram_id.in_(missing)))).all())
+
+        rows = [
+            {'poll_id': poll_id, 'user_id': user_ids[telegram_id],
+             'response': response, 'created_at': answered_at}
+            for (poll_id, telegram_id), (_, response, answered_at) in pending.items()
+        ]
+        for start in range(0, len(rows), self.max_entries):
+            await session.execute(poll_response_upsert(
+                session.bind.dialect.name, rows[start:start + self.max_entries]))
+        await session.commit()
+        return [telegram_id for (_, telegram_id), (_, response, _) in pending.items()
+                if response and not (telegram_id in users and users[telegram_id].nickname)]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing poll answers: {e}")
+
+    def start(self):
+        """Запускает периодический сброс"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Останавливает периодический сброс и записывает остаток"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, float]:
+        """Счетчики буфера"""
+        return {
+            'buffered': self.buffered,
+            'flushed': self.flushed,
+            'flushes': self.flushes,
+            'pending': len(self._pending),
+            'dropped': self.dropped,
+            'coalescing_ratio': self.buffered / self.flushed if self.flushed else 0.0,
+        }
@@ -0,0 +1,105 @@
+"""Кэш профилей пользователей для меню, настроек и статистики.
+
+Пользователи нажимают кнопки меню гораздо чаще, чем меняют профиль, поэтому
+профили читаются из кэша. Кэш хранит легкие снимки профиля вместо
+ORM-объектов в StateStore (LRU и TTL, бэкенд по STATE_BACKEND) и сбрасывается
+явно при каждом изменении профиля.
+
+С STATE_BACKEND=redis кэш общий для всех процессов. С локальным бэкендом у
+каждого процесса-воркера (sharding.py) своя копия, поэтому сброс рассылается
+остальным воркерам через publish.
+"""
+import os
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import select
+
+from database import User
+from state_store import StateStore
+
+# Максимальное число профилей в кэше
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+
+# Время жизни записи (секунды)
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '300'))
+
+_MISSING = object()
+
+
+class ProfileSnapshot:
+    """Снимок профиля пользователя"""
+
+    __slots__ = ('id', 'telegram_id', 'username', 'nickname', 'city', 'social_link',
+                 'about', 'job', 'birth_date', 'avatar', 'hobbies', 'is_visible',
+                 'created_at')
+
+    COLUMNS = (User.id, User.telegram_id, User.username, User.nickname, User.city,
+               User.social_link, User.about, User.job, User.birth_date, User.avatar,
+               User.hobbies, User.show_profile, User.created_at)
+
+    # Поля с датами: в общем хранилище снимок лежит в JSON
+    DATETIME_FIELDS = ('birth_date', 'created_at')
+
+    def __init__(self, row):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+    def dump(self) -> list:
+        return [value.isoformat() if name in self.DATETIME_FIELDS and value is not None else value
+                for name, value in ((name, getattr(self, name)) for name in self.__slots__)]
+
+    @classmethod
+    def restore(cls, values: list) -> 'ProfileSnapshot':
+        return cls(datetime.fromisoformat(value) if name in cls.DATETIME_FIELDS and value is not None else value
+                   for name, value in zip(cls.__slots__, values))
+
+
+class ProfileCache:
+    """Кэш снимков профилей по telegram_id"""
+
+    def __init__(self, max_entries: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL,
+                 backend=None):
+        self.store = StateStore('profiles', max_entries, ttl, backend)
+        # Рассылка сброса другим процессам (устанавливает sharding.py)
+        self.publish: Optional[Callable[[int], None]] = None
+
+    async def get(self, telegram_id: int):
+        """Возвращает снимок, None для незарегистрированного или _MISSING при промахе"""
+        values = await self.store.get(telegram_id, _MISSING)
+        if values is _MISSING or values is None:
+            return values
+        return ProfileSnapshot.restore(values)
+
+    async def put(self, telegram_id: int, snapshot: Optional[ProfileSnapshot]):
+        """Сохраняет снимок (None — пользователь не зарегистрирован)"""
+        await self.store.set(telegram_id, snapshot.dump() if snapshot is not None else None)
+
+    async def invalidate(self, telegram_id: int):
+        """Сбрасывает профиль после изменения, в том числе в других процессах"""
+        await self.drop(telegram_id)
+        if self.publish is not None:
+            self.publish(telegram_id)
+
+    async def drop(self, telegram_id: int):
+        """Сбрасывает профиль только в этом процессе"""
+        await self.store.backend.delete(telegram_id)
+
+    async def load(self, session, telegram_id: int) -> Optional[ProfileSnapshot]:
+        """Возвращает профиль из кэша или из базы"""
+        snapshot = await self.get(telegram_id)
+        if snapshot is _MISSING:
+            row = (await session.execute(
+                select(*ProfileSnapshot.COLUMNS)
+                .filter(User.telegram_id == telegram_id))).first()
+            snapshot = ProfileSnapshot(row) if row else None
+            await self.put(telegram_id, snapshot)
+        return snapshot
+
+    def stats(self) -> Dict[str, float]:
+        """Счетчики кэша"""
+        return self.store.stats()
+
+
+# Общий кэш процесса
+profile_cache = ProfileCache()
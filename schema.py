@@ -0,0 +1,92 @@
+"""Версия схемы базы данных.
+
+Бот не создает и не удаляет таблицы: схема ведется миграциями Alembic.
+При старте сравниваем ревизию из alembic_version с головной ревизией
+миграций и останавливаемся, если база отстает.
+
+Перед запуском бота (release-фаза):
+    python schema.py
+
+Пустая база создается по моделям и помечается головной ревизией
+(начальная миграция пустая), существующая обновляется `alembic upgrade head`.
+База, созданная прежним create_all без alembic_version, сначала помечается
+ревизией BASELINE_REVISION, которой соответствовала ее схема.
+"""
+import logging
+import os
+from functools import lru_cache
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from dotenv import load_dotenv
+from sqlalchemy import inspect
+
+from database import Base, create_db_engine
+
+logger = logging.getLogger(__name__)
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'alembic.ini')
+
+# Ревизия, до которой схема совпадает с таблицами из прежнего init_db() (create_all)
+BASELINE_REVISION = 'update_user_fields'
+
+
+class SchemaOutOfDateError(RuntimeError):
+    """Ревизия базы не совпадает с головной ревизией миграций"""
+
+
+def _alembic_config() -> Config:
+    config = Config(ALEMBIC_INI)
+    config.set_main_option('script_location', os.path.join(
+        os.path.dirname(ALEMBIC_INI), config.get_main_option('script_location')))
+    return config
+
+
+@lru_cache(maxsize=None)
+def get_head_revisions() -> frozenset:
+    """Головные ревизии миграций (читаются с диска один раз за процесс)"""
+    return frozenset(ScriptDirectory.from_config(_alembic_config()).get_heads())
+
+
+def _current_revisions(connection) -> frozenset:
+    return frozenset(MigrationContext.configure(connection).get_current_heads())
+
+
+async def check_schema(engine):
+    """Проверяет, что база на головной ревизии, иначе SchemaOutOfDateError"""
+    async with engine.connect() as connection:
+        current = await connection.run_sync(_current_revisions)
+    head = get_head_revisions()
+    if current != head:
+        raise SchemaOutOfDateError(
+            f"Database revision {', '.join(sorted(current)) or 'none'} does not match "
+            f"migration head {', '.join(sorted(head))}; run `python schema.py`")
+    logger.info(f"Database schema is at revision {', '.join(sorted(head))}")
+
+
+def migrate():
+    """Приводит базу из DATABASE_URL к головной ревизии"""
+    engine = create_db_engine(os.getenv('DATABASE_URL', 'sqlite:///random_coffee.db'))
+    try:
+        with engine.connect() as connection:
+            current = _current_revisions(connection)
+            has_tables = bool(inspect(connection).get_table_names())
+        config = _alembic_config()
+        if not current and not has_tables:
+            Base.metadata.create_all(engine)
+            command.stamp(config, 'head')
+            return
+        if not current:
+            # Таблицы есть, а alembic_version нет: миграции до базовой уже "применены"
+            logger.info(f"Stamping unversioned database with baseline revision {BASELINE_REVISION}")
+            command.stamp(config, BASELINE_REVISION)
+        command.upgrade(config, 'head')
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    migrate()
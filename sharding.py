@@ -0,0 +1,322 @@
+"""Многопроцессная обработка обновлений с шардированием по chat_id.
+
+Один процесс Python упирается в одно ядро. Лаунчер запускает BOT_WORKERS
+процессов-воркеров, каждый владеет шардом consistent hash по chat_id (или
+id пользователя для обновлений без чата). Процесс-диспетчер получает
+обновления — через вебхук или единственный цикл getUpdates — и пересылает
+JSON обновления воркеру-владельцу, поэтому состояние ConversationHandler
+каждого чата живет в одном процессе. При изменении числа воркеров consistent
+hash переносит только ~1/N чатов.
+
+Запуск:
+    BOT_WORKERS=4 python sharding.py
+
+Каждый воркер — полноценная реплика (см. leader.py): своя запись
+bot_instances и свой пул соединений (DB_POOL_SIZE на процесс), задачи
+планировщика выполняет только лидер. Метрики воркер N отдает на порту
+METRICS_PORT + N + 1, диспетчер на METRICS_PORT отвечает на GET /health.
+
+Профиль пользователя может оказаться в кэше нескольких воркеров (личный
+чат и группы в разных шардах), поэтому сброс кэша профилей воркер
+отправляет в общую очередь, а диспетчер пересылает его остальным воркерам.
+Так же рассылается закрытие опроса: ответы на него принимают все воркеры.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from typing import Dict, Hashable, Iterable, List
+
+from telegram import Bot, Update
+from telegram.error import NetworkError
+from telegram.ext import Updater
+
+import metrics
+from polls import poll_router
+from profile_cache import profile_cache
+from webhook import BOT_MODE, WebhookServer
+
+logger = logging.getLogger(__name__)
+
+# Число процессов-воркеров
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', str(os.cpu_count() or 1)))
+
+# Виртуальных узлов на воркер: чем больше, тем ровнее шарды
+HASH_RING_REPLICAS = 100
+
+# Таймаут long polling для getUpdates (секунды)
+POLL_TIMEOUT = 30
+
+# Как часто проверять, живы ли воркеры (секунды)
+SUPERVISE_INTERVAL = 5
+
+# Обновления, в которых есть чат
+_CHAT_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                'my_chat_member', 'chat_member', 'chat_join_request')
+
+# Обновления без чата: поле и ключ пользователя в нем
+_USER_FIELDS = (('poll_answer', 'user'), ('inline_query', 'from'),
+                ('chosen_inline_result', 'from'), ('shipping_query', 'from'),
+                ('pre_checkout_query', 'from'))
+
+
+# Служебные сообщения воркеру вместо обновления: сброс профиля в кэше
+# и закрытие опроса в маршрутизаторе ответов
+PROFILE_INVALIDATION = '_invalidate_profile'
+POLL_INVALIDATION = '_invalidate_poll'
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Кольцо consistent hash с виртуальными узлами"""
+
+    def __init__(self, nodes: Iterable[Hashable], replicas: int = HASH_RING_REPLICAS):
+        points = sorted((_hash(f"{node}#{i}"), node)
+                        for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key) -> Hashable:
+        """Узел-владелец ключа"""
+        index = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+def shard_key(data: Dict) -> int:
+    """Ключ шардирования обновления: id чата, иначе id пользователя"""
+    for field in _CHAT_FIELDS:
+        if field in data:
+            return data[field]['chat']['id']
+    if 'callback_query' in data:
+        callback_query = data['callback_query']
+        message = callback_query.get('message')
+        return message['chat']['id'] if message else callback_query['from']['id']
+    for field, user_field in _USER_FIELDS:
+        if field in data:
+            return data[field][user_field]['id']
+    return data.get('update_id', 0)
+
+
+class ShardDispatcher:
+    """Пересылает JSON обновлений в очередь воркера-владельца"""
+
+    def __init__(self, queues: List):
+        self.queues = queues
+        self.ring = HashRing(range(len(queues)))
+        self.routed = [0] * len(queues)
+
+    def dispatch(self, data: Dict):
+        worker = self.ring.node(shard_key(data))
+        self.queues[worker].put(data)
+        self.routed[worker] += 1
+
+    def stats(self) -> Dict[str, List[int]]:
+        return {'routed': list(self.routed)}
+
+
+def _read_queue(queue, loop, incoming: asyncio.Queue):
+    # Блокирующее чтение межпроцессной очереди в отдельном потоке
+    while True:
+        data = queue.get()
+        loop.call_soon_threadsafe(incoming.put_nowait, data)
+        if data is None:
+            return
+
+
+def _relay_broadcasts(broadcasts, pool: 'WorkerPool'):
+    # Пересылает сбросы кэша всем воркерам, кроме отправителя
+    while True:
+        message = broadcasts.get()
+        if message is None:
+            return
+        for index, queue in enumerate(pool.queues):
+            if index != message['origin']:
+                queue.put(message)
+
+
+async def _apply_broadcast(data: Dict) -> bool:
+    """Применяет сообщение другого воркера; False, если это обновление"""
+    if PROFILE_INVALIDATION in data:
+        await profile_cache.drop(data[PROFILE_INVALIDATION])
+        return True
+    if POLL_INVALIDATION in data:
+        poll_router.forget(data[POLL_INVALIDATION])
+        return True
+    return False
+
+
+async def _run_worker(index: int, queue, factory, broadcasts=None):
+    application = await factory()
+    if broadcasts is not None:
+        profile_cache.publish = lambda telegram_id: broadcasts.put(
+            {PROFILE_INVALIDATION: telegram_id, 'origin': index})
+        poll_router.publish = lambda telegram_poll_id: broadcasts.put(
+            {POLL_INVALIDATION: telegram_poll_id, 'origin': index})
+    loop = asyncio.get_running_loop()
+    incoming = asyncio.Queue()
+    threading.Thread(target=_read_queue, args=(queue, loop, incoming),
+                     name=f'worker-{index}-reader', daemon=True).start()
+
+    async with application:
+        await application.start()
+        logger.info(f"Worker {index} started (pid {os.getpid()})")
+        while True:
+            data = await incoming.get()
+            if data is None:
+                break
+            if await _apply_broadcast(data):
+                continue
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+
+    # post_shutdown вызывается только из run_polling/run_webhook
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    logger.info(f"Worker {index} stopped")
+
+
+def _worker_main(index: int, queue, factory, broadcasts=None):
+    # Остановкой воркеров управляет диспетчер через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if metrics.METRICS_PORT:
+        metrics.METRICS_PORT += index + 1
+    asyncio.run(_run_worker(index, queue, factory, broadcasts))
+
+
+class WorkerPool:
+    """Процессы-воркеры и диспетчер обновлений между ними.
+
+    factory — корутинная функция уровня модуля, возвращающая Application
+    с обработчиками (например, bot.create_worker_application).
+    """
+
+    def __init__(self, factory, workers: int = BOT_WORKERS):
+        self.factory = factory
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue() for _ in range(workers)]
+        # Сообщения воркеров остальным воркерам (сброс кэша профилей)
+        self.broadcasts = self._context.Queue()
+        self.processes: List = [None] * workers
+        self.dispatcher = ShardDispatcher(self.queues)
+        self.restarts = 0
+        self._relay = None
+
+    def _spawn(self, index: int):
+        process = self._context.Process(
+            target=_worker_main, args=(index, self.queues[index], self.factory, self.broadcasts),
+            name=f'bot-worker-{index}')
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        self._relay = threading.Thread(target=_relay_broadcasts, args=(self.broadcasts, self),
+                                       name='broadcast-relay', daemon=True)
+        self._relay.start()
+        for index in range(len(self.queues)):
+            self._spawn(index)
+        logger.info(f"Started {len(self.processes)} bot workers")
+
+    def supervise(self):
+        """Перезапускает упавших воркеров"""
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                # Упавший процесс мог остаться владельцем блокировки чтения очереди,
+                # поэтому воркер получает новую очередь, а старая отбрасывается
+                self.queues[index] = self._context.Queue()
+                self.restarts += 1
+                self._spawn(index)
+
+    def stop(self, timeout: float = 30):
+        """Останавливает воркеров после обработки их очередей"""
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {process.name} did not stop, terminating")
+                process.terminate()
+        # Ждем пересыльщика: иначе при выходе он остается в чтении закрываемой очереди
+        self.broadcasts.put(None)
+        if self._relay is not None:
+            self._relay.join(timeout)
+        logger.info(f"Bot workers stopped: {self.dispatcher.stats()}")
+
+
+async def poll_updates(bot: Bot, dispatcher: ShardDispatcher):
+    """Единственный цикл getUpdates, раздающий обновления воркерам"""
+    offset = None
+    await bot.delete_webhook()
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT,
+                                            allowed_updates=Update.ALL_TYPES)
+        except NetworkError as e:
+            logger.warning(f"Error fetching updates: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            dispatcher.dispatch(update.to_dict())
+            offset = update.update_id + 1
+
+
+async def forward_updates(update_queue: asyncio.Queue, dispatcher: ShardDispatcher):
+    """Раздает воркерам обновления, принятые вебхуком"""
+    while True:
+        update = await update_queue.get()
+        dispatcher.dispatch(update.to_dict())
+
+
+async def run_sharded(factory, workers: int = BOT_WORKERS):
+    """Запускает воркеров и диспетчер до SIGINT/SIGTERM"""
+    from bot import TELEGRAM_BOT_TOKEN, TELEGRAM_API_URL
+
+    bot = Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_URL or 'https://api.telegram.org/bot')
+    updater = Updater(bot, asyncio.Queue())
+    # Без секрета и адреса вебхука не запускаем и воркеров
+    webhook = WebhookServer(updater) if BOT_MODE == 'webhook' else None
+    pool = WorkerPool(factory, workers)
+    pool.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # Воркеры отдают метрики на METRICS_PORT + N + 1, диспетчер — /health на METRICS_PORT
+    await metrics.start_metrics_server()
+    async with updater:
+        if webhook is not None:
+            await webhook.start()
+            source = asyncio.ensure_future(forward_updates(updater.update_queue, pool.dispatcher))
+        else:
+            source = asyncio.ensure_future(poll_updates(bot, pool.dispatcher))
+
+        try:
+            while not stop_event.is_set():
+                try:
+                    await asyncio.wait_for(stop_event.wait(), SUPERVISE_INTERVAL)
+                except asyncio.TimeoutError:
+                    pool.supervise()
+        finally:
+            if webhook is not None:
+                await webhook.stop()
+            source.cancel()
+            try:
+                await source
+            except asyncio.CancelledError:
+                pass
+            await loop.run_in_executor(None, pool.stop)
+            await metrics.stop_metrics_server()
+
+if __name__ == '__main__':
+    from bot import create_worker_application
+
+    asyncio.run(run_sharded(create_worker_application))
@@ -0,0 +1,134 @@
+"""Профилировщик SQL по обновлениям и задачам с поиском N+1.
+
+Каждый запрос относится к текущей области профилирования — обработке одного
+обновления или запуску задачи планировщика (их открывают обертки из
+metrics.py). В области копятся число выполнений и суммарное время по
+нормализованному SQL (литералы и списки IN заменены на ?). Если один
+нормализованный запрос выполнился больше SQL_PROFILE_THRESHOLD раз, это
+похоже на N+1: в режиме warn пишется предупреждение, в режиме fail
+выбрасывается NPlusOneError.
+
+Режим задает SQL_PROFILE: off (по умолчанию), warn или fail. Для тестов
+есть фикстура sql_profile в conftest.py.
+"""
+import contextvars
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# off, warn или fail
+SQL_PROFILE = os.getenv('SQL_PROFILE', 'off').lower()
+
+# Сколько раз один запрос может выполниться за обновление
+SQL_PROFILE_THRESHOLD = int(os.getenv('SQL_PROFILE_THRESHOLD', '5'))
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM = re.compile(r"(?:\?|%\(\w+\)s|%s|\$\d+|(?<!:):\w+)")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_VALUES_LIST = re.compile(r"(VALUES\s*\(\?(?:,\s*\?)*\))(?:\s*,\s*\(\?(?:,\s*\?)*\))+", re.IGNORECASE)
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_sql(statement: str) -> str:
+    """SQL без литералов: запросы, отличающиеся только значениями, совпадают"""
+    statement = _STRING.sub('?', statement)
+    statement = _PARAM.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _SPACES.sub(' ', statement).strip()
+    statement = _IN_LIST.sub('(?...)', statement)
+    return _VALUES_LIST.sub(r'\1...', statement)
+
+
+class NPlusOneError(AssertionError):
+    """Один запрос выполнился за обновление больше допустимого числа раз"""
+
+
+class QueryProfile:
+    """Запросы одной области профилирования"""
+
+    def __init__(self, name: str, threshold: int = SQL_PROFILE_THRESHOLD):
+        self.name = name
+        self.threshold = threshold
+        # Нормализованный SQL -> [число выполнений, суммарное время]
+        self.statements: Dict[str, List] = {}
+        self.count = 0
+        self.total_time = 0.0
+
+    def record(self, statement: str, elapsed: float):
+        entry = self.statements.setdefault(normalize_sql(statement), [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        self.count += 1
+        self.total_time += elapsed
+
+    def repeated(self, threshold: Optional[int] = None) -> List[Tuple[str, int]]:
+        """Запросы, выполненные больше threshold раз"""
+        threshold = self.threshold if threshold is None else threshold
+        return sorted(((statement, count) for statement, (count, _) in self.statements.items()
+                       if count > threshold), key=lambda item: -item[1])
+
+    def check(self, mode: str = 'warn'):
+        """Сообщает о N+1 в режиме warn или выбрасывает NPlusOneError в режиме fail"""
+        repeated = self.repeated()
+        if not repeated:
+            return
+        details = '; '.join(f"{count}x {statement}" for statement, count in repeated)
+        message = f"Possible N+1 in {self.name}: {details}"
+        if mode == 'fail':
+            raise NPlusOneError(message)
+        logger.warning(message)
+
+    def summary(self) -> Dict:
+        return {
+            'name': self.name,
+            'statements': self.count,
+            'total_time': round(self.total_time, 6),
+            'distinct': len(self.statements),
+        }
+
+
+# Текущая область профилирования
+_current: contextvars.ContextVar[Optional[QueryProfile]] = contextvars.ContextVar(
+    'sql_profile', default=None)
+
+
+@contextmanager
+def profile_scope(name: str, mode: Optional[str] = None, threshold: Optional[int] = None):
+    """Область профилирования; при mode off ничего не собирает"""
+    mode = SQL_PROFILE if mode is None else mode
+    if mode == 'off':
+        yield None
+        return
+    profile = QueryProfile(name, SQL_PROFILE_THRESHOLD if threshold is None else threshold)
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+        logger.debug(f"SQL profile: {profile.summary()}")
+    profile.check(mode)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info['sql_profile_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current.get()
+    if profile is None:
+        return
+    started = conn.info.pop('sql_profile_started', None)
+    if started is not None:
+        profile.record(statement, time.perf_counter() - started)
@@ -0,0 +1,227 @@
+"""Ограниченное хранилище временного состояния пользователей.
+
+Бот работает месяцами без перезапуска, поэтому временное состояние по
+пользователям (например, кэш профилей, см. profile_cache.py) нельзя держать
+в обычных словарях: они растут без предела. StateStore хранит записи с TTL и
+ограничением числа записей (вытесняются давно не использованные) и считает
+попадания, промахи, вытеснения и истечения.
+
+Бэкенд выбирается переменной STATE_BACKEND:
+
+    local   словарь процесса (по умолчанию)
+    redis   общее хранилище реплик (REDIS_URL, пакет redis); размер
+            ограничивает политика вытеснения сервера (maxmemory-policy)
+
+Для тестов общего хранилища есть InMemoryKeyValue — локальная замена
+клиента Redis.
+"""
+import json
+import logging
+import os
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+# local или redis
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'local').lower()
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# Максимальное число записей в одном хранилище
+STATE_STORE_SIZE = int(os.getenv('STATE_STORE_SIZE', '10000'))
+
+# Время жизни записи по умолчанию (секунды)
+STATE_STORE_TTL = float(os.getenv('STATE_STORE_TTL', str(24 * 60 * 60)))
+
+_MISSING = object()
+
+
+class LocalBackend:
+    """Словарь процесса с LRU-вытеснением и TTL"""
+
+    def __init__(self, max_entries: int = STATE_STORE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def size(self) -> Optional[int]:
+        return len(self._entries)
+
+    async def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: Hashable, value, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    async def purge(self) -> int:
+        """Удаляет истекшие записи"""
+        now = time.monotonic()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at < now]
+        for key in expired:
+            del self._entries[key]
+        self.expirations += len(expired)
+        return len(expired)
+
+
+class SharedBackend:
+    """Общее хранилище с интерфейсом redis.asyncio (get/set с px/delete).
+
+    Значения хранятся в JSON, поэтому ключи и значения должны сериализоваться.
+    Истечение и вытеснение выполняет сервер.
+    """
+
+    def __init__(self, client, prefix: str):
+        self.client = client
+        self.prefix = prefix
+        self.evictions = 0
+        self.expirations = 0
+
+    def size(self) -> Optional[int]:
+        return None
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self.prefix}:{key}"
+
+    async def get(self, key: Hashable):
+        raw = await self.client.get(self._key(key))
+        return _MISSING if raw is None else json.loads(raw)
+
+    async def set(self, key: Hashable, value, ttl: float):
+        await self.client.set(self._key(key), json.dumps(value), px=int(ttl * 1000))
+
+    async def delete(self, key: Hashable):
+        await self.client.delete(self._key(key))
+
+    async def purge(self) -> int:
+        return 0
+
+
+class InMemoryKeyValue:
+    """Локальная замена клиента Redis для тестов SharedBackend"""
+
+    def __init__(self):
+        self._values: Dict[str, tuple] = {}
+
+    async def get(self, name: str):
+        entry = self._values.get(name)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._values[name]
+            return None
+        return value
+
+    async def set(self, name: str, value: str, px: Optional[int] = None):
+        expires_at = time.monotonic() + px / 1000 if px is not None else None
+        self._values[name] = (expires_at, value)
+        return True
+
+    async def delete(self, *names: str) -> int:
+        return sum(self._values.pop(name, None) is not None for name in names)
+
+
+_redis_client = None
+
+
+def _shared_client():
+    global _redis_client
+    if _redis_client is None:
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis requires the redis package: pip install -r requirements.txt")
+        _redis_client = redis.from_url(REDIS_URL)
+    return _redis_client
+
+
+def create_backend(name: str, max_entries: int = STATE_STORE_SIZE):
+    """Бэкенд по STATE_BACKEND"""
+    if STATE_BACKEND == 'local':
+        return LocalBackend(max_entries)
+    if STATE_BACKEND == 'redis':
+        return SharedBackend(_shared_client(), f"state:{name}")
+    raise ValueError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+
+
+# Все хранилища процесса, для метрик и периодической очистки
+_stores = weakref.WeakSet()
+
+
+class StateStore:
+    """Временное состояние с TTL, ограничением размера и счетчиками"""
+
+    def __init__(self, name: str, max_entries: int = STATE_STORE_SIZE,
+                 ttl: float = STATE_STORE_TTL, backend=None):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend if backend is not None else create_backend(name, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        _stores.add(self)
+
+    async def get(self, key: Hashable, default=None):
+        value = await self.backend.get(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    async def set(self, key: Hashable, value, ttl: Optional[float] = None):
+        """Сохраняет значение на ttl секунд (по умолчанию TTL хранилища)"""
+        await self.backend.set(key, value, self.ttl if ttl is None else ttl)
+        self.sets += 1
+
+    async def pop(self, key: Hashable, default=None):
+        value = await self.get(key, default)
+        await self.backend.delete(key)
+        return value
+
+    async def purge(self) -> int:
+        return await self.backend.purge()
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        """Счетчики хранилища"""
+        lookups = self.hits + self.misses
+        return {
+            'size': self.backend.size(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'evictions': self.backend.evictions,
+            'expirations': self.backend.expirations,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+async def purge_state_stores(context=None):
+    """Удаляет истекшие записи всех хранилищ и пишет их счетчики в лог"""
+    for store in list(_stores):
+        await store.purge()
+        logger.info(f"State store {store.name}: {store.stats()}")
+
+
+def state_store_stats() -> Dict[str, Dict]:
+    return {store.name: store.stats() for store in list(_stores)}
@@ -0,0 +1,58 @@
+"""Тесты денормализованных счетчиков пользователей (aggregates.py)."""
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from aggregates import add_rating, complete_meeting, reconcile_statement, record_meetings
+from database import Base, Meeting, User
+
+COUNTERS = (User.id, User.total_meetings, User.completed_meetings, User.rating_sum,
+            User.rating_count, User.average_rating)
+
+
+async def counters(session):
+    return {row.id: tuple(row) for row in await session.execute(select(*COUNTERS).order_by(User.id))}
+
+
+def test_counters_match_reconcile(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'aggregates.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.execute(insert(User), [
+                    {'id': user_id, 'telegram_id': 100 + user_id} for user_id in range(1, 5)])
+
+            async with AsyncSession(engine) as session:
+                now = datetime.utcnow()
+                meetings = [{'user1_id': 1, 'user2_id': 2, 'status': 'scheduled', 'created_at': now},
+                            {'user1_id': 1, 'user2_id': 3, 'status': 'scheduled', 'created_at': now},
+                            {'user1_id': 3, 'user2_id': 4, 'status': 'scheduled', 'created_at': now}]
+                await session.execute(insert(Meeting), meetings)
+                await record_meetings(session, meetings)
+                await session.commit()
+
+                assert await complete_meeting(session, 1)
+                assert await complete_meeting(session, 3)
+                # Повторное подтверждение не увеличивает счетчики
+                assert not await complete_meeting(session, 1)
+                await session.commit()
+
+                await add_rating(session, 1, 1, 2, 5)
+                await add_rating(session, 1, 2, 1, 4)
+                await add_rating(session, 3, 3, 4, 3)
+                await session.commit()
+
+                incremental = await counters(session)
+                assert incremental[1][1:] == (2, 1, 4.0, 1, 4.0)
+                assert incremental[4][1:] == (1, 1, 3.0, 1, 3.0)
+
+                await session.execute(reconcile_statement())
+                await session.commit()
+                assert await counters(session) == incremental
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,147 @@
+"""Тесты распределения пар с учетом предпочтений (compatibility.py)."""
+import math
+import random
+import time
+
+import pytest
+
+import compatibility
+from benchmark_pairing import load_engine, validate
+from compatibility import Profile, create_preference_pairs, match_by_preferences, pair_cost
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def engine(request, monkeypatch):
+    """Оба пути: векторный (NumPy) и поблочный на чистом Python"""
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(compatibility, 'np', None)
+    return request.param
+
+
+def members(pairs):
+    return sorted(user for group in pairs for user in group)
+
+
+def test_age_range_is_hard_constraint(engine):
+    profiles = {
+        1: Profile(1, age=25, age_min=20, age_max=30),
+        2: Profile(2, age=50),
+        3: Profile(3, age=28),
+        4: Profile(4, age=55, age_min=45),
+    }
+    for seed in range(10):
+        pairs = create_preference_pairs(list(profiles), {}, random.Random(seed), profiles=profiles)
+        assert sorted(map(sorted, pairs)) == [[1, 3], [2, 4]]
+
+
+def test_new_and_experienced_users(engine):
+    profiles = {
+        1: Profile(1, total_meetings=0, only_experienced=True),
+        2: Profile(2, total_meetings=0),
+        3: Profile(3, total_meetings=20, only_new_users=True),
+        4: Profile(4, total_meetings=20),
+    }
+    for seed in range(10):
+        pairs = list(map(sorted, create_preference_pairs(list(profiles), {}, random.Random(seed), profiles=profiles)))
+        assert len(pairs) == 2
+        assert [1, 2] not in pairs and [3, 4] not in pairs
+
+
+def test_languages_must_overlap_when_both_specified(engine):
+    a = Profile(1, languages={'ru'})
+    b = Profile(2, languages={'en'})
+    c = Profile(3)
+    assert pair_cost(a, b, {}) == math.inf
+    assert pair_cost(a, c, {}) < math.inf
+    profiles = {1: a, 2: b}
+    # Допустимой пары нет: участники остаются без пары, и бот их об этом предупредит
+    pairs, unpaired = match_by_preferences([1, 2], {}, profiles, random.Random(0))
+    assert pairs == []
+    assert sorted(unpaired) == [1, 2]
+
+
+def test_shared_interests_and_history(engine):
+    profiles = {
+        1: Profile(1, interests={'шахматы', 'кофе'}),
+        2: Profile(2, interests={'бег'}),
+        3: Profile(3, interests={'шахматы', 'кофе'}),
+        4: Profile(4, interests={'бег'}),
+    }
+    for seed in range(10):
+        pairs = create_preference_pairs(list(profiles), {}, random.Random(seed), profiles=profiles)
+        assert sorted(map(sorted, pairs)) == [[1, 3], [2, 4]]
+
+    # Прошлая встреча перевешивает общие интересы
+    history = {1: {3: 1.0}, 3: {1: 1.0}}
+    assert pair_cost(profiles[1], profiles[3], history) > pair_cost(profiles[1], profiles[2], history)
+
+
+def test_odd_participant_joins_compatible_group(engine):
+    profiles = {
+        1: Profile(1, age=25, age_min=20, age_max=30),
+        2: Profile(2, age=26),
+        3: Profile(3, age=60),
+        4: Profile(4, age=61),
+        5: Profile(5, age=62, age_min=55),
+    }
+    for seed in range(10):
+        pairs = create_preference_pairs(list(profiles), {}, random.Random(seed), profiles=profiles)
+        assert members(pairs) == [1, 2, 3, 4, 5]
+        trio = next(group for group in pairs if len(group) == 3)
+        assert sorted(trio) == [3, 4, 5]
+
+
+def test_missing_profiles_have_no_constraints(engine):
+    pairs = create_preference_pairs(list(range(1, 8)), {}, random.Random(1))
+    assert members(pairs) == list(range(1, 8))
+
+
+def test_engine_signature_matches_pairing_tools(engine):
+    # Инструменты из benchmark_pairing.py и pairing_simulator.py вызывают (user_ids, history, rng)
+    create = load_engine('compatibility:create_preference_pairs')
+    user_ids = list(range(1, 12))
+    history = {1: {2: 1.0}, 2: {1: 1.0}}
+    pairs = create(user_ids, history, random.Random(0))
+    validate(pairs, user_ids)
+    assert [1, 2] not in map(sorted, pairs)
+
+
+def test_large_group_is_fast(engine):
+    rng = random.Random(7)
+    words = [f'хобби{i}' for i in range(200)]
+    profiles = {
+        user_id: Profile(user_id, age=rng.randint(18, 60), age_min=18, age_max=rng.choice([None, 45]),
+                         total_meetings=rng.randint(0, 30), languages=rng.sample(['ru', 'en'], rng.randint(1, 2)),
+                         meeting_times=rng.sample(['утро', 'день', 'вечер'], 2),
+                         interests=rng.sample(words, 5))
+        for user_id in range(1, 3001)
+    }
+    started = time.perf_counter()
+    pairs = create_preference_pairs(list(profiles), {}, random.Random(0), profiles=profiles)
+    elapsed = time.perf_counter() - started
+    placed = members(pairs)
+    assert len(placed) >= 2900
+    for group in pairs:
+        for i, user1 in enumerate(group):
+            for user2 in group[i + 1:]:
+                assert pair_cost(profiles[user1], profiles[user2], {}) < math.inf
+    assert elapsed < (1 if engine == 'numpy' else 6)
+
+
+def test_cosine_does_not_scale_with_vocabulary():
+    np = pytest.importorskip('numpy')
+    # 3000 участников, у каждой пары 50 своих терминов: словарь из 75 000 терминов.
+    # Плотная матрица участники × словарь заняла бы ~900 МБ
+    vectors = [compatibility.normalize(dict.fromkeys((f'{i // 2}_{k}' for k in range(50)), 1.0))
+               for i in range(3000)]
+    started = time.perf_counter()
+    similarity = compatibility._cosine(vectors)
+    elapsed = time.perf_counter() - started
+    assert similarity.shape == (3000, 3000)
+    assert similarity[0, 1] == pytest.approx(1.0)
+    assert similarity[0, 2] == 0
+    # Ненулевые только блоки 2×2 пар (вместе с диагональю)
+    assert np.count_nonzero(similarity) == 4 * 1500
+    assert elapsed < 1
@@ -0,0 +1,93 @@
+"""Тесты рассылки с учетом лимитов Telegram (fanout.py)."""
+import asyncio
+import time
+
+from telegram.error import Forbidden, RetryAfter, TimedOut
+
+import fanout
+from fanout import FanOutDispatcher, TokenBucket
+
+
+class Chat:
+    """send() для одного чата: сначала бросает ошибки из errors, потом отвечает"""
+
+    def __init__(self, chat_id, *errors):
+        self.chat_id = chat_id
+        self.errors = list(errors)
+        self.calls = []
+
+    async def send(self):
+        self.calls.append(time.monotonic())
+        if self.errors:
+            raise self.errors.pop(0)
+        return f'message to {self.chat_id}'
+
+
+def test_dispatchers_share_one_bucket():
+    async def scenario():
+        first, second = FanOutDispatcher(), FanOutDispatcher()
+        assert first.bucket is second.bucket is fanout.shared_bucket()
+
+        # Две одновременные рассылки по 4 сообщения при лимите 2/с укладываются в общий бюджет
+        bucket = TokenBucket(rate=2, capacity=2)
+        chats = [Chat(chat_id) for chat_id in range(8)]
+        started = time.monotonic()
+        results = await asyncio.gather(
+            FanOutDispatcher(bucket=bucket).run((chat.chat_id, chat.send) for chat in chats[:4]),
+            FanOutDispatcher(bucket=bucket).run((chat.chat_id, chat.send) for chat in chats[4:]))
+        assert sum(len(result.sent) for result in results) == 8
+        # 2 токена сразу, остальные 6 — по 0.5 с
+        assert time.monotonic() - started >= 2.9
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_pauses_every_chat():
+    async def scenario():
+        flooded = Chat(1, RetryAfter(1))
+        other = Chat(2)
+        dispatcher = FanOutDispatcher(bucket=TokenBucket(rate=100, capacity=1))
+        started = time.monotonic()
+        result = await dispatcher.run([(1, flooded.send), (2, lambda: asyncio.sleep(0.05, 'late')),
+                                       (3, other.send)])
+        assert set(result.sent) == {1, 2, 3}
+        assert len(flooded.calls) == 2
+        # Повтор и следующие отправки ждут окончания паузы
+        assert flooded.calls[1] - started >= 1
+        assert other.calls[0] - started >= 1
+
+    asyncio.run(scenario())
+
+
+def test_forbidden_chat_is_dropped_without_retry():
+    async def scenario():
+        kicked = Chat(1, Forbidden('bot was kicked'))
+        result = await FanOutDispatcher(bucket=TokenBucket(rate=100)).run([(1, kicked.send)])
+        assert result.forbidden == [1]
+        assert not result.sent and not result.failed
+        assert len(kicked.calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_timed_out_backs_off_exponentially(monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def fake_sleep(delay, result=None):
+        delays.append(delay)
+        return await sleep(0, result)
+
+    async def scenario():
+        monkeypatch.setattr(fanout.asyncio, 'sleep', fake_sleep)
+        slow = Chat(1, TimedOut(), TimedOut())
+        hopeless = Chat(2, *(TimedOut() for _ in range(10)))
+        dispatcher = FanOutDispatcher(max_retries=2, bucket=TokenBucket(rate=1000))
+        result = await dispatcher.run([(1, slow.send)])
+        assert 1 in result.sent and delays == [1, 2]
+
+        result = await dispatcher.run([(2, hopeless.send)])
+        assert isinstance(result.failed[2], TimedOut)
+        assert len(hopeless.calls) == 3
+
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+"""Тесты индекса интересов (interest_index.py)."""
+import asyncio
+import math
+
+import pytest
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from database import Base, InterestTerm, User
+from interest_index import (index_profile, profile_vector, rebuild_index, similar_users, stem,
+                            tokenize, weight_by_idf)
+
+PROFILES = {
+    1: ('Книги, бег, настольные игры', 'Люблю кофе и разговоры', 'Инженер'),
+    2: ('Читаю книги и бегаю по утрам', None, 'Инженер-программист'),
+    3: ('Настольные игры и книга по выходным', 'Играю в шахматы', None),
+    4: ('Фотография, горы', 'Путешествую', 'Дизайнер'),
+}
+
+
+def test_stem_russian_forms():
+    assert stem('книги') == stem('книгами') == stem('книга')
+    assert stem('путешествия') == stem('путешествую')
+    assert stem('фотографией') == stem('фотография')
+    assert stem('books') == 'book'
+
+
+def test_tokenize_drops_stop_words():
+    assert tokenize('Я люблю книги и кофе, 2024') == ['книг', 'коф']
+    assert tokenize(None) == []
+
+
+def test_profile_vector_is_normalized():
+    vector = profile_vector(*PROFILES[1])
+    assert math.isclose(sum(weight * weight for weight in vector.values()), 1.0)
+    # Хобби весят больше работы
+    assert vector['книг'] > vector['инженер']
+    assert profile_vector() == {}
+
+
+def test_weight_by_idf_prefers_rare_terms():
+    vector = weight_by_idf([{'книг': 0.7, 'шахмат': 0.7}, {'книг': 1.0}, {'книг': 1.0}])[0]
+    assert vector['шахмат'] > vector['книг']
+    assert math.isclose(sum(weight * weight for weight in vector.values()), 1.0)
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    path = tmp_path / 'interests.db'
+    engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {'id': user_id, 'telegram_id': 1000 + user_id, 'hobbies': hobbies, 'about': about, 'job': job}
+            for user_id, (hobbies, about, job) in PROFILES.items()])
+    engine.dispose()
+    return path
+
+
+def test_rebuild_and_similar_users(database_url):
+    engine = create_engine(f'sqlite:///{database_url}')
+    with engine.begin() as conn:
+        assert rebuild_index(conn, batch_size=3) == len(PROFILES)
+        assert {row[0] for row in conn.execute(select(InterestTerm.user_id).distinct())} == set(PROFILES)
+    engine.dispose()
+
+    async def scenario():
+        async_engine = create_async_engine(f'sqlite+aiosqlite:///{database_url}')
+        try:
+            async with AsyncSession(async_engine) as session:
+                similar = await similar_users(session, 1, k=2)
+                assert [user_id for user_id, _ in similar] == [3, 2]
+                assert similar[0][1] > similar[1][1] > 0
+                assert await similar_users(session, 1, k=5, candidates=[2, 4]) == similar[1:]
+
+                # Изменение профиля пересчитывает только вектор этого пользователя
+                user = await session.get(User, 4)
+                user.hobbies, user.about, user.job = PROFILES[1]
+                await index_profile(session, user)
+                await session.commit()
+                assert [user_id for user_id, _ in await similar_users(session, 1, k=1)] == [4]
+        finally:
+            await async_engine.dispose()
+
+    asyncio.run(scenario())
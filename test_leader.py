@@ -0,0 +1,70 @@
+"""Тесты выбора лидера и догоняющего запуска задач (leader.py)."""
+import asyncio
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import Base, ScheduledJobRun
+from leader import LeaderElection
+
+
+def test_new_leader_catches_up_missed_jobs(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'leader.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                now = datetime.utcnow()
+                await conn.execute(insert(ScheduledJobRun), [
+                    # Ежечасная задача не запускалась два часа: срабатывание пропущено
+                    {'name': 'hourly_report', 'last_run_at': now - timedelta(hours=2)},
+                    # Еженедельная задача выполнена после последнего срабатывания
+                    {'name': 'weekly_poll', 'last_run_at': now - timedelta(minutes=1)},
+                ])
+            session_factory = async_sessionmaker(engine, expire_on_commit=False)
+            election = LeaderElection(session_factory, 'replica-1', ttl=30, renew_interval=10)
+
+            ran = []
+
+            async def hourly_report(tag):
+                ran.append(('hourly_report', tag))
+
+            async def weekly_poll(tag):
+                ran.append(('weekly_poll', tag))
+
+            async def never_ran(tag):
+                ran.append(('never_ran', tag))
+
+            # Срабатывания далеко от текущего момента: планировщик сам их не запустит
+            minute, hour = (now.minute + 30) % 60, (now.hour + 12) % 24
+            scheduler = AsyncIOScheduler(timezone='UTC')
+            scheduler.add_job(election.leader_only(hourly_report), 'cron', minute=minute, args=['cron'])
+            scheduler.add_job(election.leader_only(weekly_poll), 'cron', day_of_week='mon',
+                              hour=hour, args=['cron'])
+            scheduler.add_job(election.leader_only(never_ran), 'cron', minute=minute, args=['cron'])
+            scheduler.start()
+            try:
+                # Не-лидер ничего не догоняет
+                election.attach(scheduler)
+                assert election._catch_up_task is None
+
+                assert await election.try_acquire()
+                await election._catch_up_task
+                assert election._catch_up_task.result() == ['hourly_report']
+                assert ran == [('hourly_report', 'cron')]
+
+                async with session_factory() as session:
+                    last_run = await session.scalar(select(ScheduledJobRun.last_run_at)
+                                                    .filter_by(name='hourly_report'))
+                assert last_run > datetime.utcnow() - timedelta(minutes=1)
+
+                # После записи запуска догонять больше нечего
+                assert await election.catch_up() == []
+            finally:
+                scheduler.shutdown(wait=False)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
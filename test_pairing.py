@@ -0,0 +1,173 @@
+"""Тесты движка распределения пар (pairing.py)."""
+import asyncio
+import itertools
+import random
+import time
+from datetime import datetime
+
+from sqlalchemy import event, func, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from database import Base, PairHistory
+from pairing import (_augment, _greedy_zero_cost, count_repeats, create_pairs,
+                     load_pair_history, record_pair_history)
+
+
+def clique(users, cost=1.0):
+    """История, в которой все участники уже встречались друг с другом"""
+    history = {}
+    for i, user1 in enumerate(users):
+        for user2 in users[i + 1:]:
+            history.setdefault(user1, {})[user2] = cost
+            history.setdefault(user2, {})[user1] = cost
+    return history
+
+
+class KeepOrder(random.Random):
+    """rng без перемешивания: порядок обхода задает тест"""
+
+    def shuffle(self, x):
+        pass
+
+
+def min_repeats(users, history):
+    """Наименьшее число повторов среди всех разбиений на пары (перебор)"""
+    if not users:
+        return 0
+    first, rest = users[0], users[1:]
+    return min((1 if history.get(first, {}).get(partner, 0.0) > 0 else 0) +
+               min_repeats([user for user in rest if user != partner], history)
+               for partner in rest)
+
+
+def members(pairs):
+    return sorted(user for group in pairs for user in group)
+
+
+def test_empty_history_pairs_everyone():
+    for n in (0, 1, 2, 3, 10, 11):
+        pairs = create_pairs(list(range(n)), {}, random.Random(n))
+        assert members(pairs) == list(range(n))
+        if n >= 2:
+            assert len(pairs) == n // 2
+            assert sorted(map(len, pairs))[:-1] == [2] * (n // 2 - 1)
+
+
+def test_odd_participant_joins_cheapest_pair():
+    # 4 встречался только с 0: хотя бы одна пара без 0 найдется всегда
+    history = {4: {0: 2.0}, 0: {4: 2.0}}
+    for seed in range(20):
+        pairs = create_pairs([0, 1, 2, 3, 4], history, random.Random(seed))
+        assert members(pairs) == [0, 1, 2, 3, 4]
+        assert sorted(map(len, pairs)) == [2, 3]
+        assert count_repeats(pairs, history) == 0
+
+
+def test_greedy_skips_met_partners():
+    history = {1: {2: 1.0}, 2: {1: 1.0}}
+    mate, leftovers = _greedy_zero_cost([1, 2, 3, 4], history)
+    assert leftovers == []
+    assert mate[1] != 2 and mate[2] != 1
+
+
+def test_augment_finds_length_three_path():
+    # Жадный шаг свел 1 и 2; 3 и 4 уже встречались между собой, с 2 и 1 соответственно — нет
+    history = {3: {4: 1.0, 1: 1.0}, 4: {3: 1.0, 2: 1.0}, 1: {3: 1.0}, 2: {4: 1.0}}
+    mate = {1: 2, 2: 1}
+    remaining = _augment(mate, [3, 4], history, [1, 2, 3, 4])
+    assert remaining == []
+    assert mate == {1: 4, 4: 1, 2: 3, 3: 2}
+
+
+def test_full_clique_pairs_cheapest_repeats():
+    users = list(range(10))
+    history = clique(users)
+    # Пара 0-1 встречалась давно — ее выбрать выгоднее
+    history[0][1] = history[1][0] = 0.1
+    for seed in range(10):
+        pairs = create_pairs(users, history, random.Random(seed))
+        assert members(pairs) == users
+        assert count_repeats(pairs, history) == 5
+
+
+def test_clique_with_newcomers_is_fast():
+    # Сообщество, где все старожилы уже встретились, плюс новички
+    veterans = list(range(1500))
+    newcomers = list(range(1500, 2000))
+    history = clique(veterans)
+    started = time.perf_counter()
+    pairs = create_pairs(veterans + newcomers, history, random.Random(1))
+    elapsed = time.perf_counter() - started
+    assert members(pairs) == veterans + newcomers
+    # Каждый новичок достается старожилу: повторов ровно (1500 - 500) / 2
+    assert count_repeats(pairs, history) == 500
+    assert elapsed < 5
+
+
+def test_misses_longer_augmenting_path():
+    # Новые пары образуют путь 5 - 1 - 2 - 3 - 4 - 6, остальные уже встречались.
+    # Жадный шаг сводит 1 = 2 и 3 = 4, и увеличивающий путь остается только
+    # длины 5: приближение дает повтор 5 - 6, оптимум — ни одного
+    users = [1, 2, 3, 4, 5, 6]
+    history = clique(users)
+    for user1, user2 in ((5, 1), (1, 2), (2, 3), (3, 4), (4, 6)):
+        del history[user1][user2], history[user2][user1]
+
+    pairs = create_pairs(users, history, KeepOrder())
+    assert pairs == [(1, 2), (3, 4), (5, 6)]
+    assert count_repeats(pairs, history) == 1
+    assert min_repeats(users, history) == 0
+
+
+def test_within_two_thirds_of_optimum_on_small_graphs():
+    # Гарантия шагов 1-2: новых пар не меньше 2/3 от максимума
+    rng = random.Random(7)
+    for _ in range(200):
+        users = list(range(8))
+        history = {}
+        for user1, user2 in itertools.combinations(users, 2):
+            if rng.random() < 0.6:
+                history.setdefault(user1, {})[user2] = 1.0
+                history.setdefault(user2, {})[user1] = 1.0
+        pairs = create_pairs(users, history, random.Random(rng.random()))
+        new_pairs = len(pairs) - count_repeats(pairs, history)
+        assert new_pairs >= 2 / 3 * (len(users) // 2 - min_repeats(users, history))
+
+
+def test_pair_history_of_many_participants(tmp_path):
+    # 20000 участников: одним запросом было бы 4 * 10000 и 2 * 20000 параметров,
+    # больше лимита asyncpg (32767)
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'pairs.db'}")
+        parameters = []
+
+        @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+        def count_parameters(conn, cursor, statement, params, context, executemany):
+            parameters.append(len(params))
+
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+
+            users = list(range(1, 20001))
+            met_at = datetime(2024, 1, 1)
+            async with AsyncSession(engine) as session:
+                await record_pair_history(
+                    session, {(user, user + 1): 1 for user in users[::2]}, met_at)
+                # Повторная встреча увеличивает счетчик
+                await record_pair_history(session, {(1, 2): 1}, met_at)
+                await session.commit()
+                assert await session.scalar(select(func.count()).select_from(PairHistory)) == 10000
+
+                history = await load_pair_history(session, users, now=met_at)
+                assert len(history) == 20000
+                assert history[1] == {2: 3.0}
+                assert history[20000] == {19999: 2.0}
+
+                # Встречи с теми, кто не участвует на этой неделе, не загружаются
+                assert await load_pair_history(session, users[1::2]) == {}
+            assert max(parameters) <= 32767
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,158 @@
+"""Тесты хранения разговоров и user_data в базе (persistence.py)."""
+import asyncio
+import inspect
+import re
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+import telegram
+from telegram import Chat, Message, Update, User
+from telegram.ext import CommandHandler, ConversationHandler, MessageHandler, filters
+from telegram.ext._utils.trackingdict import TrackingDict
+
+from database import Base, ConversationState, PersistedUserData
+from persistence import DatabasePersistence, conversation_reloader
+
+BIRTH_DATE = datetime(1990, 5, 17)
+
+
+def with_database(tmp_path, scenario):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'persistence.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+            await scenario(async_sessionmaker(engine, expire_on_commit=False))
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+def message_update(chat_id, user_id, text='Москва'):
+    user = User(id=user_id, first_name='user', is_bot=False)
+    chat = Chat(id=chat_id, type=Chat.PRIVATE)
+    return Update(1, message=Message(1, datetime.utcnow(), chat, from_user=user, text=text))
+
+
+def registration_handler():
+    async def noop(update, context):
+        pass
+
+    return ConversationHandler(name='registration', persistent=True,
+                               entry_points=[CommandHandler('start', noop)],
+                               states={2: [MessageHandler(filters.TEXT, noop)]},
+                               fallbacks=[])
+
+
+def test_conversation_and_user_data_round_trip(tmp_path):
+    async def scenario(session_factory):
+        writer = DatabasePersistence(session_factory)
+        await writer.update_conversation('registration', (10, 1), 2)
+        await writer.update_conversation('registration', (20, 2), 3)
+        await writer.update_conversation('registration', (20, 2), None)
+        await writer.update_user_data(1, {'name': 'Анна', 'birth_date': BIRTH_DATE})
+        # Неизменившиеся данные повторно не пишутся
+        await writer.update_user_data(1, {'name': 'Анна', 'birth_date': BIRTH_DATE})
+        assert writer.stats()['writes'] == 4
+
+        reader = DatabasePersistence(session_factory)
+        assert await reader.get_conversations('registration') == {(10, 1): 2}
+        assert await reader.get_conversations('settings') == {}
+        assert await reader.load_conversations([('registration', (10, 1)),
+                                                ('settings', (10, 1))]) == {('registration', (10, 1)): 2}
+
+        user_data = {}
+        await reader.refresh_user_data(1, user_data)
+        await reader.refresh_user_data(1, user_data)
+        assert user_data == {'name': 'Анна', 'birth_date': BIRTH_DATE}
+        assert reader.stats()['loads'] == 1
+
+        await reader.drop_user_data(1)
+        async with session_factory() as session:
+            assert await session.scalar(select(PersistedUserData.user_id)) is None
+
+    with_database(tmp_path, scenario)
+
+
+def test_reloader_private_api_is_pinned(tmp_path):
+    # conversation_reloader опирается на закрытый API PTB: при обновлении
+    # версии тест должен упасть раньше, чем бот перестанет подгружать разговоры
+    requirements = (Path(__file__).parent / 'requirements.txt').read_text()
+    pinned = re.search(r'^python-telegram-bot(?:\[[^\]]*\])?==(\S+)$', requirements, re.M)
+    assert pinned and telegram.__version__ == pinned.group(1)
+
+    assert list(inspect.signature(ConversationHandler._get_key).parameters) == ['self', 'update']
+    for name in ('update_no_track', 'pop_accessed_write_items'):
+        assert callable(getattr(TrackingDict, name, None))
+
+    async def scenario(session_factory):
+        handler = registration_handler()
+        await handler._initialize_persistence(
+            SimpleNamespace(persistence=DatabasePersistence(session_factory)))
+        assert isinstance(handler._conversations, TrackingDict)
+        assert handler._get_key(message_update(10, 1)) == (10, 1)
+
+    with_database(tmp_path, scenario)
+
+
+def test_reloader_picks_up_conversation_started_elsewhere(tmp_path):
+    async def scenario(session_factory):
+        persistence = DatabasePersistence(session_factory)
+        handler = registration_handler()
+        await handler._initialize_persistence(SimpleNamespace(persistence=persistence))
+        reload = conversation_reloader(persistence, [handler]).callback
+
+        # Другая реплика начала разговор уже после старта этого процесса
+        await DatabasePersistence(session_factory).update_conversation('registration', (10, 1), 2)
+        assert handler.check_update(message_update(10, 1)) is None
+
+        await reload(message_update(10, 1), None)
+        assert handler._conversations[(10, 1)] == 2
+        assert handler.check_update(message_update(10, 1)) is not None
+        # Подгруженное состояние не считается изменением и не пишется обратно
+        assert not handler._conversations.pop_accessed_write_items()
+
+        # Разговор уже в памяти, и пользователи без разговора: база не читается повторно
+        await reload(message_update(10, 1), None)
+        await reload(message_update(30, 3), None)
+        assert persistence.stats()['conversation_loads'] == 2
+
+    with_database(tmp_path, scenario)
+
+
+def test_expire_drops_idle_rows_and_users(tmp_path):
+    async def scenario(session_factory):
+        persistence = DatabasePersistence(session_factory, ttl=60)
+        stale = datetime.utcnow() - timedelta(minutes=5)
+        async with session_factory() as session:
+            await session.execute(insert(ConversationState), [
+                {'name': 'registration', 'key': '[10, 1]', 'state': '2', 'updated_at': stale},
+                {'name': 'registration', 'key': '[20, 2]', 'state': '3',
+                 'updated_at': datetime.utcnow()}])
+            await session.execute(insert(PersistedUserData), [
+                {'user_id': 1, 'data': '{"name": "old"}', 'updated_at': stale}])
+            await session.commit()
+
+        await persistence.refresh_user_data(1, {})
+        await persistence.refresh_user_data(2, {})
+        # Пользователь 1 давно не обращался к боту
+        persistence._users[1] = (persistence._users[1][0] - 120, persistence._users[1][1])
+
+        dropped = []
+        application = SimpleNamespace(drop_user_data=dropped.append)
+        await persistence.expire(application)
+        assert dropped == [1]
+        assert persistence.stats()['users_in_memory'] == 1
+        assert await persistence.get_conversations('registration') == {(20, 2): 3}
+        async with session_factory() as session:
+            assert await session.scalar(select(PersistedUserData.user_id)) is None
+
+        # Выгрузка по TTL не удаляет строку: ее срок проверяет expire
+        await persistence.drop_user_data(1)
+        assert persistence.stats()['pending'] == 0
+
+    with_database(tmp_path, scenario)
@@ -0,0 +1,193 @@
+"""Тесты маршрутизации и write-behind буфера ответов на опросы (polls.py)."""
+import asyncio
+import queue
+import threading
+from contextlib import asynccontextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from database import Base, Chat, PollResponse, User, WeeklyPoll
+import sharding
+from polls import PollAnswerBuffer, PollRouter, close_replaced_polls
+
+POISON = (1, 666)
+
+
+class RecordingBuffer(PollAnswerBuffer):
+    """Пишет ответы в словарь; ответ POISON не записывается никогда"""
+
+    def __init__(self, **kwargs):
+        super().__init__(self._session, **kwargs)
+        self.rows = {}
+        self.database_down = False
+
+    @asynccontextmanager
+    async def _session(self):
+        yield None
+
+    async def _write(self, session, pending):
+        if self.database_down:
+            raise ConnectionRefusedError('database is down')
+        if POISON in pending:
+            raise ValueError('poison row')
+        self.rows.update({key: response for key, (_, response, _) in pending.items()})
+        return []
+
+
+def test_poison_row_is_dropped_after_max_attempts():
+    buffer = RecordingBuffer(max_attempts=3)
+
+    async def scenario():
+        buffer.add(1, 100, 'a', True)
+        buffer.add(*POISON, 'poison', True)
+        buffer.add(1, 101, 'b', False)
+        # Остальные ответы записываются по одному, ядовитый остается в буфере
+        assert await buffer.flush() == 2
+        assert buffer.rows == {(1, 100): True, (1, 101): False}
+        assert len(buffer) == 1
+
+        buffer.add(1, 102, 'c', True)
+        assert await buffer.flush() == 1
+        assert await buffer.flush() == 0
+        assert len(buffer) == 0
+
+    asyncio.run(scenario())
+    assert buffer.stats()['dropped'] == 1
+    assert buffer.stats()['flushed'] == 3
+
+
+def test_unavailable_database_keeps_answers():
+    buffer = RecordingBuffer(max_attempts=1)
+
+    async def scenario():
+        buffer.add(1, 100, 'a', True)
+        buffer.database_down = True
+        for _ in range(3):
+            with pytest.raises(ConnectionRefusedError):
+                await buffer.flush()
+        # Ошибки соединения не считаются попытками записи строки
+        assert len(buffer) == 1
+        buffer.database_down = False
+        assert await buffer.flush() == 1
+
+    asyncio.run(scenario())
+    assert buffer.stats()['dropped'] == 0
+
+
+def test_unregistered_yes_voters_are_found_while_writing(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'answers.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.execute(insert(Chat), [{'id': 1, 'chat_id': -1}])
+                await conn.execute(insert(WeeklyPoll), [{'id': 1, 'chat_id': 1, 'status': 'active'}])
+                await conn.execute(insert(User), [
+                    {'telegram_id': 100, 'nickname': 'registered'},
+                    {'telegram_id': 101, 'nickname': None}])
+
+            notified = []
+
+            async def on_unregistered(telegram_ids):
+                notified.append(telegram_ids)
+
+            buffer = PollAnswerBuffer(lambda: AsyncSession(engine))
+            buffer.on_unregistered = on_unregistered
+            buffer.add(1, 100, 'registered', True)
+            buffer.add(1, 101, 'no_nickname', True)
+            buffer.add(1, 102, 'new', True)
+            buffer.add(1, 103, 'declined', False)
+            assert await buffer.flush() == 4
+            await asyncio.sleep(0)
+
+            assert notified == [[101, 102]]
+            async with AsyncSession(engine) as session:
+                assert await session.scalar(select(func.count(PollResponse.id))) == 4
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_replaced_polls_leave_the_router(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'polls.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.execute(insert(Chat), [{'id': 1, 'chat_id': -1}, {'id': 2, 'chat_id': -2}])
+                await conn.execute(insert(WeeklyPoll), [
+                    {'id': 1, 'chat_id': 1, 'telegram_poll_id': 'week1', 'status': 'active',
+                     'created_at': datetime.utcnow()},
+                    {'id': 2, 'chat_id': 2, 'telegram_poll_id': 'other', 'status': 'active',
+                     'created_at': datetime.utcnow()}])
+
+            router = PollRouter()
+            async with AsyncSession(engine) as session:
+                await router.warm_up(session)
+                assert len(router) == 2
+
+                assert await close_replaced_polls(session, [1], router) == 1
+                session.add(WeeklyPoll(id=3, chat_id=1, telegram_poll_id='week2', status='active',
+                                       created_at=datetime.utcnow()))
+                await session.commit()
+                router.register('week2', 3)
+
+                assert len(router) == 2
+                # Ответ на закрытый опрос больше не маршрутизируется, и кэш не растет
+                assert await router.resolve(session, 'week1') is None
+                assert await router.resolve(session, 'week2') == 3
+                assert len(router) == 2
+                assert (await session.scalar(select(WeeklyPoll.status).filter_by(id=1))) == 'closed'
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_closed_poll_leaves_other_workers_routers(tmp_path, monkeypatch):
+    # Лидер закрывает опрос, воркер продолжал бы маршрутизировать ответы по своему кэшу
+    leader, worker = PollRouter(), PollRouter()
+    monkeypatch.setattr(sharding, 'poll_router', worker)
+    broadcasts = queue.Queue()
+    pool = SimpleNamespace(queues=[queue.Queue(), queue.Queue()])
+    leader.publish = lambda telegram_poll_id: broadcasts.put(
+        {sharding.POLL_INVALIDATION: telegram_poll_id, 'origin': 0})
+    relay = threading.Thread(target=sharding._relay_broadcasts, args=(broadcasts, pool))
+    relay.start()
+
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'polls.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.execute(insert(Chat), [{'id': 1, 'chat_id': -1}])
+                await conn.execute(insert(WeeklyPoll), [
+                    {'id': 1, 'chat_id': 1, 'telegram_poll_id': 'week1', 'status': 'active',
+                     'created_at': datetime.utcnow()}])
+
+            async with AsyncSession(engine) as session:
+                await leader.warm_up(session)
+                await worker.warm_up(session)
+                assert await close_replaced_polls(session, [1], leader) == 1
+                await session.commit()
+                # Без рассылки воркер отвечал бы из кэша
+                assert await worker.resolve(session, 'week1') == 1
+
+                message = pool.queues[1].get(timeout=5)
+                assert await sharding._apply_broadcast(message)
+                assert await worker.resolve(session, 'week1') is None
+                # Отправитель свое сообщение не получает
+                assert pool.queues[0].empty()
+        finally:
+            await engine.dispose()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        broadcasts.put(None)
+        relay.join(5)
@@ -0,0 +1,115 @@
+"""Тесты кэша профилей (profile_cache.py) и рассылки его сбросов между воркерами."""
+import asyncio
+import queue
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+from database import Base, User
+from profile_cache import ProfileCache
+from sharding import PROFILE_INVALIDATION, _relay_broadcasts
+from state_store import InMemoryKeyValue, LocalBackend, SharedBackend
+
+BIRTH_DATE = datetime(1990, 5, 17)
+
+
+def with_users(tmp_path, scenario):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'profiles.db'}")
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+                await conn.execute(insert(User), [
+                    {'id': i, 'telegram_id': 100 + i, 'nickname': f'user{i}',
+                     'birth_date': BIRTH_DATE, 'created_at': datetime.utcnow()}
+                    for i in range(1, 4)])
+            async with AsyncSession(engine) as session:
+                await scenario(session)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_lru_and_unregistered_users(tmp_path):
+    cache = ProfileCache(ttl=60, backend=LocalBackend(max_entries=2))
+
+    async def scenario(session):
+        assert (await cache.load(session, 101)).nickname == 'user1'
+        assert (await cache.load(session, 102)).nickname == 'user2'
+        # Незарегистрированный тоже кэшируется и вытесняет давно не использованный профиль
+        assert await cache.load(session, 999) is None
+        assert await cache.load(session, 999) is None
+        assert (await cache.load(session, 102)).nickname == 'user2'
+        assert (await cache.load(session, 101)).nickname == 'user1'
+
+    with_users(tmp_path, scenario)
+    stats = cache.stats()
+    assert stats['evictions'] == 2
+    assert (stats['hits'], stats['misses']) == (2, 4)
+
+
+def test_ttl_expiry(tmp_path):
+    cache = ProfileCache(ttl=-1, backend=LocalBackend())
+
+    async def scenario(session):
+        await cache.load(session, 101)
+        await cache.load(session, 101)
+
+    with_users(tmp_path, scenario)
+    assert cache.stats()['hits'] == 0
+    assert cache.stats()['expirations'] == 1
+
+
+def test_invalidation_is_published(tmp_path):
+    published = []
+    cache = ProfileCache(ttl=60, backend=LocalBackend())
+    cache.publish = published.append
+
+    async def scenario(session):
+        await cache.load(session, 101)
+        await session.execute(User.__table__.update().where(User.id == 1).values(nickname='renamed'))
+        assert (await cache.load(session, 101)).nickname == 'user1'
+        await cache.invalidate(101)
+        assert (await cache.load(session, 101)).nickname == 'renamed'
+        # Сброс, полученный от другого воркера, дальше не рассылается
+        await cache.drop(101)
+
+    with_users(tmp_path, scenario)
+    assert published == [101]
+
+
+def test_shared_backend_round_trip(tmp_path):
+    client = InMemoryKeyValue()
+    first = ProfileCache(ttl=60, backend=SharedBackend(client, 'state:profiles'))
+    second = ProfileCache(ttl=60, backend=SharedBackend(client, 'state:profiles'))
+
+    async def scenario(session):
+        loaded = await first.load(session, 101)
+        cached = await second.get(101)
+        assert cached.birth_date == loaded.birth_date == BIRTH_DATE
+        assert cached.created_at == loaded.created_at
+        # Общее хранилище: сброс в одном процессе виден во всех
+        await first.invalidate(101)
+        await second.get(101)
+
+    with_users(tmp_path, scenario)
+    assert (second.stats()['hits'], second.stats()['misses']) == (1, 1)
+
+
+def test_relay_skips_the_sender():
+    broadcasts = queue.Queue()
+    pool = SimpleNamespace(queues=[queue.Queue() for _ in range(3)])
+    relay = threading.Thread(target=_relay_broadcasts, args=(broadcasts, pool))
+    relay.start()
+    broadcasts.put({PROFILE_INVALIDATION: 101, 'origin': 1})
+    broadcasts.put(None)
+    relay.join(5)
+
+    assert not relay.is_alive()
+    assert pool.queues[1].empty()
+    for index in (0, 2):
+        assert pool.queues[index].get_nowait()[PROFILE_INVALIDATION] == 101
@@ -0,0 +1,178 @@
+"""Регрессионные тесты планов запросов.
+
+Заполняет базу реалистичным объемом данных и через EXPLAIN проверяет, что
+запросы, которые выполняют обработчики bot.py, хранилище разговоров,
+выборы лидера и индекс интересов, используют индексы.
+
+SQLite проверяется всегда. Для PostgreSQL укажите TEST_POSTGRES_URL
+(база будет очищена): там план строится с enable_seqscan = off, так что
+Seq Scan в плане означает, что подходящего индекса нет вовсе.
+"""
+import os
+import random
+import re
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import case, create_engine, func, insert, or_, select, text, update
+
+from aggregates import _stats_statement
+from database import (Base, Chat, ConversationState, InterestTerm, LeaderLease, Meeting,
+                      PairHistory, PersistedUserData, PollResponse, Rating, User, WeeklyPoll)
+
+USERS = 5000
+CHATS = 100
+POLLS_PER_CHAT = 20
+RESPONSES_PER_POLL = 40
+MEETINGS = 30000
+RATINGS = 10000
+TERMS = 2000
+TERMS_PER_USER = 12
+CONVERSATIONS = 5000
+
+
+def seed(engine):
+    """Заполняет базу данными, похожими на рабочие"""
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {'id': i, 'telegram_id': 10 ** 6 + i, 'username': f'user{i}',
+             'nickname': f'User {i}', 'about': 'о себе ' * 20}
+            for i in range(1, USERS + 1)])
+        conn.execute(insert(Chat), [
+            {'id': i, 'chat_id': -10 ** 6 - i, 'title': f'chat {i}', 'is_active': True}
+            for i in range(1, CHATS + 1)])
+        polls = [
+            {'id': (chat - 1) * POLLS_PER_CHAT + week + 1, 'chat_id': chat,
+             'message_id': (chat - 1) * POLLS_PER_CHAT + week + 1,
+             'telegram_poll_id': str((chat - 1) * POLLS_PER_CHAT + week + 1),
+             'status': 'closed', 'created_at': now - timedelta(weeks=POLLS_PER_CHAT - week)}
+            for chat in range(1, CHATS + 1) for week in range(POLLS_PER_CHAT)]
+        conn.execute(insert(WeeklyPoll), polls)
+        conn.execute(insert(PollResponse), [
+            {'poll_id': poll['id'], 'user_id': user_id, 'response': rng.random() < 0.7}
+            for poll in polls
+            for user_id in rng.sample(range(1, USERS + 1), RESPONSES_PER_POLL)])
+        meetings = []
+        for _ in range(MEETINGS):
+            user1, user2 = rng.sample(range(1, USERS + 1), 2)
+            meetings.append({'user1_id': user1, 'user2_id': user2,
+                             'status': rng.choice(['scheduled', 'completed']),
+                             'created_at': now - timedelta(days=rng.randrange(365))})
+        conn.execute(insert(Meeting), meetings)
+        conn.execute(insert(Rating), [
+            {'meeting_id': rng.randrange(1, MEETINGS + 1),
+             'from_user_id': rng.randrange(1, USERS + 1),
+             'to_user_id': rng.randrange(1, USERS + 1),
+             'rating': rng.randrange(1, 6)}
+            for _ in range(RATINGS)])
+        pairs = {(min(m['user1_id'], m['user2_id']), max(m['user1_id'], m['user2_id']))
+                 for m in meetings}
+        conn.execute(insert(PairHistory), [
+            {'user_low_id': low, 'user_high_id': high, 'meet_count': 1,
+             'last_met_at': now} for low, high in pairs])
+        conn.execute(insert(InterestTerm), [
+            {'user_id': user_id, 'term': f'term{term}', 'weight': rng.random()}
+            for user_id in range(1, USERS + 1)
+            for term in rng.sample(range(TERMS), TERMS_PER_USER)])
+        conn.execute(insert(ConversationState), [
+            {'name': rng.choice(['registration', 'settings']), 'key': f'[{-i}, {i}]',
+             'state': '1', 'updated_at': now - timedelta(hours=rng.randrange(72))}
+            for i in range(1, CONVERSATIONS + 1)])
+        conn.execute(insert(PersistedUserData), [
+            {'user_id': 10 ** 6 + i, 'data': '{}',
+             'updated_at': now - timedelta(hours=rng.randrange(72))}
+            for i in range(1, USERS + 1)])
+        conn.execute(insert(LeaderLease), [
+            {'name': 'scheduler', 'holder_id': 'replica-1', 'expires_at': now, 'acquired_at': now}])
+        conn.execute(text('ANALYZE'))
+
+
+def hot_path_queries():
+    """Запросы, которые выполняются в работе бота (активные чаты и bot_instances читаются целиком намеренно)"""
+    user_id = 1234
+    user_ids = list(range(100, 140))
+    terms = [f'term{term}' for term in range(0, 120, 10)]
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=1)
+    return {
+        'user by telegram_id': select(User.id, User.nickname)
+        .filter(User.telegram_id == 10 ** 6 + user_id),
+        'chat by chat_id': select(Chat).filter_by(chat_id=-10 ** 6 - 7),
+        'active poll by telegram poll id': select(WeeklyPoll.id)
+        .filter(WeeklyPoll.telegram_poll_id == '555')
+        .filter(WeeklyPoll.status == 'active'),
+        'latest poll of chat': select(WeeklyPoll).filter_by(chat_id=7)
+        .order_by(WeeklyPoll.created_at.desc()).limit(1),
+        'positive responses': select(PollResponse.user_id)
+        .filter_by(poll_id=555, response=True),
+        'response of user': select(PollResponse).filter(
+            PollResponse.poll_id == 555, PollResponse.user_id == user_id),
+        'pair history of participants': select(PairHistory.user_low_id, PairHistory.user_high_id,
+                                               PairHistory.meet_count, PairHistory.last_met_at)
+        .filter(PairHistory.user_low_id.in_(user_ids)),
+        'participants by id': select(User.id, User.username, User.telegram_id)
+        .filter(User.id.in_(user_ids)),
+        'stats of user': _stats_statement().filter(User.telegram_id == 10 ** 6 + user_id),
+        'stats of users': _stats_statement().filter(
+            User.telegram_id.in_([10 ** 6 + i for i in user_ids])),
+        'persisted user data': select(PersistedUserData.data)
+        .filter(PersistedUserData.user_id == 10 ** 6 + user_id),
+        'conversations of handler': select(ConversationState.key, ConversationState.state)
+        .filter(ConversationState.name == 'settings', ConversationState.updated_at >= cutoff),
+        'leader lease compare-and-set': update(LeaderLease)
+        .where(LeaderLease.name == 'scheduler',
+               or_(LeaderLease.holder_id == 'replica-2', LeaderLease.expires_at < now))
+        .values(holder_id='replica-2', expires_at=now + timedelta(seconds=30),
+                acquired_at=case((LeaderLease.holder_id == 'replica-2', LeaderLease.acquired_at),
+                                 else_=now)),
+        'interest vectors of users': select(InterestTerm.user_id, InterestTerm.term, InterestTerm.weight)
+        .filter(InterestTerm.user_id.in_(user_ids)),
+        'interest term frequencies': select(InterestTerm.term, func.count())
+        .filter(InterestTerm.term.in_(terms))
+        .group_by(InterestTerm.term),
+        'users sharing interest terms': select(InterestTerm.user_id, InterestTerm.weight)
+        .filter(InterestTerm.term.in_(terms), InterestTerm.user_id != user_id),
+    }
+
+
+def explain(conn, stmt):
+    """Возвращает план запроса в виде строки"""
+    sql = str(stmt.compile(dialect=conn.dialect,
+                           compile_kwargs={'literal_binds': True}))
+    if conn.dialect.name == 'sqlite':
+        rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql).all()
+        return '\n'.join(row[-1] for row in rows)
+    conn.exec_driver_sql('SET enable_seqscan = off')
+    return '\n'.join(row[0] for row in conn.exec_driver_sql('EXPLAIN ' + sql))
+
+
+def engines():
+    urls = [pytest.param(os.environ['DATABASE_URL'], id='sqlite')]
+    postgres_url = os.getenv('TEST_POSTGRES_URL')
+    urls.append(pytest.param(postgres_url, id='postgresql', marks=pytest.mark.skipif(
+        not postgres_url, reason='TEST_POSTGRES_URL is not set')))
+    return urls
+
+
+@pytest.fixture(scope='module', params=engines())
+def seeded_engine(request):
+    engine = create_engine(request.param)
+    seed(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize('name', list(hot_path_queries()))
+def test_query_uses_index(seeded_engine, name):
+    with seeded_engine.connect() as conn:
+        plan = explain(conn, hot_path_queries()[name])
+    if seeded_engine.dialect.name == 'sqlite':
+        # SCAN без USING ... INDEX — полный проход по таблице
+        assert not re.search(r'^SCAN \w+$', plan, re.MULTILINE), plan
+        assert 'USE TEMP B-TREE' not in plan, plan
+    else:
+        assert 'Seq Scan' not in plan, plan
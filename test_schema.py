@@ -0,0 +1,119 @@
+"""Тесты приведения базы к головной ревизии (schema.py)."""
+import logging
+from datetime import datetime
+
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, Float, ForeignKey, Integer, MetaData,
+                        String, Table, Text, create_engine, inspect, text)
+
+import schema
+
+
+def baseline_metadata():
+    """Таблицы, которые создавал прежний init_db() через create_all"""
+    metadata = MetaData()
+    Table('users', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('telegram_id', BigInteger, unique=True, nullable=False),
+          Column('username', String), Column('nickname', String), Column('city', String),
+          Column('social_link', String), Column('about', Text), Column('job', String),
+          Column('birth_date', DateTime), Column('avatar', String), Column('hobbies', Text),
+          Column('created_at', DateTime), Column('status', String(50)),
+          Column('is_active', Boolean), Column('show_profile', Boolean),
+          Column('experience_level', Integer), Column('total_meetings', Integer),
+          Column('average_rating', Float), Column('last_active', DateTime),
+          Column('settings', Text))
+    Table('user_preferences', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+          Column('preferred_gender', String(50)), Column('age_range_min', Integer),
+          Column('age_range_max', Integer), Column('preferred_languages', String(255)),
+          Column('preferred_interests', String(500)), Column('preferred_meeting_times', String(100)),
+          Column('only_new_users', Boolean), Column('only_experienced', Boolean))
+    Table('meetings', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('user1_id', Integer, ForeignKey('users.id'), nullable=False),
+          Column('user2_id', Integer, ForeignKey('users.id'), nullable=False),
+          Column('scheduled_time', DateTime), Column('status', String(50)),
+          Column('created_at', DateTime))
+    Table('ratings', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('meeting_id', Integer, ForeignKey('meetings.id'), nullable=False),
+          Column('from_user_id', Integer, ForeignKey('users.id'), nullable=False),
+          Column('to_user_id', Integer, ForeignKey('users.id'), nullable=False),
+          Column('rating', Float), Column('comment', String(500)), Column('created_at', DateTime))
+    Table('chats', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('chat_id', BigInteger, unique=True, nullable=False),
+          Column('title', String(255)), Column('is_active', Boolean), Column('joined_at', DateTime))
+    Table('weekly_polls', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('chat_id', Integer, ForeignKey('chats.id'), nullable=False),
+          Column('message_id', Integer), Column('week_start', DateTime), Column('week_end', DateTime),
+          Column('status', String(50)), Column('created_at', DateTime))
+    Table('poll_responses', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('poll_id', Integer, ForeignKey('weekly_polls.id'), nullable=False),
+          Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+          Column('response', Boolean), Column('created_at', DateTime))
+    Table('bot_instances', metadata,
+          Column('instance_id', String(36), primary_key=True),
+          Column('last_heartbeat', DateTime, nullable=False))
+    return metadata
+
+
+def current_revisions(database_url):
+    engine = create_engine(database_url)
+    try:
+        with engine.connect() as connection:
+            return schema._current_revisions(connection), set(inspect(connection).get_table_names())
+    finally:
+        engine.dispose()
+
+
+def test_empty_database_is_created_at_head(tmp_path, monkeypatch):
+    database_url = f"sqlite:///{tmp_path / 'empty.db'}"
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    bot_logger = logging.getLogger('bot')
+    schema.migrate()
+    revisions, tables = current_revisions(database_url)
+    assert revisions == schema.get_head_revisions()
+    assert {'pair_history', 'interest_terms'} <= tables
+    # Настройка логирования Alembic не отключает логгеры процесса
+    assert not bot_logger.disabled
+
+
+def test_unversioned_production_database_is_stamped_and_upgraded(tmp_path, monkeypatch):
+    database_url = f"sqlite:///{tmp_path / 'production.db'}"
+    engine = create_engine(database_url)
+    baseline_metadata().create_all(engine)
+    with engine.begin() as connection:
+        for user_id in (1, 2):
+            connection.execute(text(
+                "INSERT INTO users (id, telegram_id, username, total_meetings, created_at) "
+                "VALUES (:id, :telegram_id, :username, 0, :now)"),
+                {'id': user_id, 'telegram_id': 100 + user_id, 'username': f'old_user{user_id}',
+                 'now': datetime.utcnow()})
+        connection.execute(text(
+            "INSERT INTO meetings (user1_id, user2_id, status, created_at) "
+            "VALUES (1, 2, 'completed', :now)"), {'now': datetime.utcnow()})
+    engine.dispose()
+
+    monkeypatch.setenv('DATABASE_URL', database_url)
+    schema.migrate()
+
+    revisions, tables = current_revisions(database_url)
+    assert revisions == schema.get_head_revisions()
+    assert {'pair_history', 'leader_leases', 'conversation_states', 'interest_terms'} <= tables
+    engine = create_engine(database_url)
+    try:
+        with engine.connect() as connection:
+            row = connection.execute(text(
+                "SELECT username, total_meetings, completed_meetings FROM users WHERE id = 1")).one()
+        # Данные сохранились, счетчики из add_user_aggregates посчитаны по встречам
+        assert tuple(row) == ('old_user1', 1, 1)
+    finally:
+        engine.dispose()
+
+    # Повторный запуск release-фазы ничего не меняет
+    schema.migrate()
+    assert current_revisions(database_url)[0] == schema.get_head_revisions()
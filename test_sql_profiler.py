@@ -0,0 +1,55 @@
+"""Тесты профилировщика SQL (sql_profiler.py)."""
+import pytest
+from sqlalchemy import create_engine, insert, select
+
+from database import Base, User
+from sql_profiler import NPlusOneError, normalize_sql, profile_scope
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{'telegram_id': 100 + i, 'username': f'user{i}'}
+                                    for i in range(10)])
+    yield engine
+    engine.dispose()
+
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT * FROM users WHERE id = 5 AND name = 'x'") == \
+        "SELECT * FROM users WHERE id = ? AND name = ?"
+    assert normalize_sql("SELECT users_1.id FROM users AS users_1 WHERE id IN (?, ?, ?)") == \
+        "SELECT users_1.id FROM users AS users_1 WHERE id IN (?...)"
+    assert normalize_sql("SELECT x::text FROM t WHERE a = :a") == "SELECT x::text FROM t WHERE a = ?"
+
+
+def test_detects_n_plus_one(engine):
+    with pytest.raises(NPlusOneError, match='users'):
+        with profile_scope('per-user selects', mode='fail', threshold=3), engine.connect() as conn:
+            for telegram_id in range(100, 110):
+                conn.execute(select(User.id).filter(User.telegram_id == telegram_id))
+
+
+def test_warn_mode_logs(engine, caplog):
+    with profile_scope('warn', mode='warn', threshold=3) as profile, engine.connect() as conn:
+        for telegram_id in range(100, 105):
+            conn.execute(select(User.id).filter(User.telegram_id == telegram_id))
+    assert profile.count == 5
+    assert 'Possible N+1 in warn' in caplog.text
+
+
+def test_fixture_counts_batched_query(engine, sql_profile):
+    with engine.connect() as conn:
+        conn.execute(select(User.id).filter(User.telegram_id.in_(range(100, 110)))).all()
+        conn.execute(select(User.id).filter(User.telegram_id.in_(range(100, 103)))).all()
+    # Списки IN разной длины считаются одним запросом
+    assert list(sql_profile.statements.values())[0][0] == 2
+    assert sql_profile.repeated() == []
+
+
+def test_scope_off_records_nothing(engine):
+    with profile_scope('off', mode='off') as profile, engine.connect() as conn:
+        conn.execute(select(User.id))
+    assert profile is None
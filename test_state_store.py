@@ -0,0 +1,65 @@
+"""Тесты ограниченного хранилища состояния (state_store.py)."""
+import asyncio
+
+import pytest
+
+from state_store import InMemoryKeyValue, LocalBackend, SharedBackend, StateStore
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_lru_eviction():
+    store = StateStore('test_lru', ttl=60, backend=LocalBackend(max_entries=2))
+
+    async def scenario():
+        await store.set(1, 'a')
+        await store.set(2, 'b')
+        assert await store.get(1) == 'a'
+        await store.set(3, 'c')
+        # 2 использовался давнее всех
+        assert await store.get(2) is None
+        assert await store.get(1) == 'a'
+        assert await store.get(3) == 'c'
+
+    run(scenario())
+    stats = store.stats()
+    assert stats['size'] == 2
+    assert stats['evictions'] == 1
+    assert stats['misses'] == 1
+
+
+def test_ttl_expiry_and_purge():
+    store = StateStore('test_ttl', ttl=60, backend=LocalBackend())
+
+    async def scenario():
+        await store.set('expired', 1, ttl=-1)
+        await store.set('gone', 2, ttl=-1)
+        await store.set('alive', 3)
+        assert await store.get('expired') is None
+        assert await store.purge() == 1
+        assert await store.get('alive') == 3
+
+    run(scenario())
+    assert store.stats()['expirations'] == 2
+    assert store.stats()['size'] == 1
+
+
+@pytest.mark.parametrize('backend', [
+    lambda: LocalBackend(),
+    lambda: SharedBackend(InMemoryKeyValue(), 'state:test'),
+])
+def test_backends_share_interface(backend):
+    store = StateStore('test_backend', ttl=60, backend=backend())
+
+    async def scenario():
+        await store.set(42, {'step': 'city'})
+        assert await store.get(42) == {'step': 'city'}
+        assert await store.pop(42) == {'step': 'city'}
+        assert await store.get(42, 'missing') == 'missing'
+        await store.set(43, [1, 2], ttl=-1)
+        assert await store.get(43) is None
+
+    run(scenario())
+    assert store.stats()['hits'] == 2
@@ -0,0 +1,57 @@
+"""Тесты режима вебхука (webhook.py) против заглушки Bot API (fake_telegram.py)."""
+import asyncio
+import socket
+
+import httpx
+import pytest
+from telegram import Bot
+from telegram.ext import Updater
+
+from fake_telegram import FakeBotAPI, make_update
+from webhook import SECRET_HEADER, WebhookServer
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_secret_and_url_are_required():
+    updater = Updater(Bot('1:token'), asyncio.Queue())
+    with pytest.raises(RuntimeError, match='WEBHOOK_SECRET_TOKEN'):
+        WebhookServer(updater, 'https://bot.example.com', secret_token='')
+    with pytest.raises(RuntimeError, match='WEBHOOK_URL'):
+        WebhookServer(updater, '', secret_token='secret')
+
+
+def test_updates_need_the_secret_header():
+    async def scenario():
+        api = FakeBotAPI()
+        api_port = await api.start('127.0.0.1', 0)
+        updater = Updater(Bot('1:token', base_url=f'http://127.0.0.1:{api_port}/bot'), asyncio.Queue())
+        server = WebhookServer(updater, 'https://bot.example.com/', secret_token='secret')
+        port = free_port()
+        try:
+            async with updater:
+                await server.start('127.0.0.1', port)
+                assert api.calls['setWebhook'] == 1
+
+                url = f'http://127.0.0.1:{port}/telegram'
+                async with httpx.AsyncClient() as client:
+                    # Секрет проверяется в каждом запросе
+                    for headers in ({}, {SECRET_HEADER: 'wrong'}):
+                        response = await client.post(url, json=make_update(1, 10), headers=headers)
+                        assert response.status_code == 403
+                    response = await client.post(url, json=make_update(2, 10),
+                                                 headers={SECRET_HEADER: 'secret'})
+                    assert response.status_code == 200
+
+                update = await asyncio.wait_for(updater.update_queue.get(), 5)
+                assert update.update_id == 2
+                assert updater.update_queue.empty()
+                await server.stop()
+        finally:
+            await api.stop()
+
+    asyncio.run(scenario())
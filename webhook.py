@@ -0,0 +1,99 @@
+"""Режим вебхука: прием обновлений Telegram по HTTP вместо long polling.
+
+HTTP-сервер — встроенный вебхук PTB (Updater.start_webhook на tornado,
+пакет python-telegram-bot[webhooks]): он принимает POST от Telegram,
+сверяет заголовок X-Telegram-Bot-Api-Secret-Token с секретом в каждом
+запросе, кладет обновление в очередь Updater и регистрирует вебхук в
+Telegram. Проверка для балансировщика — GET /health на сервере метрик
+(metrics.py, METRICS_PORT).
+
+Режим включается переменной BOT_MODE=webhook:
+
+    WEBHOOK_URL              публичный адрес, который регистрируется в Telegram (обязателен)
+    WEBHOOK_LISTEN           интерфейс для сервера (0.0.0.0)
+    WEBHOOK_PORT             порт (PORT платформы или 8443)
+    WEBHOOK_PATH             путь для обновлений (/telegram)
+    WEBHOOK_SECRET_TOKEN     секрет для заголовка Telegram (обязателен)
+    WEBHOOK_MAX_CONNECTIONS  сколько соединений Telegram открывает к вебхуку (40)
+"""
+import asyncio
+import logging
+import os
+import signal
+
+from telegram import Update
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+# polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+
+# Telegram открывает не больше 100 соединений к вебхуку
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """Вебхук PTB с обязательным секретом.
+
+    Обновления попадают в updater.update_queue: для приложения это его
+    очередь (application.updater), для диспетчера воркеров (sharding.py) —
+    отдельная очередь, которую он раздает по шардам.
+    """
+
+    def __init__(self, updater: Updater, webhook_url: str = WEBHOOK_URL, path: str = WEBHOOK_PATH,
+                 secret_token: str = WEBHOOK_SECRET_TOKEN,
+                 max_connections: int = WEBHOOK_MAX_CONNECTIONS):
+        # Без секрета PTB принимает обновления от кого угодно
+        if not secret_token:
+            raise RuntimeError("WEBHOOK_SECRET_TOKEN must be set when BOT_MODE=webhook")
+        # Без адреса PTB зарегистрировал бы в Telegram адрес интерфейса (http://0.0.0.0:...)
+        if not webhook_url:
+            raise RuntimeError("WEBHOOK_URL must be set when BOT_MODE=webhook")
+        self.updater = updater
+        self.webhook_url = webhook_url.rstrip('/') + path
+        self.path = path
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+
+    async def start(self, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT):
+        """Запускает сервер и регистрирует вебхук в Telegram"""
+        await self.updater.start_webhook(
+            listen=listen, port=port, url_path=self.path, webhook_url=self.webhook_url,
+            secret_token=self.secret_token, max_connections=self.max_connections,
+            allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Webhook listening on {listen}:{port}{self.path}, registered at {self.webhook_url}")
+
+    async def stop(self):
+        if self.updater.running:
+            await self.updater.stop()
+
+
+async def run_webhook(application, webhook_url: str = WEBHOOK_URL):
+    """Запускает приложение в режиме вебхука до SIGINT/SIGTERM"""
+    server = WebhookServer(application.updater, webhook_url)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        await server.start()
+        await application.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+
+    # post_shutdown вызывается только из run_polling/run_webhook
+    if application.post_shutdown:
+        await application.post_shutdown(application)